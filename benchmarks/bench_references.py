@@ -0,0 +1,122 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+# S.D.G
+
+"""
+Micro-benchmark of the reference extraction of IRC messages
+
+Extracts the references of a synthetic stream of channel traffic, mostly
+chatter with some links and info requests, with lugito.references and with
+the token splitting and parsing previously done by the irc connector.
+
+    python -m benchmarks.bench_references [--messages N] [--repeat N]
+"""
+
+# Imports
+import random
+import argparse
+import timeit
+from lugito.references import extract_references
+
+HOST = 'https://phab.lubuntu.me/'
+USERNAME = 'lugito'
+
+CHATTER = [
+    'is anyone around to look at the installer?',
+    'Thanks! That fixed it for me',
+    'The daily ISO boots fine here, Disco looks good',
+    'Dinner time, back in an hour',
+    'Testing the new Qt build now, will report back',
+]
+
+
+def make_traffic(count, seed=0):
+    """Build count messages of which about one in five mentions tasks"""
+
+    rng = random.Random(seed)
+    messages = []
+
+    for _ in range(count):
+        roll = rng.random()
+
+        if roll < 0.1:
+            messages.append('see {}T{}#{} and {}D{}'.format(HOST,
+                rng.randint(1, 999), rng.randint(1, 9999), HOST,
+                rng.randint(1, 200)))
+
+        elif roll < 0.2:
+            messages.append('{}: info {}'.format(USERNAME, ' '.join(
+                'T{}'.format(rng.randint(1, 999)) for _ in range(3))))
+
+        else:
+            messages.append(rng.choice(CHATTER))
+
+    return messages
+
+
+def parse_legacy(task):
+    """The parsing done by irc.get_task_info before lugito.references"""
+
+    anchor = None
+    if '#' in task:
+        task, anchor = task.split('#')
+
+    try:
+        if len(task.split('T')) > 1:
+            return ('T', int(task.split('T')[1]), anchor)
+
+        elif len(task.split('D')) > 1:
+            return ('D', int(task.split('D')[1]), anchor)
+
+    except ValueError:
+        return None
+
+
+def legacy(message):
+    """The splitting done by irc.bot before lugito.references"""
+
+    tasks = []
+
+    if message.startswith(USERNAME + ': info'):
+        for item in message.split(USERNAME + ': info', 1)[1].split():
+            if item.startswith('T') or item.startswith('D'):
+                tasks.append(item.strip())
+
+    elif HOST in message:
+        for item in message.split(HOST):
+            if item.split() and (item.split()[0].startswith('T') or
+                item.split()[0].startswith('D')):
+                tasks.append(item.split()[0].strip())
+
+    return [parse_legacy(task) for task in tasks]
+
+
+def extractor(message):
+
+    if message.startswith(USERNAME + ': info'):
+        return extract_references(message, HOST)
+
+    elif HOST in message:
+        return extract_references(message, HOST, bare=False)
+
+    return []
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--messages', type=int, default=100000)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args(args)
+
+    messages = make_traffic(args.messages)
+
+    for name, func in [('legacy', legacy), ('extractor', extractor)]:
+        best = min(timeit.repeat(lambda: [func(m) for m in messages],
+            number=1, repeat=args.repeat))
+
+        print('%-10s %8.3f s %8.3f us/message' % (name, best,
+            best / len(messages) * 1e6))
+
+
+if __name__ == '__main__':
+    main()
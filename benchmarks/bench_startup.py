@@ -0,0 +1,85 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+# S.D.G
+
+"""
+Startup regression benchmark
+
+Profiles the startup of lugito several times and fails if the median
+startup time exceeds the budget.  Unless a directory holding a .lugitorc
+is given, the startup uses a minimal config without connectors.
+
+    python -m benchmarks.bench_startup [--budget SECONDS] [--repeat N]
+        [--cwd DIRECTORY]
+"""
+
+# Imports
+import os
+import io
+import sys
+import time
+import argparse
+import tempfile
+import statistics
+from lugito.profiling import profile_startup
+
+MINIMAL_CONFIG = """
+[phabricator]
+host = http://127.0.0.1:9091/api/
+token = api-nojs2ip33hmp4zn6u6cf72w7d6yh
+"""
+
+DEFAULT_BUDGET = 3.0
+
+
+def time_startup(repeat):
+    """Get the time of each startup in seconds"""
+
+    times = []
+
+    for _ in range(repeat):
+        report = io.StringIO()
+
+        started = time.perf_counter()
+        if profile_startup(stream=report) != 0:
+            sys.stderr.write(report.getvalue())
+            raise RuntimeError('lugito failed to start')
+        times.append(time.perf_counter() - started)
+
+    # The report of the last run
+    sys.stdout.write(report.getvalue())
+    return times
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--budget', type=float, default=DEFAULT_BUDGET)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--cwd', default=None)
+    args = parser.parse_args(args)
+
+    with tempfile.TemporaryDirectory() as directory:
+        if args.cwd is None:
+            with open(os.path.join(directory, '.lugitorc'), 'w') as config:
+                config.write(MINIMAL_CONFIG)
+
+        os.environ['PYTHONPATH'] = os.pathsep.join(
+            [os.getcwd()] + os.environ.get('PYTHONPATH', '').split(
+                os.pathsep)).rstrip(os.pathsep)
+        os.chdir(args.cwd or directory)
+
+        times = time_startup(args.repeat)
+
+    median = statistics.median(times)
+    print('\nMedian startup of %d runs: %.1f ms, budget %.1f ms' % (
+        len(times), median * 1e3, args.budget * 1e3))
+
+    if median > args.budget:
+        print('Startup exceeds the budget')
+        return 1
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
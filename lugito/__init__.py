@@ -1,8 +1,10 @@
 from lugito.lugito import (
     Lugito,
+    LugitoEvent,
 )
 
 import lugito.config
+import lugito.conduit
 
 from ._version import get_versions
 __version__ = get_versions()['version']
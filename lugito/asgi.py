@@ -0,0 +1,193 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+# S.D.G
+
+"""
+:mod:`lugito.asgi`
+======================================
+
+ASGI application serving the lugito webhooks from an asyncio event loop.
+Conduit, Launchpad and Jenkins calls run on a thread pool so they never
+block the loop.  The Flask application in :mod:`lugito.webhooks` is
+unchanged.
+
+.. currentmodule:: lugito.asgi
+"""
+
+# Imports
+import asyncio
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from lugito import webhooks
+from lugito.ingest import DEFAULT_WORKERS
+from lugito.lugito import PHAB_WEBHOOK_SIG
+
+logger = logging.getLogger('lugito.asgi')
+
+# Add log level
+ch = logging.StreamHandler()
+
+formatter = logging.Formatter(
+    '%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+ch.setFormatter(formatter)
+
+logger.addHandler(ch)
+logger.setLevel(webhooks.GLOBAL_LOG_LEVEL)
+
+# Pool running the blocking calls of the handlers
+executor = None
+
+
+def _run_blocking(func, *args):
+    """Run a blocking call on the handler pool"""
+
+    loop = asyncio.get_running_loop()
+    return loop.run_in_executor(executor, func, *args)
+
+
+async def handle_hook(hmac_key, process, body, headers):
+    """Validate a Phabricator request and process its event"""
+
+    if not webhooks.lugito.verify_request(hmac_key, body,
+            headers.get(PHAB_WEBHOOK_SIG.lower())):
+        return
+
+    if webhooks.ingest_queue is not None:
+        await _run_blocking(webhooks.queue_delivery, hmac_key, body)
+        return
+
+    event = await _run_blocking(webhooks.lugito.load_event, body, hmac_key)
+
+    if event:
+        await _run_blocking(webhooks.process_delivery, hmac_key, process,
+            event)
+
+
+async def commithook(body, headers):
+    """Commit hook"""
+
+    await handle_hook('commithook', webhooks.process_commithook, body,
+        headers)
+
+
+async def irc(body, headers):
+    """Main route"""
+
+    await handle_hook('irc', webhooks.process_irc, body, headers)
+
+
+async def jenkinstrigger(body, headers):
+    """Jenkins trigger"""
+
+    await handle_hook('jenkins', webhooks.process_jenkins, body, headers)
+
+
+async def jenkinsircnotify(body, headers):
+    """Jenkins IRC notifications"""
+
+    if webhooks.ingest_queue is not None:
+        await _run_blocking(webhooks.ingest_queue.put, 'jenkinsnag', body)
+        return
+
+    webhooks.notify_jenkins_status(body)
+
+
+ROUTES = {
+    '/commithook': commithook,
+    '/irc': irc,
+    '/jenkins': jenkinstrigger,
+    '/jenkinsnag': jenkinsircnotify,
+}
+
+
+async def _read_body(receive):
+
+    body = b''
+    more_body = True
+
+    while more_body:
+        message = await receive()
+        body += message.get('body', b'')
+        more_body = message.get('more_body', False)
+
+    return body
+
+
+async def _respond(send, status, text):
+
+    await send({
+        'type': 'http.response.start',
+        'status': status,
+        'headers': [(b'content-type', b'text/plain; charset=utf-8')],
+    })
+    await send({
+        'type': 'http.response.body',
+        'body': text.encode('utf-8'),
+    })
+
+
+async def _lifespan(receive, send):
+
+    global executor
+
+    while True:
+        message = await receive()
+
+        if message['type'] == 'lifespan.startup':
+            settings = webhooks.config.CONFIG.get('lugito', {})
+            executor = ThreadPoolExecutor(
+                max_workers=int(settings.get('workers', DEFAULT_WORKERS)))
+            await send({'type': 'lifespan.startup.complete'})
+
+        elif message['type'] == 'lifespan.shutdown':
+            if executor is not None:
+                executor.shutdown(wait=False)
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+
+async def app(scope, receive, send):
+    """ASGI entry point"""
+
+    if scope['type'] == 'lifespan':
+        await _lifespan(receive, send)
+        return
+
+    if scope['type'] != 'http':
+        return
+
+    handler = ROUTES.get(scope['path'])
+
+    if handler is None:
+        await _respond(send, 404, 'Not Found')
+        return
+
+    if scope['method'] != 'POST':
+        await _respond(send, 405, 'Method Not Allowed')
+        return
+
+    body = await _read_body(receive)
+    headers = {key.decode('latin-1').lower(): value.decode('latin-1')
+        for key, value in scope['headers']}
+
+    try:
+        await handler(body, headers)
+    except Exception:
+        logger.exception('%s failed' % scope['path'])
+        await _respond(send, 500, 'Internal Server Error')
+        return
+
+    await _respond(send, 200, 'Ok')
+
+
+def run_asgi(host='0.0.0.0', port=5000):
+    """Serve the ASGI application with uvicorn"""
+
+    try:
+        import uvicorn
+    except ImportError:
+        raise ImportError('The asgi server requires uvicorn, install it with'
+            ' pip install lugito[asgi]')
+
+    webhooks.start_services()
+    uvicorn.run(app, host=host, port=port, lifespan='on')
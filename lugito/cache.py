@@ -0,0 +1,432 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+# S.D.G
+
+"""
+:mod:`lugito.cache`
+======================================
+
+In-process caches for Conduit lookups and seen webhook deliveries
+
+.. currentmodule:: lugito.cache
+"""
+
+# Imports
+import time
+import sqlite3
+import threading
+from collections import OrderedDict
+
+_MISSING = object()
+
+
+class TTLCache(object):
+    """
+    Thread safe cache with a bounded number of entries evicted in least
+    recently used order, and entries expiring after a time to live
+
+    Parameters
+    ----------
+
+    maxsize: int
+       The maximum number of entries kept
+
+    ttl: float
+       The default time to live of an entry in seconds
+
+    timer: callable
+       The clock used to expire entries
+
+    """
+
+    def __init__(self, maxsize=1024, ttl=300, timer=time.monotonic):
+
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.timer = timer
+
+        self.hits = 0
+        self.misses = 0
+
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+
+    def __len__(self):
+        return len(self._entries)
+
+
+    def __contains__(self, key):
+        return self.get(key, _MISSING, count=False) is not _MISSING
+
+
+    def get(self, key, default=None, count=True):
+        """
+        Get an entry
+
+        Parameters
+        ----------
+
+        key: hashable
+           The key of the entry
+
+        default: object
+           Returned if the entry is missing or expired
+
+        count: boolean
+           Update the hit and miss counters
+
+        Returns
+        -------
+
+        value: object
+           The cached value or default
+
+        """
+
+        with self._lock:
+            entry = self._entries.get(key)
+
+            if entry is not None and entry[0] <= self.timer():
+                del self._entries[key]
+                entry = None
+
+            if entry is None:
+                if count:
+                    self.misses += 1
+                return default
+
+            self._entries.move_to_end(key)
+            if count:
+                self.hits += 1
+            return entry[1]
+
+
+    def set(self, key, value, ttl=None):
+        """
+        Add or replace an entry
+
+        Parameters
+        ----------
+
+        key: hashable
+           The key of the entry
+
+        value: object
+           The value to cache
+
+        ttl: float or None
+           The time to live of the entry, the cache default if None
+
+        """
+
+        if ttl is None:
+            ttl = self.ttl
+
+        with self._lock:
+            self._entries[key] = (self.timer() + ttl, value)
+            self._entries.move_to_end(key)
+
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+
+    def invalidate(self, key):
+        """Remove an entry if present"""
+
+        with self._lock:
+            self._entries.pop(key, None)
+
+
+    def clear(self):
+        """Remove all entries"""
+
+        with self._lock:
+            self._entries.clear()
+
+
+    def stats(self):
+        """
+        Get the cache statistics
+
+        Returns
+        -------
+
+        stats: dictionary
+           The number of entries, hits and misses and the hit rate
+
+        """
+
+        total = self.hits + self.misses
+
+        return {
+            'size': len(self._entries),
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': (self.hits / total) if total else 0.0,
+        }
+
+
+class HandleCache(TTLCache):
+    """
+    Cache of PHID handles with a time to live depending on the PHID type,
+    e.g. USER in PHID-USER-5cmhaqtkggymhvbyqdcv
+
+    Parameters
+    ----------
+
+    maxsize: int
+       The maximum number of handles kept
+
+    ttl: float
+       The time to live of handles of types missing from ttls
+
+    ttls: dictionary
+       The time to live of each PHID type
+
+    """
+
+    def __init__(self, maxsize=1024, ttl=300, ttls=None, **kwargs):
+
+        super(HandleCache, self).__init__(maxsize, ttl, **kwargs)
+        self.ttls = ttls or {}
+
+
+    def set(self, key, value, ttl=None):
+
+        if ttl is None:
+            ttl = self.ttls.get(get_phid_type(key), self.ttl)
+
+        super(HandleCache, self).set(key, value, ttl)
+
+
+def get_phid_type(phid):
+    """
+    Get the type of a PHID
+
+    >>> get_phid_type('PHID-USER-5cmhaqtkggymhvbyqdcv')
+    'USER'
+
+    """
+
+    parts = phid.split('-')
+
+    if len(parts) < 3:
+        return None
+
+    return parts[1]
+
+
+class SeenSet(object):
+    """
+    Thread safe set of recently seen keys.  Keys are forgotten once they are
+    older than the window or when more than maxsize keys are kept, and are
+    optionally stored in a SQLite database so they survive a restart.
+
+    Parameters
+    ----------
+
+    maxsize: int
+       The maximum number of keys kept
+
+    window: float
+       The number of seconds a key is remembered
+
+    path: str or None
+       The path of the SQLite database, None to keep the keys in memory only
+
+    timer: callable
+       The clock used to expire keys
+
+    """
+
+    def __init__(self, maxsize=4096, window=3600, path=None, timer=time.time):
+
+        self.maxsize = maxsize
+        self.window = window
+        self.timer = timer
+
+        self._keys = OrderedDict()
+        self._claimed = set()
+        self._lock = threading.Lock()
+        self._db = None
+
+        if path is not None:
+            self._db = sqlite3.connect(path, check_same_thread=False)
+
+            with self._db:
+                self._db.execute('CREATE TABLE IF NOT EXISTS seen ('
+                    'key TEXT PRIMARY KEY, seen REAL NOT NULL)')
+
+                # From now on rows are only deleted with their keys
+                self._db.execute('DELETE FROM seen WHERE seen <= ?',
+                    (self.timer() - self.window,))
+
+            rows = self._db.execute('SELECT key, seen FROM seen '
+                'ORDER BY seen')
+
+            for key, seen in rows:
+                self._keys[key] = seen
+
+            self._expire(self.timer())
+
+
+    def __len__(self):
+        return len(self._keys)
+
+
+    def __contains__(self, key):
+
+        with self._lock:
+            self._expire(self.timer())
+            return key in self._keys
+
+
+    def _expire(self, now):
+        """Forget the keys out of the window or over maxsize"""
+
+        expired = []
+
+        while self._keys:
+            key, seen = next(iter(self._keys.items()))
+
+            if (seen > now - self.window) and\
+                    (len(self._keys) <= self.maxsize):
+                break
+
+            self._keys.popitem(last=False)
+            expired.append(key)
+
+        # The table holds the same keys as the dictionary, so it is bounded
+        # by maxsize too
+        if expired and (self._db is not None):
+            with self._db:
+                self._db.executemany('DELETE FROM seen WHERE key = ?',
+                    [(key,) for key in expired])
+
+
+    def check_and_add(self, keys):
+        """
+        Check whether all keys were seen and remember them
+
+        Parameters
+        ----------
+
+        keys: list
+           The keys to check
+
+        Returns
+        -------
+
+        seen: boolean
+           True if every key was already seen within the window
+
+        """
+
+        if not keys:
+            return False
+
+        with self._lock:
+            now = self.timer()
+            self._expire(now)
+
+            if all(key in self._keys for key in keys):
+                return True
+
+            self._add(keys, now)
+            return False
+
+
+    def add(self, keys):
+        """
+        Remember keys
+
+        Parameters
+        ----------
+
+        keys: list
+           The keys to remember
+
+        """
+
+        if not keys:
+            return
+
+        with self._lock:
+            now = self.timer()
+            self._expire(now)
+            self._add(keys, now)
+
+
+    def claim(self, key):
+        """
+        Claim a key not seen yet, so that concurrent callers don't both
+        handle it.  The key is then either added once handled or released.
+
+        Parameters
+        ----------
+
+        key: str
+           The key to claim
+
+        Returns
+        -------
+
+        claimed: boolean
+           False if the key was seen or is claimed by another caller
+
+        """
+
+        with self._lock:
+            self._expire(self.timer())
+
+            if (key in self._keys) or (key in self._claimed):
+                return False
+
+            self._claimed.add(key)
+            return True
+
+
+    def release(self, key):
+        """Release a claimed key without remembering it"""
+
+        with self._lock:
+            self._claimed.discard(key)
+
+
+    def discard(self, keys):
+        """
+        Forget keys, e.g. those of a delivery that failed to be processed
+
+        Parameters
+        ----------
+
+        keys: list
+           The keys to forget
+
+        """
+
+        with self._lock:
+            for key in keys:
+                self._keys.pop(key, None)
+
+            if self._db is not None:
+                with self._db:
+                    self._db.executemany('DELETE FROM seen WHERE key = ?',
+                        [(key,) for key in keys])
+
+
+    def _add(self, keys, now):
+
+        for key in keys:
+            self._claimed.discard(key)
+            self._keys.pop(key, None)
+            self._keys[key] = now
+
+        if self._db is not None:
+            with self._db:
+                self._db.executemany('INSERT OR REPLACE INTO seen '
+                    '(key, seen) VALUES (?, ?)',
+                    [(key, now) for key in keys])
+
+        self._expire(now)
@@ -2,17 +2,38 @@
 # -*- coding: utf-8 -*-
 # S.D.G
 
-"""Doc string for module
-
-
+"""
+:mod:`lugito.cli`
+======================================
 
-:author: Ben Johnston
+The lugito command.  The webhooks are only imported once the arguments
+are parsed, so that their import can be profiled.
 
+.. currentmodule:: lugito.cli
 """
 
 # Imports
+import sys
+import argparse
 
 
-if __name__ == "__main__":
+def main(args=None):
+    parser = argparse.ArgumentParser(prog='lugito', add_help=False)
+    parser.add_argument('--profile-startup', action='store_true',
+        help='report the time of each import and initialisation phase of'
+        ' the startup, then exit')
+    parser.add_argument('--startup-budget', type=float, default=None,
+        help='profile the startup and exit with an error if it takes longer'
+        ' than this many seconds, implies --profile-startup')
+    known, args = parser.parse_known_args(args)
+
+    if known.profile_startup or (known.startup_budget is not None):
+        from lugito.profiling import profile_startup
+        return profile_startup(budget=known.startup_budget)
+
     from lugito.webhooks import run
-    run()
+    return run(args, parents=[parser])
+
+
+if __name__ == "__main__":
+    sys.exit(main())
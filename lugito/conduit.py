@@ -0,0 +1,221 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+# S.D.G
+
+"""
+:mod:`lugito.conduit`
+======================================
+
+Process wide Phabricator Conduit client with pooled keep-alive connections
+
+.. currentmodule:: lugito.conduit
+"""
+
+# Imports
+import json
+import http
+import threading
+import requests
+import phabricator
+import lugito
+from requests.adapters import HTTPAdapter, Retry
+
+DEFAULT_POOL_SIZE = 10
+
+# Retries of a request failing to connect or read, as python-phabricator
+RETRIES = 3
+
+_CLIENTS = {}
+_CLIENTS_LOCK = threading.Lock()
+
+
+def is_valid_argument(value, target):
+    """
+    Check the type of a Conduit argument, as python-phabricator
+
+    >>> is_valid_argument(['PHID-USER-1'], [(str,)])
+    True
+    >>> is_valid_argument('PHID-USER-1', [(str,)])
+    False
+
+    Parameters
+    ----------
+
+    value: object
+       The argument
+
+    target: tuple or list
+       The accepted types, in a list if the argument is a list
+
+    Returns
+    -------
+
+    valid: boolean
+       True if the argument has one of the accepted types
+
+    """
+
+    if isinstance(target, list):
+        return isinstance(value, (list, tuple, set)) and\
+            all(is_valid_argument(item, target[0]) for item in value)
+
+    return isinstance(value, target)
+
+
+class PooledResource(phabricator.Resource):
+    """
+    Conduit resource sending its requests through the session of the client
+    it belongs to rather than opening a new connection per call.  The
+    arguments are checked and failed connections retried as
+    python-phabricator does.
+    """
+
+    def __init__(self, api, interface=None, endpoint=None, method=None,
+            nested=False):
+
+        # The interface definitions are parsed once by the client and shared
+        # with every resource
+        self.api = api
+        self._interface = interface
+        self.endpoint = endpoint
+        self.method = method
+        self.nested = nested
+
+
+    def __getattr__(self, attr):
+
+        # Conduit methods never start with an underscore
+        if attr.startswith('_'):
+            raise AttributeError(attr)
+
+        interface = self._interface
+        if self.nested:
+            attr = "%s.%s" % (self.endpoint, attr)
+
+        submethod_match = attr + '.'
+        submethod_exists = any(key.startswith(submethod_match)
+            for key in interface.keys())
+
+        if attr not in interface and submethod_exists:
+            return PooledResource(self.api, interface, attr, self.endpoint,
+                nested=True)
+        elif attr not in interface:
+            interface[attr] = {}
+
+        if self.nested:
+            return PooledResource(self.api, interface[attr], attr,
+                self.method)
+        return PooledResource(self.api, interface[attr], attr, self.endpoint)
+
+
+    def _request(self, **kwargs):
+
+        names = [x.split(':')[0] for x in kwargs.keys()]
+
+        for key, target in self._interface.get('required', {}).items():
+            if key not in names:
+                raise ValueError('Missing required argument: %s' % key)
+
+            if isinstance(kwargs.get(key), list) and\
+                    not isinstance(target, list):
+                raise ValueError('Wrong argument type: %s is not a list' % key)
+
+            if not is_valid_argument(kwargs.get(key), target):
+                raise ValueError('Wrong argument type: %s' % key)
+
+        if not self.api._conduit:
+            self.api.connect()
+        kwargs['__conduit__'] = self.api._conduit
+
+        headers = {
+            'User-Agent': 'python-phabricator/%s' % str(
+                self.api.clientVersion),
+            'Content-Type': 'application/x-www-form-urlencoded',
+        }
+
+        body = {
+            "params": json.dumps(kwargs),
+            "output": self.api.response_format,
+        }
+
+        path = '%s%s.%s' % (self.api.host, self.method, self.endpoint)
+        response = self.api.session.post(path, data=body, headers=headers,
+            timeout=self.api.timeout)
+
+        # Make sure we got a 2xx response indicating success
+        if not 200 <= response.status_code < 300:
+            raise http.client.HTTPException(
+                'Bad response status: {0}'.format(response.status_code))
+
+        data = self._parse_response(response.text)
+
+        return phabricator.Result(data['result'])
+
+
+class ConduitClient(PooledResource, phabricator.Phabricator):
+    """
+    Phabricator client sharing one keep-alive connection pool between all of
+    its resources
+
+    Parameters
+    ----------
+
+    host: str
+       The Conduit API url
+
+    token: str
+       The Conduit API token
+
+    pool_size: int
+       The maximum number of connections kept alive to the host
+
+    """
+
+    def __init__(self, host, token, pool_size=DEFAULT_POOL_SIZE, **kwargs):
+
+        phabricator.Phabricator.__init__(self, host=host, token=token,
+            **kwargs)
+
+        # Older releases of phabricator keep the parsed definitions in
+        # interface rather than _interface
+        self._interface = self.__dict__.get('_interface',
+            self.__dict__.get('interface'))
+        self.token = token
+
+        self.pool_size = pool_size
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size,
+            max_retries=Retry(total=RETRIES, connect=RETRIES,
+                allowed_methods=['HEAD', 'GET', 'POST', 'PATCH', 'PUT',
+                    'OPTIONS']))
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+    _request = phabricator.Phabricator._request
+
+
+def get_client():
+    """
+    Get the Conduit client for the configured Phabricator host.  The client is
+    created on first use and shared by Lugito and all connectors.
+
+    Returns
+    -------
+
+    client: ConduitClient
+       The shared Conduit client
+
+    """
+
+    host = lugito.config.CONFIG['phabricator']['host']
+    token = lugito.config.CONFIG['phabricator']['token']
+    pool_size = int(lugito.config.CONFIG['phabricator'].get(
+        'pool_size', DEFAULT_POOL_SIZE))
+
+    key = (host, token, pool_size)
+
+    with _CLIENTS_LOCK:
+        if key not in _CLIENTS:
+            _CLIENTS[key] = ConduitClient(host, token, pool_size)
+
+        return _CLIENTS[key]
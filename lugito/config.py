@@ -71,8 +71,17 @@ def update_config(config_file=DEFAULT_CONFIG_FILE):
     CONFIG['phabricator']['host'] = config['phabricator']['host']
     CONFIG['phabricator']['token'] = config['phabricator']['token']
 
+    if 'pool_size' in config['phabricator']:
+        CONFIG['phabricator']['pool_size'] = int(
+            config['phabricator']['pool_size'])
+
+    if 'handle_cache_size' in config['phabricator']:
+        CONFIG['phabricator']['handle_cache_size'] = int(
+            config['phabricator']['handle_cache_size'])
+
     CONFIG['phabricator']['hooks'] = {}
     CONFIG['phabricator']['package_names'] = {}
+    CONFIG['phabricator']['handle_ttl'] = {}
 
     # Iterate through hooks for HMAC keys
     if 'phabricator.hooks' in config:
@@ -83,6 +92,17 @@ def update_config(config_file=DEFAULT_CONFIG_FILE):
         for key, value in config['phabricator.package_names'].items():
             CONFIG['phabricator']['package_names'][key] = value
 
+    # Time to live of cached handles per PHID type e.g. USER
+    if 'phabricator.handle_ttl' in config:
+        for key, value in config['phabricator.handle_ttl'].items():
+            CONFIG['phabricator']['handle_ttl'][key.upper()] = float(value)
+
+    # General settings
+    CONFIG['lugito'] = {}
+    if 'lugito' in config:
+        for key, value in config['lugito'].items():
+            CONFIG['lugito'][key] = value
+
     CONFIG['connectors'] = {}
 
     # Iterate through available connectors
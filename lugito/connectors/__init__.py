@@ -2,14 +2,181 @@
 # -*- coding: utf-8 -*-
 # S.D.G
 
-from lugito.connectors.irc import (
-    irc,
-)
+"""
+:mod:`lugito.connectors`
+======================================
 
-from lugito.connectors.launchpad import (
-    launchpad,
-)
+Registry of the connectors configured by the connector.* sections.  A
+connector module is only imported, and its class only instantiated, when
+the connector is first used.  The irc, launchpad and jenkins classes are
+still available from this package, they are imported on first access.
 
-from lugito.connectors.jenkins import (
-    jenkins,
-)
+.. currentmodule:: lugito.connectors
+"""
+
+# Imports
+import logging
+import importlib
+import threading
+import lugito
+
+# The class of each connector, as module:class
+CONNECTORS = {
+    'irc': 'lugito.connectors.irc:irc',
+    'launchpad': 'lugito.connectors.launchpad:launchpad',
+    'jenkins': 'lugito.connectors.jenkins:jenkins',
+}
+
+# The connector classes available from the package
+__all__ = ['irc', 'launchpad', 'jenkins']
+
+
+def register(name, path):
+    """
+    Register a connector class
+
+    Parameters
+    ----------
+
+    name: str
+       The name of the connector, e.g. irc for the connector.irc section
+
+    path: str
+       The module and class name of the connector, e.g.
+       lugito.connectors.irc:irc
+
+    """
+
+    CONNECTORS[name] = path
+
+
+def get_connector_class(name):
+    """
+    Import the class of a connector.  The class key of the connector
+    section takes precedence over the registered class.
+
+    Parameters
+    ----------
+
+    name: str
+       The name of the connector
+
+    Returns
+    -------
+
+    cls: type
+       The connector class
+
+    """
+
+    settings = lugito.config.CONFIG.get('connectors', {}).get(name, {})
+    path = settings.get('class', CONNECTORS.get(name))
+
+    if path is None:
+        raise KeyError('no connector class for %s' % name)
+
+    module_name, class_name = path.split(':')
+    module = importlib.import_module(module_name)
+    cls = getattr(module, class_name)
+
+    # Importing a connector module binds it to the package under the name
+    # of the class it exports
+    if globals().get(name) is module:
+        globals()[name] = cls
+
+    return cls
+
+
+class ConnectorRegistry(object):
+    """
+    The connectors of the connector.* config sections, built on first use
+
+    Parameters
+    ----------
+
+    log_level: int
+       The logging level of the connectors
+
+    kwargs: dictionary or None
+       The extra keyword arguments of each connector class by name, e.g.
+       the shared Scheduler of the jenkins connector
+
+    """
+
+    def __init__(self, log_level=logging.DEBUG, kwargs=None):
+
+        self.log_level = log_level
+        self.kwargs = kwargs or {}
+
+        self._connectors = {}
+        self._lock = threading.Lock()
+
+
+    def __contains__(self, name):
+        """Whether a connector is configured"""
+
+        return name in self.configured()
+
+
+    def configured(self):
+        """
+        Get the names of the configured connectors
+
+        Returns
+        -------
+
+        names: list
+           The names of the connector sections with a connector class
+
+        """
+
+        settings = lugito.config.CONFIG.get('connectors', {})
+
+        return [name for name in settings
+            if (name in CONNECTORS) or ('class' in settings[name])]
+
+
+    def get(self, name):
+        """
+        Get a connector, importing and building it if it is not yet
+
+        Parameters
+        ----------
+
+        name: str
+           The name of the connector
+
+        Returns
+        -------
+
+        connector: object
+           The connector instance
+
+        """
+
+        with self._lock:
+            if name not in self._connectors:
+
+                if name not in self:
+                    raise KeyError('connector %s is not configured' % name)
+
+                cls = get_connector_class(name)
+                self._connectors[name] = cls(log_level=self.log_level,
+                    **self.kwargs.get(name, {}))
+
+            return self._connectors[name]
+
+
+    def loaded(self, name):
+        """Get a connector if it was already built, None otherwise"""
+
+        return self._connectors.get(name)
+
+
+def __getattr__(name):
+    """Import a connector class on first access"""
+
+    if name in __all__:
+        return get_connector_class(name)
+
+    raise AttributeError('module %s has no attribute %s' % (__name__, name))
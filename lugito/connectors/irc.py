@@ -14,15 +14,305 @@ Define an irc connector class
 # Imports
 import ssl
 import http
-import socket
+import time
+import random
+import asyncio
 import logging
 import threading
-import phabricator
 import lugito
-from time import sleep
+from collections import namedtuple, deque
+from lugito.cache import TTLCache
+from lugito.references import Reference, extract_references,\
+    parse_reference
+
+# Flood control defaults, BURST messages at once then RATE messages a second
+BURST = 4
+RATE = 1.0
+
+# Seconds a task or diff summary is cached
+INFO_TTL = 60
+INFO_CACHE_SIZE = 256
+
+# Seconds the messages of an author are held to be merged, 0 to disable,
+# and the maximum delay of a held message
+COALESCE_WINDOW = 0
+COALESCE_MAX_DELAY = 30
+
+# Objects named in a digest
+DIGEST_NAMES = 10
+
+# Seconds of silence before the server is pinged
+PING_INTERVAL = 120
+
+# Reconnection backoff
+BACKOFF_BASE = 1.0
+BACKOFF_MAX = 300.0
+
+
+def get_backoff(attempt):
+    """
+    Get the delay before a reconnection attempt, doubling with each attempt
+    up to BACKOFF_MAX with a random jitter of up to half the delay
+    """
+
+    delay = min(BACKOFF_MAX, BACKOFF_BASE * (2 ** attempt))
+    return delay / 2 + random.uniform(0, delay / 2)
+
+
+class TokenBucket(object):
+    """
+    Token bucket rate limiter
+
+    Parameters
+    ----------
+
+    rate: float
+       The number of tokens added per second
+
+    burst: int
+       The maximum number of tokens held
+
+    timer: callable
+       The clock used to add tokens
+
+    """
+
+    def __init__(self, rate=RATE, burst=BURST, timer=time.monotonic):
+
+        self.rate = rate
+        self.burst = burst
+        self.timer = timer
+
+        self.tokens = float(burst)
+        self.updated = timer()
+        self._lock = threading.Lock()
+
+
+    def consume(self):
+        """
+        Take a token
+
+        Returns
+        -------
+
+        wait: float
+           Zero if a token was available, else the number of seconds until
+           the token that was reserved becomes available
+
+        """
+
+        with self._lock:
+            now = self.timer()
+            self.tokens = min(self.burst,
+                self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+
+            self.tokens -= 1
+
+            if self.tokens >= 0:
+                return 0.0
+
+            return -self.tokens / self.rate
+
+
+IRCMessage = namedtuple('IRCMessage', ['prefix', 'command', 'params'])
+
+
+def parse_message(line):
+    """
+    Parse an IRC protocol line
+
+    >>> parse_message(':nick!user@host PRIVMSG #chan :hello there')
+    IRCMessage(prefix='nick!user@host', command='PRIVMSG', params=['#chan', 'hello there'])
+
+    Parameters
+    ----------
+
+    line: str
+       The line without its line ending
+
+    Returns
+    -------
+
+    message: IRCMessage
+       The prefix (None if absent), upper case command and parameters of the
+       line, the trailing parameter last
+
+    """
+
+    prefix = None
+    if line.startswith(':'):
+        prefix, _, line = line[1:].partition(' ')
+
+    trailing = None
+    if line.startswith(':'):
+        trailing = line[1:]
+        line = ''
+    elif ' :' in line:
+        line, _, trailing = line.partition(' :')
+
+    params = line.split()
+    command = params.pop(0).upper() if params else ''
+
+    if trailing is not None:
+        params.append(trailing)
+
+    return IRCMessage(prefix, command, params)
+
+
+class LineBuffer(object):
+    """
+    Split the data received from an IRC server into lines, keeping the
+    partial last line until the rest of it is received
+    """
+
+    def __init__(self):
+        self._buffer = bytearray()
+
+    def feed(self, data):
+        """
+        Add received data
+
+        Parameters
+        ----------
+
+        data: bytes
+           The received data
+
+        Returns
+        -------
+
+        lines: list
+           The decoded lines completed by the data, without line endings
+
+        """
+
+        self._buffer.extend(data)
+
+        lines = []
+        start = 0
+
+        while True:
+            end = self._buffer.find(b'\n', start)
+            if end < 0:
+                break
+
+            line = bytes(self._buffer[start:end]).rstrip(b'\r')
+            if line:
+                lines.append(line.decode('utf-8', 'replace'))
+            start = end + 1
+
+        del self._buffer[:start]
+        return lines
+
+    def clear(self):
+        """Drop any partial line"""
+
+        del self._buffer[:]
+
+
+def format_summary(taskinfo):
+    """
+    Format the status, title and link of a task or diff
+
+    Parameters
+    ----------
+
+    taskinfo: dictionary
+       The priorityColor, statusName, title and uri of the object
+
+    Returns
+    -------
+
+    summary: str
+       The IRC formatted summary without the closing color code
+
+    """
+
+    summary = "\x033[\x03"
+
+    # The color of the priority text should correspond to its value.
+    color = taskinfo["priorityColor"]
+    if color == "violet":
+        summary += "\x036Needs Triage"
+    elif color == "pink":
+        summary += "\x035Unbreak Now!"
+    elif color == "red":
+        summary += "\x034High"
+    elif color == "orange":
+        summary += "\x037Medium"
+    elif color == "yellow":
+        summary += "\x038Low"
+    elif color == "sky":
+        summary += "\x037Wishlist"
+
+    # Put the task status in the message.
+    if color is not None:
+        summary += ", "
+
+    summary += taskinfo["statusName"] + "\x03\x033]\x03 "
+
+    # Put the title in there as well.
+    summary += taskinfo["title"].strip() + ": "
+
+    # And the link.
+    summary += "\x032" + taskinfo["uri"]
+
+    return summary
+
+
+def format_digest(who, body, objects):
+    """
+    Format the digest of the events of an author
+
+    Parameters
+    ----------
+
+    who: str
+       The author of the events
+
+    body: str
+       The kind of event e.g. commented on the task
+
+    objects: list
+       The full name of the object of each event
+
+    Returns
+    -------
+
+    message: str
+       The IRC formatted digest
+
+    """
+
+    # Only the names e.g. T31 of T31: Better IRC integration
+    names = []
+    for objectstr in objects:
+        name = objectstr.split(":")[0]
+
+        if name not in names:
+            names.append(name)
+
+    message = "\x033[\x03\x0313{} updates\x03\x033]\x03 ".format(
+        len(objects))
+    message += "\x0315" + who + "\x03 "
+    message += body + ": "
+    message += ", ".join(names[:DIGEST_NAMES])
+
+    if len(names) > DIGEST_NAMES:
+        message += " and {} more".format(len(names) - DIGEST_NAMES)
+
+    return message
 
 
 class irc(object):
+    """
+    IRC client running on an asyncio event loop in a background thread.
+    The reader answers PINGs and handles commands while the writer sends the
+    queued notices at the pace of the token bucket.  Lost connections are
+    reopened with exponential backoff, and notices queued in the meantime
+    are sent once the channel is joined again.
+    """
 
     def __init__(self, log_level=logging.DEBUG, sleep_delay=5):
 
@@ -35,84 +325,329 @@ class irc(object):
         self.channel = lugito.config.CONFIG['connectors']['irc']['channel']
 
         # Phabricator info
-        self.phab = phabricator.Phabricator(
-            host=lugito.config.CONFIG['phabricator']['host'],
-            token=lugito.config.CONFIG['phabricator']['token'],)
+        self.phab = lugito.conduit.get_client()
         self.phab_host = self.phab.host.replace('api/', '')
 
         self.logger = logging.getLogger('lugito.connector.IRCConnector')
 
-        # Add log level
-        ch = logging.StreamHandler()
+        # Add log level, the handler once per logger
+        if not self.logger.handlers:
+            ch = logging.StreamHandler()
 
-        formatter = logging.Formatter(
-            '%(asctime)s - %(name)s - %(levelname)s - %(message)s')
-        ch.setFormatter(formatter)
+            formatter = logging.Formatter(
+                '%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+            ch.setFormatter(formatter)
+
+            self.logger.addHandler(ch)
 
-        self.logger.addHandler(ch)
         self.logger.setLevel(log_level)
 
         self.sleep_delay = sleep_delay
 
+        # Outgoing messages, kept until written to a connection
+        self.bucket = TokenBucket(
+            rate=float(lugito.config.CONFIG['connectors']['irc'].get(
+                'rate', RATE)),
+            burst=int(lugito.config.CONFIG['connectors']['irc'].get(
+                'burst', BURST)),
+        )
+        self.outbound = deque()
+        self.sent = 0
+
+        # Summaries of the tasks and diffs mentioned in the channel
+        self.info_cache = TTLCache(
+            maxsize=int(lugito.config.CONFIG['connectors']['irc'].get(
+                'info_cache_size', INFO_CACHE_SIZE)),
+            ttl=float(lugito.config.CONFIG['connectors']['irc'].get(
+                'info_ttl', INFO_TTL)),
+        )
+
+        # Messages held to be merged into digests
+        self.coalesce_window = float(
+            lugito.config.CONFIG['connectors']['irc'].get(
+                'coalesce_window', COALESCE_WINDOW))
+        self.coalesce_max_delay = float(
+            lugito.config.CONFIG['connectors']['irc'].get(
+                'coalesce_max_delay', COALESCE_MAX_DELAY))
+        self._coalescing = {}
+        self._coalesce_lock = threading.Lock()
+
+        self.lines = LineBuffer()
+        self.connected = False
+        self._usersuffix = 0
+
+        self.loop = None
+        self._thread = None
+        self._stream = None
+        self._outbound_ready = None
+        self._writer_task = None
+        self._attempt = 0
+        self._joined = threading.Event()
+
+        # Handlers of the messages received while connecting
+        self._setup_handlers = {
+            'NOTICE': self._on_setup_notice,
+            'PING': self._on_ping,
+            '433': self._on_nick_in_use,
+            '477': self._on_join_refused,
+            '366': self._on_joined,
+        }
+
+        # Handlers of the messages received once in the channel
+        self._handlers = {
+            'PING': self._on_ping,
+            'PRIVMSG': self._on_privmsg,
+        }
+
 
     def _send_raw(self, message): # pragma: no cover
-        """Low level send"""
+        """Low level send, called from the event loop"""
+
+        self._stream.write(message.encode('utf-8'))
 
-        self.conn.send(message.encode('utf-8'))
 
+    async def _open_connection(self): # pragma: no cover
+        """Open the TLS connection to the server"""
 
-    def _setup_connection(self):
-        """Setup connection"""
-        self.conn = ssl.wrap_socket(
-            socket.socket(socket.AF_INET, socket.SOCK_STREAM))
-        self.conn.connect((self.host, self.port))
+        return await asyncio.open_connection(self.host, self.port,
+            ssl=ssl.create_default_context())
 
 
-    def connect(self):
-        """Connect"""
+    def _dispatch(self, line, handlers):
+        """Parse a line and call the handler of its command"""
 
-        self.logger.info("Connecting to IRC.")
-        self._setup_connection()
+        self.logger.debug(line)
 
-        setup = False
-        usersuffix = 0
+        message = parse_message(line)
+        handler = handlers.get(message.command)
 
-        while not setup:
-            response = self.conn.recv(512).decode("utf-8")
-            self.logger.debug(response)
+        if handler is not None:
+            handler(message)
 
-            if "No Ident response" in response:
-                self._send_raw("NICK {}\r\n".format(self.username))
-                self._send_raw("USER {} * * :{}\r\n".format(
-                    self.username, self.username))
-                self._send_raw("PRIVMSG nickserv :identify {} {}\r\n".format(
-                    self.username, self.password))
+    def _on_ping(self, message):
+        token = message.params[-1] if message.params else ''
+        self._send_raw("PONG :{}\r\n".format(token))
 
-            if "You are now identified" in response:
-                sleep(self.sleep_delay)
-                self._send_raw("JOIN {}\r\n".format(self.channel))
+    def _on_setup_notice(self, message):
+        text = message.params[-1] if message.params else ''
 
-            if "477" in response:
-                sleep(self.sleep_delay)
-                self._send_raw("JOIN {}\r\n".format(self.channel))
+        if "No Ident response" in text:
+            self._send_raw("NICK {}\r\n".format(self.username))
+            self._send_raw("USER {} * * :{}\r\n".format(
+                self.username, self.username))
+            self._send_raw("PRIVMSG nickserv :identify {} {}\r\n".format(
+                self.username, self.password))
 
-            if "433" in response:
-                usersuffix = usersuffix + 1
-                self.username = self.username + str(usersuffix)
-                self._send_raw("NICK {}\r\n".format(self.username))
-                self._send_raw("USER {} * * :{}\r\n".format(
-                    self.username, self.username))
+        elif "You are now identified" in text:
+            asyncio.ensure_future(self._join_later())
 
-            if "PING" in response:
-                self._send_raw("PONG :{}\r\n".format(response.split(":")[1]))
+    def _on_join_refused(self, message):
+        asyncio.ensure_future(self._join_later())
 
-            if "366" in response:
-                setup = True
+    async def _join_later(self):
+        await asyncio.sleep(self.sleep_delay)
+        self._send_raw("JOIN {}\r\n".format(self.channel))
 
+    def _on_nick_in_use(self, message):
+        self._usersuffix = self._usersuffix + 1
+        self.username = self.username + str(self._usersuffix)
+        self._send_raw("NICK {}\r\n".format(self.username))
+        self._send_raw("USER {} * * :{}\r\n".format(
+            self.username, self.username))
+
+    def _on_joined(self, message):
+        self.connected = True
+        self._joined.set()
+
+        # The connection works, start the backoff again if it is lost
+        self._attempt = 0
         self.logger.info("Successfully connected to the IRC server.")
 
-    def send_notice(self, message): # pragma: no cover
-        self._send_raw("NOTICE {} :{}\r\n".format(self.channel, message))
+        self._writer_task = asyncio.ensure_future(self._write())
+
+    def _on_privmsg(self, message):
+        if len(message.params) < 2:
+            return
+
+        text = message.params[-1]
+
+        # Answering needs Conduit calls, keep them off the event loop
+        if text.startswith(self.username + ": info"):
+            self._answer(text, "info")
+
+        elif self.phab_host in text:
+            self._answer(text, "link")
+
+
+    def _answer(self, text, kind):
+        """Answer a message on the default executor"""
+
+        future = asyncio.get_running_loop().run_in_executor(
+            None, self.bot, text, kind)
+        future.add_done_callback(self._answered)
+
+
+    def _answered(self, future):
+
+        if (not future.cancelled()) and (future.exception() is not None):
+            self.logger.error("Failed to answer a message",
+                exc_info=future.exception())
+
+
+    async def _read(self, reader):
+        """
+        Read lines until the connection is lost.  If the server is silent
+        for PING_INTERVAL seconds it is pinged, if it stays silent the
+        connection is considered lost.
+        """
+
+        pinged = False
+
+        while True:
+            try:
+                data = await asyncio.wait_for(reader.read(4096),
+                    PING_INTERVAL)
+            except asyncio.TimeoutError:
+                if pinged:
+                    raise ConnectionError("No reply to PING")
+
+                self._send_raw("PING :{}\r\n".format(self.host))
+                pinged = True
+                continue
+
+            if len(data) == 0:
+                return
+
+            pinged = False
+
+            for line in self.lines.feed(data):
+                handlers = self._handlers if self.connected else\
+                    self._setup_handlers
+
+                self._dispatch(line, handlers)
+
+
+    async def _write(self):
+        """Write the outgoing messages, waiting for the rate limit"""
+
+        while True:
+            if not self.outbound:
+                self._outbound_ready.clear()
+                await self._outbound_ready.wait()
+                continue
+
+            await asyncio.sleep(self.bucket.consume())
+
+            # A message is only dropped from the queue once written, so that
+            # it is sent again after a reconnect
+            message = self.outbound[0]
+            self._send_raw(message)
+            await self._stream.drain()
+
+            self.outbound.popleft()
+            self.sent += 1
+
+
+    async def _session(self, reader, writer):
+        """Register, join the channel and handle a connection until lost"""
+
+        self._stream = writer
+        self.lines.clear()
+        self.connected = False
+        self._usersuffix = 0
+
+        try:
+            await self._read(reader)
+        finally:
+            self.connected = False
+            self._joined.clear()
+
+            if self._writer_task is not None:
+                self._writer_task.cancel()
+                self._writer_task = None
+
+            writer.close()
+
+
+    async def _run(self):
+        """Keep a connection open, reconnecting with backoff"""
+
+        self._outbound_ready = asyncio.Event()
+        if self.outbound:
+            self._outbound_ready.set()
+
+        self._attempt = 0
+
+        while True:
+            self.logger.info("Connecting to IRC.")
+
+            try:
+                reader, writer = await self._open_connection()
+                await self._session(reader, writer)
+            except (OSError, ConnectionError) as err:
+                self.logger.warning("IRC connection failed: {}".format(err))
+            except Exception:
+                # e.g. a failing handler, the client must keep running
+                self.logger.exception("IRC session failed")
+
+            delay = get_backoff(self._attempt)
+            self._attempt += 1
+
+            self.logger.warning("Connection lost, reconnecting in {:.1f}s"\
+                .format(delay))
+            await asyncio.sleep(delay)
+
+
+    def connect(self, timeout=60):
+        """
+        Start the client thread and wait for the channel to be joined
+
+        Parameters
+        ----------
+
+        timeout: float
+           Seconds to wait for the channel to be joined, the client keeps
+           trying in the background afterwards
+
+        Returns
+        -------
+
+        joined: boolean
+           True if the channel was joined within the timeout
+
+        """
+
+        if self._thread is None:
+            self.loop = asyncio.new_event_loop()
+            self._thread = threading.Thread(
+                target=self.loop.run_until_complete, args=[self._run()])
+            self._thread.daemon = True
+            self._thread.start()
+
+        return self._joined.wait(timeout)
+
+    def _wake_writer(self):
+
+        if self._outbound_ready is not None:
+            self._outbound_ready.set()
+
+    def queue_depth(self):
+        """Number of outgoing messages waiting to be written"""
+
+        return len(self.outbound)
+
+    def send_notice(self, message):
+        """Queue a notice to the channel, safe to call from any thread"""
+
+        self.outbound.append("NOTICE {} :{}\r\n".format(
+            self.channel, message))
+
+        if self.loop is not None:
+            self.loop.call_soon_threadsafe(self._wake_writer)
+
+        depth = self.queue_depth()
+        if depth > self.bucket.burst:
+            self.logger.debug("{} messages waiting to be sent".format(depth))
 
     def send(self, *args, **kwargs):
         """Send a formatted message"""
@@ -139,124 +674,242 @@ class irc(object):
         message += "\x032" + link + "\x03"
         # Make sure we can debug this if it goes haywire
         self.logger.debug(message)
-        # Sleep for a fifth of a second, so when we have a bunch of messages we have a buffer
-        sleep(0.2)
-        # Aaaaand, send it off!
-        self.send_notice(message)
+
+        if (self.coalesce_window <= 0) or (self.loop is None):
+            # Aaaaand, send it off! The writer takes care of flood control
+            self.send_notice(message)
+            return
+
+        self.coalesce((who, body), objectstr, message)
+
+    def coalesce(self, key, objectstr, message):
+        """
+        Hold a message back for the coalescing window.  The messages with
+        the same key received within the window are sent as a single
+        digest, at most coalesce_max_delay seconds after the first one.
+
+        Parameters
+        ----------
+
+        key: tuple
+           The author and the kind of event
+
+        objectstr: str
+           The full name of the object e.g. T31: Better IRC integration
+
+        message: str
+           The message sent if no other message with the key is received
+
+        """
+
+        now = time.monotonic()
+
+        with self._coalesce_lock:
+            group = self._coalescing.get(key)
+            first = group is None
+
+            if first:
+                group = {'first': now, 'objects': [], 'messages': []}
+                self._coalescing[key] = group
+
+            group['last'] = now
+            group['objects'].append(objectstr)
+            group['messages'].append(message)
+
+        if first:
+            self.loop.call_soon_threadsafe(self._flush_later, key)
+
+    def _flush_later(self, key):
+        """Send the messages of a key once its window closed"""
+
+        with self._coalesce_lock:
+            group = self._coalescing[key]
+
+            deadline = min(group['last'] + self.coalesce_window,
+                group['first'] + self.coalesce_max_delay)
+            delay = deadline - time.monotonic()
+
+            if delay <= 0:
+                del self._coalescing[key]
+
+        if delay > 0:
+            self.loop.call_later(delay, self._flush_later, key)
+            return
+
+        if len(group['messages']) == 1:
+            self.send_notice(group['messages'][0])
+            return
+
+        who, body = key
+        self.send_notice(format_digest(who, body, group['objects']))
 
     def get_task_info(self, task):
+        """Send the summary of a task or diff"""
 
-        sendmessage = ""
+        self.get_tasks_info([task])
 
-        # Strip out anchor link
-        # This will prevent invalid task / diff references
-        anchor = None
-        if '#' in task:
-            task, anchor = task.split('#')
 
-        try:
-            # We only need the task number.
-            if len(task.split("T")) > 1:
-                taskinfo = self.phab.maniphest.info(
-                    task_id=int(task.split("T")[1]))
-
-            # or the diff number
-            elif len(task.split("D")) > 1:
-                taskinfo = self.phab.differential.query(
-                    ids=[int(task.split("D")[1])])[0]
-                taskinfo['priorityColor'] = None
-
-            sendmessage += "\x033[\x03"
-
-            # The color of the priority text should correspond to its value.
-            color = taskinfo["priorityColor"]
-            if color == "violet":
-                sendmessage += "\x036Needs Triage"
-            elif color == "pink":
-                sendmessage += "\x035Unbreak Now!"
-            elif color == "red":
-                sendmessage += "\x034High"
-            elif color == "orange":
-                sendmessage += "\x037Medium"
-            elif color == "yellow":
-                sendmessage += "\x038Low"
-            elif color == "sky":
-                sendmessage += "\x037Wishlist"
-
-            # Put the task status in the message.
-            if color is not None:
-                sendmessage += ", "
-
-            sendmessage += taskinfo["statusName"] + "\x03\x033]\x03 "
-
-            # Put the title in there as well.
-            sendmessage += taskinfo["title"].strip() + ": "
-
-            # And the link.
-            sendmessage += "\x032" + taskinfo["uri"]
+    def get_tasks_info(self, tasks):
+        """
+        Send the summaries of tasks and diffs, in the order of the references.
+        The objects missing from the info cache are looked up with at most
+        one maniphest.search and one differential.revision.search
+
+        Parameters
+        ----------
+
+        tasks: list
+           The Reference, or the reference or link text, of each task and
+           diff e.g. T123, D45 or https://phab.lubuntu.me/T88#3230
+
+        """
+
+        references = []
+        for task in tasks:
+
+            if isinstance(task, Reference):
+                references.append((str(task), task))
+
+            else:
+                # If someone wrote something like "Tblah", obviously that's
+                # not right.
+                references.append((task.strip(), parse_reference(task)))
+
+        summaries = self.get_summaries([reference.name
+            for text, reference in references if reference is not None])
+
+        for text, reference in references:
+
+            if (reference is None) or (reference.name not in summaries):
+                self.send_notice("\x034Error: " + text +\
+                    " is an invalid task reference.\x03")
+                continue
+
+            sendmessage = summaries[reference.name]
 
             # Add the anchor back if it was present
-            if anchor is not None:
-                sendmessage += '#{}'.format(anchor)
+            if reference.anchor is not None:
+                sendmessage += '#{}'.format(reference.anchor)
 
             sendmessage += '\x03'
 
             # Send it off!
             self.send_notice(sendmessage)
 
-        # If someone wrote something like "Tblah", obviously that's not right.
-        except ValueError:
 
-            if anchor is not None:
-                link = '{}#{}'.format(task.strip(), anchor)
+    def get_summaries(self, names):
+        """
+        Get the formatted summaries of tasks and diffs, from the info cache
+        if they were looked up recently
+
+        Parameters
+        ----------
+
+        names: list
+           The object names e.g. T123 or D45
+
+        Returns
+        -------
+
+        summaries: dictionary
+           The status, title and link of each object found
+
+        """
+
+        summaries = {}
+        task_ids = []
+        diff_ids = []
+
+        for name in names:
+            if name in summaries:
+                continue
+
+            summary = self.info_cache.get(name)
+
+            if summary is not None:
+                summaries[name] = summary
+
+            elif name.startswith("T"):
+                task_ids.append(int(name[1:]))
+
             else:
-                link = task.strip()
+                diff_ids.append(int(name[1:]))
 
-            self.send_notice("\x034Error: " + link +\
-                " is an invalid task reference.\x03")
+        found = []
 
+        if task_ids:
+            tasks = self.phab.maniphest.search(
+                constraints={"ids": sorted(set(task_ids))})
 
-    def bot(self, message, msgtype):
+            for task in tasks["data"]:
+                found.append(("T{}".format(task["id"]), {
+                    "priorityColor": task["fields"]["priority"]["color"],
+                    "statusName": task["fields"]["status"]["name"],
+                    "title": task["fields"]["name"],
+                    "uri": self.phab_host + "T{}".format(task["id"]),
+                }))
 
-        if msgtype == "info":
-            message = message.split(" :" + self.username + ": info")[1]
+        if diff_ids:
+            diffs = self.phab.differential.revision.search(
+                constraints={"ids": sorted(set(diff_ids))})
 
-            for item in message.split():
-                if item.startswith("T") or item.startwith("D"):
-                    self.get_task_info(item.strip())
+            for diff in diffs["data"]:
+                found.append(("D{}".format(diff["id"]), {
+                    "priorityColor": None,
+                    "statusName": diff["fields"]["status"]["name"],
+                    "title": diff["fields"]["title"],
+                    "uri": self.phab_host + "D{}".format(diff["id"]),
+                }))
 
-        elif msgtype == "link":
+        for name, taskinfo in found:
+            summaries[name] = format_summary(taskinfo)
+            self.info_cache.set(name, summaries[name])
 
-            for item in message.split(self.phab_host):
-                if (item.split()[0].strip().startswith("T")) or \
-                    (item.split()[0].strip().startswith("D")):
+        return summaries
 
-                    self.get_task_info(item.split()[0].strip())
 
-        else:
-            self.sendnotice("\x034Error: unknown command.\x03")
-            return None
+    def invalidate_info(self, name):
+        """
+        Forget the cached summary of a task or diff
 
+        Parameters
+        ----------
 
-    def listen(self):
+        name: str
+           The object name e.g. T123 or D45
 
-        while True:
-            ircmsg = self.conn.recv(512)
+        """
+
+        self.info_cache.invalidate(name)
 
-            if len(ircmsg) == 0:
-                # logger.warn is deprecated, use .warning.
-                self.logger.warning("Connection lost, reconnecting!")
-                self.connect()
-                continue
 
-            ircmsg = ircmsg.decode("UTF-8").strip('\n\r')
-            self.logger.debug(ircmsg)
+    def info_stats(self):
+        """Get the statistics of the info cache"""
 
-            if ircmsg.find("PING :") != -1:
-                self.conn.send(bytes("PONG :pingis\n", "UTF-8"))
+        return self.info_cache.stats()
 
-            elif ircmsg.find(" :" + self.username + ": info") != -1:
-                self.bot(ircmsg, "info")
 
-            elif ircmsg.find("{}".format(self.phab_host)) != -1:
-                self.bot(ircmsg, "link")
+    def bot(self, message, msgtype):
+
+        if msgtype == "info":
+            message = message.split(self.username + ": info", 1)[1]
+            references = extract_references(message, self.phab_host)
+
+        elif msgtype == "link":
+            references = extract_references(message, self.phab_host,
+                bare=False)
+
+        else:
+            self.send_notice("\x034Error: unknown command.\x03")
+            return None
+
+        # Look all the references up at once
+        if references:
+            self.get_tasks_info(references)
+
+
+    def listen(self):
+        """Block while the client thread runs"""
+
+        if self._thread is not None:
+            self._thread.join()
@@ -13,18 +13,100 @@ Define a jenkins connector class
 # Imports
 import re
 import logging
-import phabricator
 import lugito
 import requests
+import requests.adapters
 import json
-import jenkinsapi.custom_exceptions
-from jenkinsapi.jenkins import Jenkins
+import threading
 from string import Template
+from urllib.parse import quote
+from collections import namedtuple
+from lugito.dispatcher import Dispatcher, Scheduler, BuildPending
+
+# Connections kept to the Jenkins server
+POOL_SIZE = 4
+
+# Seconds to wait for the Jenkins server
+TIMEOUT = 30
+
+# Seconds during which the commits of a package trigger a single build
+DEBOUNCE = 5
+
+# Number of most recent builds fetched and cached per job
+BUILDS = 3
+
+# Fields of the builds of a job API request
+BUILDS_TREE = "builds[number,result,url,building]{0,%d}" % BUILDS
+
+JenkinsBuild = namedtuple('JenkinsBuild', ['number', 'result', 'url',
+    'building'])
+
+
+def format_status(status, last_status):
+    """
+    Customize the status message of a build depending on the status of the
+    previous build
+
+    >>> format_status('FAILURE', 'SUCCESS')
+    '\\x034just failed after succeeding\\x03'
+    >>> format_status('SUCCESS', 'SUCCESS') is None
+    True
+
+    Parameters
+    ----------
+
+    status: str
+       The result of the build e.g. SUCCESS
+
+    last_status: str or None
+       The result of the previous build
+
+    Returns
+    -------
+
+    message: str or None
+       The colored message, None if the project has been consistently
+       stable
+
+    """
+
+    # If it has been consistently stable, don't cause extra noise
+    if status == "SUCCESS" and last_status == status:
+        return None
+
+    # Customize the message depending on the previous build status
+    if status == "SUCCESS":
+        if last_status == "FAILURE":
+            status = "just succeeded after failing"
+        elif last_status == "UNSTABLE":
+            status = "just became stable"
+        # Color it green
+        status = "\x033" + status + "\x03"
+    elif status == "FAILURE":
+        if last_status == "SUCCESS":
+            status = "just failed after succeeding"
+        elif last_status == "UNSTABLE":
+            status = "just failed after being unstable"
+        # Color it red
+        status = "\x034" + status + "\x03"
+    elif status == "UNSTABLE":
+        if last_status == "SUCCESS":
+            status = "just became unstable"
+        elif last_status == "FAILURE":
+            status = "just became unstable after failing"
+        # Color it yellow
+        status = "\x038" + status + "\x03"
+    elif status == "ABORTED":
+        # Color it gray
+        status = "\x0315" + status + "\x03"
+
+    return status
 
 
 class jenkins(object):
 
-    def __init__(self, log_level=logging.DEBUG):
+    def __init__(self, log_level=logging.DEBUG, scheduler=None,
+            dispatcher=None):
 
         # Launchpad info
         # Read the configuration out of the .lugitorc file
@@ -32,10 +114,7 @@ class jenkins(object):
             lugito.config.CONFIG['phabricator']['package_names']
 
         # Phabricator info
-        self.phab = phabricator.Phabricator(
-            host=lugito.config.CONFIG['phabricator']['host'],
-            token=lugito.config.CONFIG['phabricator']['token'],
-        )
+        self.phab = lugito.conduit.get_client()
 
         # Jenkins info
         self.jenkins_site = lugito.config.CONFIG['connectors']['jenkins']\
@@ -48,16 +127,41 @@ class jenkins(object):
 
         self.logger = logging.getLogger('lugito.connector.jenkins')
 
-        self.jenkins = self.auth_jenkins()
+        # A hung server must not hold a dispatcher thread forever
+        self.timeout = float(lugito.config.CONFIG['connectors']['jenkins']\
+            .get('timeout', TIMEOUT))
+
+        # Authenticated on first use
+        self._session = None
+        self._session_lock = threading.Lock()
+
+        # Commits of the packages received within the debounce window
+        # trigger a single build.  The scheduler only queues the
+        # notifyCommit, it is sent by the dispatcher.  Both are shared with
+        # the webhooks when given.
+        self.debounce = float(lugito.config.CONFIG['connectors']['jenkins']\
+            .get('debounce', DEBOUNCE))
+        self.scheduler = scheduler or Scheduler(log_level)
+        self.dispatcher = dispatcher or Dispatcher(log_level)
+        self.triggered = 0
+        self.collapsed = 0
+        self._triggers = set()
+        self._trigger_lock = threading.Lock()
+
+        # The completed builds of each job by number
+        self._builds = {}
+        self._builds_lock = threading.Lock()
+
+        # Add log level, the handler once per logger
+        if not self.logger.handlers:
+            ch = logging.StreamHandler()
+
+            formatter = logging.Formatter(
+                '%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+            ch.setFormatter(formatter)
+
+            self.logger.addHandler(ch)
 
-        # Add log level
-        ch = logging.StreamHandler()
-
-        formatter = logging.Formatter(
-            '%(asctime)s - %(name)s - %(levelname)s - %(message)s')
-        ch.setFormatter(formatter)
-
-        self.logger.addHandler(ch)
         self.logger.setLevel(log_level)
 
 
@@ -72,10 +176,13 @@ class jenkins(object):
 
 
     def send(self, *args, **kwargs):
-        """Send the commit message"""
+        """
+        Trigger the build of a package.  The commits of a package received
+        within the debounce window trigger a single notifyCommit.
+        """
 
         if len(args) == 1:
-            package_name = args
+            package_name = args[0]
         elif len(kwargs) == 1:
             package_name = kwargs['package_name']
 
@@ -83,86 +190,252 @@ class jenkins(object):
         # name always matches the package name
         package_name = self.get_package_name(package_name.lower())
 
-        if package_name:
-            package_url = self.jenkins_trigger_url.replace(
-                "PACKAGE", package_name)
-            r = requests.post("{}/git/notifyCommit?url={}".format(
-                self.jenkins_site, package_url), data="")
+        if not package_name:
+            return
+
+        if self.debounce <= 0:
+            self.notify_commit(package_name)
+            return
+
+        with self._trigger_lock:
+            if package_name in self._triggers:
+                self.collapsed += 1
+                self.logger.debug("notifyCommit of {} already queued".format(
+                    package_name))
+                return
+
+            self._triggers.add(package_name)
+
+        self.scheduler.call_later(self.debounce, self._trigger, package_name)
+
+
+    def _trigger(self, package_name):
+        """Queue the notifyCommit of a package, on the scheduler thread"""
+
+        # Commits received from now on need another notifyCommit
+        with self._trigger_lock:
+            self._triggers.discard(package_name)
+
+        self.dispatcher.submit('jenkins', self.notify_commit, package_name)
+
+
+    def notify_commit(self, package_name):
+        """Ask Jenkins to poll the repository of a package"""
+
+        package_url = self.jenkins_trigger_url.replace(
+            "PACKAGE", package_name)
+        r = self.session.post("{}/git/notifyCommit".format(
+            self.jenkins_site), params={"url": package_url}, data="",
+            timeout=self.timeout)
+
+        self.triggered += 1
+        self.logger.debug("Sent to Jenkins: {} {}".format(
+            r.status_code, r.reason))
+
+
+    def trigger_stats(self):
+        """
+        Get the notifyCommit statistics
 
-            self.logger.debug("Sent to Jenkins: {} {}".format(
-                r.status_code, r.reason))
+        Returns
+        -------
+
+        stats: dictionary
+           The number of notifyCommit sent, of commits collapsed into a
+           queued notifyCommit and of packages waiting for one
+
+        """
+
+        with self._trigger_lock:
+            return {
+                'triggered': self.triggered,
+                'collapsed': self.collapsed,
+                'pending': len(self._triggers),
+            }
+
+
+    @property
+    def session(self):
+        """The HTTP session of the Jenkins API, created on first use"""
+
+        with self._session_lock:
+            if self._session is None:
+                self._session = self.auth_jenkins()
+
+            return self._session
 
 
     def auth_jenkins(self):
-        """Authenticate with the Jenkins server"""
+        """
+        Create an HTTP session authenticated with the Jenkins API key,
+        with a pool of keep-alive connections
+        """
 
-        site = lugito.config.CONFIG["connectors"]["jenkins"]["site"]
         user = lugito.config.CONFIG["connectors"]["jenkins"]["user"]
         key = lugito.config.CONFIG["connectors"]["jenkins"]["api_key"]
 
-        server = Jenkins(site, username=user, password=key)
+        session = requests.Session()
+        session.auth = (user, key)
+
+        # Keep the connections to the server alive between requests
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1,
+            pool_maxsize=int(lugito.config.CONFIG["connectors"]["jenkins"]\
+                .get("pool_size", POOL_SIZE)))
+        session.mount(self.jenkins_site, adapter)
+
+        return session
+
+
+    def get_builds(self, proj_name):
+        """
+        Get the last builds of a job with a single API request.  The
+        completed builds are cached, they don't change.
+
+        Parameters
+        ----------
+
+        proj_name: str
+           The name of the job
+
+        Returns
+        -------
+
+        builds: dictionary or None
+           The JenkinsBuild of the last builds by number, None if the job
+           doesn't exist
 
-        return server
+        """
 
+        # The job name is a single path segment
+        r = self.session.get("{}/job/{}/api/json".format(self.jenkins_site,
+            quote(proj_name, safe="")), params={"tree": BUILDS_TREE},
+            timeout=self.timeout)
 
-    def receive(self, proj_name):
-        """Receive the project name and return the status of the last build"""
+        if r.status_code == 404:
+            return None
+
+        r.raise_for_status()
+
+        builds = {}
+        for build in r.json().get("builds", []):
+            builds[build["number"]] = JenkinsBuild(build["number"],
+                build.get("result"), build.get("url"),
+                build.get("building", False))
+
+        self.cache_builds(proj_name, builds.values())
+
+        return builds
+
+
+    def cache_builds(self, proj_name, builds):
+        """Cache the completed builds of a job"""
+
+        with self._builds_lock:
+            cached = self._builds.setdefault(proj_name, {})
+
+            for build in builds:
+                if (not build.building) and (build.result is not None):
+                    cached[build.number] = build
+
+            # Only the most recent builds are needed
+            for number in sorted(cached)[:-BUILDS]:
+                del cached[number]
+
+
+    def get_cached_build(self, proj_name, number):
+        """Get a completed build from the cache, None if not cached"""
+
+        with self._builds_lock:
+            return self._builds.get(proj_name, {}).get(number)
+
+
+    def receive(self, request):
+        """
+        Get the status of a build of a project.  The RESULT, BUILD_NUMBER,
+        BUILD_URL and PREVIOUS_RESULT of the build are taken from the
+        request when present.  Otherwise the last builds of the job are
+        fetched with one request, unless the previous build is cached.
+
+        Parameters
+        ----------
 
-        proj_name = json.loads(proj_name)["PROJECT"]
+        request: str
+           The JSON request with the PROJECT name and optionally the build
+           details
 
-        status = None
+        Returns
+        -------
 
-        print("Getting project")
+        status: tuple or None
+           The project name, the status message or None if there is nothing
+           to report, and the build URL.  None if the project has no build
 
-        # If the server has the job, use it
-        if self.jenkins.has_job(proj_name):
-            proj = (proj_name, self.jenkins.get_job(proj_name))
+        Raises
+        ------
 
-        # Get the status of the last completed build if there isone
-        try:
-            # Get the data from Jenkins
-            status = proj[1].get_last_completed_build().get_status()
-            url = proj[1].get_last_completed_build().get_build_url()
-        except jenkinsapi.custom_exceptions.NoBuildData:
+        BuildPending
+           The build is not finished
+
+        """
+
+        payload = json.loads(request)
+        proj_name = payload["PROJECT"]
+
+        number = payload.get("BUILD_NUMBER")
+        if number is not None:
+            number = int(number)
+
+        build = None
+        if (number is not None) and ("RESULT" in payload) and\
+                ("BUILD_URL" in payload):
+            build = JenkinsBuild(number, payload["RESULT"],
+                payload["BUILD_URL"], False)
+
+        previous = None
+        if "PREVIOUS_RESULT" in payload:
+            previous = JenkinsBuild(None, payload["PREVIOUS_RESULT"], None,
+                False)
+        elif build is not None:
+            previous = self.get_cached_build(proj_name, number - 1)
+
+        # Everything needed is known, no request
+        if (build is not None) and ((previous is not None) or (number <= 1)):
+            self.cache_builds(proj_name, [build])
+            return proj_name, format_status(build.result,
+                previous and previous.result), build.url
+
+        builds = self.get_builds(proj_name)
+
+        # If the server doesn't have the job there is nothing to report
+        if builds is None:
+            self.logger.debug('{} is an unknown job'.format(proj_name))
             return None
 
-        # Get the status of <current build> - 1
-        last_status = proj[1].get_build(proj[1].get_last_buildnumber() - 1)
-        last_status = last_status.get_status()
-
-        # If it has been consistently stable, don't cause extra noise
-        if status == "SUCCESS" and last_status == status:
-            return proj[0], None, url
-
-        print("Customizing build status")
-
-        # Customize the message depending on the previous build status
-        if status == "SUCCESS":
-            if last_status == "FAILURE":
-                status = "just succeeded after failing"
-            elif last_status == "UNSTABLE":
-                status = "just became stable"
-            # Color it green
-            status = "\x033" + status + "\x03"
-        elif status == "FAILURE":
-            if last_status == "SUCCESS":
-                status = "just failed after succeeding"
-            elif last_status == "UNSTABLE":
-                status = "just failed after being unstable"
-            # Color it red
-            status = "\x034" + status + "\x03"
-        elif status == "UNSTABLE":
-            if last_status == "SUCCESS":
-                status = "just became unstable"
-            elif last_status == "FAILURE":
-                status = "just became unstable after failing"
-            # Color it yellow
-            status = "\x038" + status + "\x03"
-        elif status == "ABORTED":
-            # Color it gray
-            status = "\x0315" + status + "\x03"
-
-        return proj[0], status, url
+        if build is None:
+            if number is None:
+                if not builds:
+                    return None
+
+                # The most recent build
+                number = max(builds)
+
+            build = builds.get(number)
+
+            if (build is None) or build.building or (build.result is None):
+                raise BuildPending(proj_name)
+
+        else:
+            self.cache_builds(proj_name, [build])
+
+        if previous is None:
+            previous = builds.get(number - 1)
+
+            # A previous build still running has no result
+            if (previous is not None) and previous.building:
+                previous = None
+
+        return proj_name, format_status(build.result,
+            previous and previous.result), build.url
 
 
     def listen(self):
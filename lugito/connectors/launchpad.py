@@ -11,12 +11,18 @@ Define a launchpad connector class
 """
 
 # Imports
+import os
 import re
+import time
 import logging
-import phabricator
+import threading
 import lugito
+from lugito.cache import SeenSet
 from string import Template
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
 from launchpadlib.launchpad import Launchpad as lp
+from lazr.restfulclient.errors import Unauthorized
 
 
 BUG_MESSAGE = Template(
@@ -27,6 +33,116 @@ BUG_MESSAGE = Template(
 
 RE_COMMIT_MSG = re.compile(r"lp:\s+\#\d+(?:,\s*\#\d+)*")
 
+# Bugs processed at once
+BUG_CONCURRENCY = 4
+
+# The commit and bug pairs remembered by the ledger, for 90 days
+LEDGER_SIZE = 65536
+LEDGER_WINDOW = 90 * 24 * 3600
+
+# The task status set by a commit
+FIX_COMMITTED = 'Fix Committed'
+
+# Outcomes of a bug
+UPDATED = 'updated'
+ALREADY_FIXED = 'already fixed'
+SKIPPED = 'skipped'
+NO_TASK = 'no task'
+FAILED = 'failed'
+
+BugOutcome = namedtuple('BugOutcome', ['bug', 'outcome', 'latency', 'error'])
+
+
+def get_target_ranks(package_name, releases):
+    """
+    Get the rank of the bug targets of a package, the release targets in
+    the order of the releases then the Ubuntu target
+
+    >>> sorted(get_target_ranks('nm-tray', ['Cosmic', 'Bionic']).items(),
+    ...     key=lambda item: item[1])
+    [('nm-tray (Ubuntu Cosmic)', 0), ('nm-tray (Ubuntu Bionic)', 1), \
+('nm-tray (Ubuntu)', 2)]
+
+    Parameters
+    ----------
+
+    package_name: str
+       The source package
+
+    releases: list
+       The supported Ubuntu releases
+
+    Returns
+    -------
+
+    ranks: dictionary
+       The rank of each target name, lower is better
+
+    """
+
+    ranks = {}
+
+    for rank, release in enumerate(releases):
+        ranks["{} (Ubuntu {})".format(package_name, release)] = rank
+
+    ranks["{} (Ubuntu)".format(package_name)] = len(releases)
+
+    return ranks
+
+
+class SendResult(object):
+    """
+    The outcome of the bugs referenced by a commit
+
+    Attributes
+    ----------
+
+    outcomes: list
+       The BugOutcome of each bug in the order of the commit message
+
+    """
+
+    def __init__(self, outcomes=None):
+
+        self.outcomes = outcomes or []
+
+
+    def __iter__(self):
+        return iter(self.outcomes)
+
+
+    def __len__(self):
+        return len(self.outcomes)
+
+
+    @property
+    def failed(self):
+        """The outcomes of the bugs that failed"""
+
+        return [outcome for outcome in self.outcomes
+            if outcome.outcome == FAILED]
+
+
+    @property
+    def ok(self):
+        """True if no bug failed"""
+
+        return not self.failed
+
+
+    def summary(self):
+        """
+        Describe the outcomes
+
+        >>> SendResult([BugOutcome('1', UPDATED, 0.5, None)]).summary()
+        'bug 1: updated (500 ms)'
+
+        """
+
+        return ', '.join('bug {}: {} ({:.0f} ms)'.format(outcome.bug,
+            outcome.outcome, outcome.latency * 1e3)
+            for outcome in self.outcomes)
+
 
 class launchpad(object):
 
@@ -46,37 +162,83 @@ class launchpad(object):
         self.package_names =\
             lugito.config.CONFIG['phabricator']['package_names']
 
+        # Where launchpadlib caches the service description and the
+        # credentials, None for its defaults
+        self.cache_dir = lugito.config.CONFIG['connectors']\
+            ['launchpad'].get('cache_dir')
+        self.credentials_file = lugito.config.CONFIG['connectors']\
+            ['launchpad'].get('credentials_file')
+
+        # The ranked bug targets of each package
+        self.targets = {package_name: get_target_ranks(package_name,
+            self.supported_vers)
+            for package_name in set(self.package_names.values())}
 
         # Phabricator info
-        self.phab = phabricator.Phabricator(
-            host=lugito.config.CONFIG['phabricator']['host'],
-            token=lugito.config.CONFIG['phabricator']['token'],
-        )
+        self.phab = lugito.conduit.get_client()
 
         self.phab_host = lugito.config.CONFIG['phabricator']['host'].replace(
             'api/', '')
 
+        # Bugs processed at once
+        self.bug_concurrency = int(lugito.config.CONFIG['connectors']\
+            ['launchpad'].get('bug_concurrency', BUG_CONCURRENCY))
+        self._executor = None
+        self._executor_lock = threading.Lock()
+        self._local = threading.local()
+
+        # Bumped when the stored credentials are dropped, so that the
+        # sessions of the other workers don't drop the new ones
+        self._credentials = 0
+        self._credentials_lock = threading.Lock()
+
+        # The commit and bug pairs already updated, so that a commit
+        # delivered again doesn't comment twice
+        settings = lugito.config.CONFIG['connectors']['launchpad']
+        self.ledger = SeenSet(
+            maxsize=int(settings.get('ledger_size', LEDGER_SIZE)),
+            window=float(settings.get('ledger_window', LEDGER_WINDOW)),
+            path=settings.get('ledger_path'),
+        )
+
         self.logger = logging.getLogger('lugito.connector.launchpad')
 
-        # Add log level
-        ch = logging.StreamHandler()
+        # Add log level, the handler once per logger
+        if not self.logger.handlers:
+            ch = logging.StreamHandler()
+
+            formatter = logging.Formatter(
+                '%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+            ch.setFormatter(formatter)
 
-        formatter = logging.Formatter(
-            '%(asctime)s - %(name)s - %(levelname)s - %(message)s')
-        ch.setFormatter(formatter)
+            self.logger.addHandler(ch)
 
-        self.logger.addHandler(ch)
         self.logger.setLevel(log_level)
 
 
     def connect(self):
-        """Connect"""
+        """
+        Log in now on a worker of the bug pool.  This is optional, the
+        connector logs in when the first bug is processed.
+        """
+
+        self.executor.submit(self.get_lp).result()
+
+    def login(self):
+        """
+        Log in to Launchpad.  The service description is cached in the
+        cache directory and the credentials are stored once, so that only
+        the first login of the first run, or the login after the
+        credentials were rejected, authorizes the application.
+        """
 
         self.logger.info("Connecting to Launchpad")
-        self.lp = lp.login_with(
+        return lp.login_with(
             self.application,
             self.staging,
-            self.version)
+            launchpadlib_dir=self.cache_dir,
+            credentials_file=self.credentials_file,
+            version=self.version)
 
     def get_package_name(self, name):
         """Need to check"""
@@ -101,7 +263,21 @@ class launchpad(object):
 
 
     def send(self, *args, **kwargs):
-        """Send the commit message"""
+        """
+        Comment on the bugs referenced by a commit message and mark them as
+        Fix Committed.  The bugs are processed concurrently, a failure only
+        affects its own bug.  Given the commit_phid keyword, the bugs
+        already updated for the commit are skipped.
+
+        Returns
+        -------
+
+        result: SendResult
+           The outcome of each bug
+
+        """
+
+        commit_phid = kwargs.pop('commit_phid', None)
 
         if len(args) == 2:
             package_name, commit_msg = args
@@ -116,30 +292,228 @@ class launchpad(object):
         package_name = self.get_package_name(package_name)
         bug_list = self.get_bugs_list(commit_msg)
 
-        if package_name and bug_list:
-
-            for bug in bug_list:
-                goodtask = None
-                bug = self.lp.load("/bugs/" + str(bug).strip())
-
-                for task in bug.bug_tasks:
-                    for rel in self.supported_vers:
-                        if package_name + " (Ubuntu " + rel + ")" in task.bug_target_display_name:
-                            goodtask = task
-                            break
-
-                    if not goodtask:
-                        if package_name + " (Ubuntu)" in task.bug_target_display_name:
-                            goodtask = task
-
-                if goodtask:
-                    message = BUG_MESSAGE.substitute(
-                        link=self.phab_host + package_name,
-                        commit_message=commit_msg,
-                    )
-                    bug.newMessage(content=message)
-                    goodtask.status = "Fix Committed"
-                    goodtask.lp_save()
+        result = SendResult()
+
+        if not (package_name and bug_list):
+            return result
+
+        outcomes = []
+
+        for bug_id in bug_list:
+            bug_id = bug_id.strip()
+            key = self.get_ledger_key(commit_phid, bug_id)
+
+            # Claimed before any Launchpad call, so that a delivery running
+            # at the same time skips the bug too
+            if (key is not None) and (not self.ledger.claim(key)):
+                outcomes.append(BugOutcome(bug_id, SKIPPED, 0.0, None))
+            else:
+                outcomes.append(self.executor.submit(self.process_bug,
+                    package_name, commit_msg, bug_id, key))
+
+        for outcome in outcomes:
+            if not isinstance(outcome, BugOutcome):
+                outcome = outcome.result()
+
+            result.outcomes.append(outcome)
+
+        self.logger.info(result.summary())
+        return result
+
+
+    def get_ledger_key(self, commit_phid, bug_id):
+        """The ledger key of a commit and bug, None without a commit"""
+
+        if commit_phid is None:
+            return None
+
+        return '{}:{}'.format(commit_phid, bug_id)
+
+
+    def process_bug(self, package_name, commit_msg, bug_id, key=None):
+        """
+        Comment on a bug and mark its task as Fix Committed
+
+        Parameters
+        ----------
+
+        package_name: str
+           The source package of the commit
+
+        commit_msg: str
+           The commit message
+
+        bug_id: str
+           The bug number
+
+        key: str or None
+           The claimed ledger key, recorded once the bug is updated and
+           released otherwise
+
+        Returns
+        -------
+
+        outcome: BugOutcome
+           The outcome of the bug
+
+        """
+
+        started = time.monotonic()
+
+        # The steps already done, not repeated by the retry
+        done = set()
+
+        try:
+            try:
+                outcome = self.update_bug(package_name, commit_msg, bug_id,
+                    done)
+            except Unauthorized:
+                # The credentials were rejected, authorize again and retry
+                # once
+                self.logger.info('Launchpad session expired')
+                self.drop_credentials()
+                outcome = self.update_bug(package_name, commit_msg, bug_id,
+                    done)
+
+            error = None
+
+        except Exception as err:
+            self.logger.exception('Failed to update bug {}'.format(bug_id))
+            outcome = FAILED
+            error = err
+
+        # A bug that wasn't updated can be retried by another delivery
+        if key is not None:
+            if outcome in (UPDATED, ALREADY_FIXED):
+                self.ledger.add([key])
+            else:
+                self.ledger.release(key)
+
+        return BugOutcome(bug_id, outcome, time.monotonic() - started, error)
+
+
+    def update_bug(self, package_name, commit_msg, bug_id, done=None):
+        """
+        Update a bug, returns the outcome.  The steps done are added to
+        done, the steps already in it are skipped.
+        """
+
+        if done is None:
+            done = set()
+
+        bug = self.get_lp().load("/bugs/" + bug_id)
+        goodtask = self.get_task(package_name, bug.bug_tasks)
+
+        if not goodtask:
+            return NO_TASK
+
+        if 'comment' not in done:
+            message = BUG_MESSAGE.substitute(
+                link=self.phab_host + package_name,
+                commit_message=commit_msg,
+            )
+            bug.newMessage(content=message)
+            done.add('comment')
+
+        if goodtask.status == FIX_COMMITTED:
+            return ALREADY_FIXED
+
+        goodtask.status = FIX_COMMITTED
+        goodtask.lp_save()
+
+        return UPDATED
+
+
+    def get_task(self, package_name, tasks):
+        """
+        Get the task of a package with the best ranked target
+
+        Parameters
+        ----------
+
+        package_name: str
+           The source package
+
+        tasks: list
+           The tasks of a bug
+
+        Returns
+        -------
+
+        task: object or None
+           The task targeting the package, None if there is none
+
+        """
+
+        ranks = self.targets.get(package_name)
+        if ranks is None:
+            ranks = get_target_ranks(package_name, self.supported_vers)
+
+        goodtask = None
+        goodrank = None
+
+        for task in tasks:
+            rank = ranks.get(task.bug_target_display_name)
+
+            if (rank is not None) and ((goodrank is None) or
+                    (rank < goodrank)):
+                goodtask, goodrank = task, rank
+
+        return goodtask
+
+
+    @property
+    def executor(self):
+        """The pool processing the bugs, created on first use"""
+
+        with self._executor_lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(
+                    max_workers=self.bug_concurrency,
+                    thread_name_prefix='lugito-launchpad-bug')
+
+            return self._executor
+
+
+    def get_lp(self):
+        """
+        Get the Launchpad session of the current thread, logging in on
+        first use.  launchpadlib sessions can't be shared between threads,
+        each worker of the bug pool logs in once and keeps its session.
+        """
+
+        lp = getattr(self._local, 'lp', None)
+
+        if lp is None:
+            with self._credentials_lock:
+                self._local.credentials = self._credentials
+
+            lp = self._local.lp = self.login()
+
+        return lp
+
+
+    def drop_credentials(self):
+        """
+        Drop the Launchpad session of the current thread and the stored
+        credentials, so that the next login authorizes the application
+        again.  The credentials are only dropped once for the workers
+        that logged in with them.  Without a credentials file they are
+        kept in the keyring, only a transient rejection is recovered.
+        """
+
+        self._local.lp = None
+
+        with self._credentials_lock:
+            if getattr(self._local, 'credentials', 0) != self._credentials:
+                return
+
+            self._credentials += 1
+
+            if self.credentials_file and\
+                    os.path.exists(self.credentials_file):
+                self.logger.info('Dropping the Launchpad credentials')
+                os.remove(self.credentials_file)
 
 
     def listen(self):
@@ -0,0 +1,314 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+# S.D.G
+
+"""
+:mod:`lugito.dispatcher`
+======================================
+
+Dispatch work to the connectors on bounded thread pools, and schedule
+delayed calls
+
+.. currentmodule:: lugito.dispatcher
+"""
+
+# Imports
+import time
+import heapq
+import logging
+import threading
+import itertools
+from concurrent.futures import ThreadPoolExecutor
+import lugito
+
+DEFAULT_CONCURRENCY = 2
+
+# Messages to irc must keep their order
+CONCURRENCY = {
+    'irc': 1,
+    'launchpad': 4,
+    'jenkins': 2,
+}
+
+
+class BuildPending(Exception):
+    """
+    The build of a project is not finished, the call can be retried later
+    with the Scheduler
+    """
+
+
+class Dispatcher(object):
+    """
+    Run connector calls in the background.  Each connector has its own queue
+    and pool of threads so that a slow connector doesn't hold up the others.
+
+    The number of threads of a connector is read from the concurrency value
+    of its config section, falling back to CONCURRENCY.
+
+    Parameters
+    ----------
+
+    log_level: int
+       The logging level
+
+    """
+
+    def __init__(self, log_level=logging.DEBUG):
+
+        self.logger = logging.getLogger('lugito.dispatcher')
+
+        # Add log level, the handler once per logger
+        if not self.logger.handlers:
+            ch = logging.StreamHandler()
+
+            formatter = logging.Formatter(
+                '%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+            ch.setFormatter(formatter)
+
+            self.logger.addHandler(ch)
+
+        self.logger.setLevel(log_level)
+
+        self._executors = {}
+        self._pending = {}
+        self._lock = threading.Lock()
+
+
+    def get_concurrency(self, connector):
+        """Get the number of threads of a connector"""
+
+        settings = lugito.config.CONFIG.get('connectors', {}).get(
+            connector, {})
+
+        return int(settings.get('concurrency',
+            CONCURRENCY.get(connector, DEFAULT_CONCURRENCY)))
+
+
+    def _get_executor(self, connector):
+
+        with self._lock:
+            if connector not in self._executors:
+                self._executors[connector] = ThreadPoolExecutor(
+                    max_workers=self.get_concurrency(connector),
+                    thread_name_prefix='lugito-%s' % connector)
+                self._pending[connector] = 0
+
+            return self._executors[connector]
+
+
+    def submit(self, connector, func, *args, **kwargs):
+        """
+        Queue a call for a connector
+
+        Parameters
+        ----------
+
+        connector: str
+           The name of the connector, e.g. irc
+
+        func: callable
+           The connector method to call
+
+        Returns
+        -------
+
+        future: concurrent.futures.Future
+           The future of the call
+
+        """
+
+        executor = self._get_executor(connector)
+
+        with self._lock:
+            self._pending[connector] += 1
+
+        future = executor.submit(func, *args, **kwargs)
+        future.add_done_callback(
+            lambda future: self._done(connector, future))
+
+        return future
+
+
+    def _done(self, connector, future):
+
+        with self._lock:
+            self._pending[connector] -= 1
+
+        if (not future.cancelled()) and (future.exception() is not None):
+            self.logger.error('%s call failed: %r' % (connector,
+                future.exception()))
+
+
+    def pending(self, connector=None):
+        """
+        Get the number of queued or running calls
+
+        Parameters
+        ----------
+
+        connector: str or None
+           The name of the connector, None for all connectors
+
+        Returns
+        -------
+
+        pending: int or dictionary
+           The number of calls of the connector, or of each connector
+
+        """
+
+        with self._lock:
+            if connector is None:
+                return dict(self._pending)
+
+            return self._pending.get(connector, 0)
+
+
+    def shutdown(self, wait=True):
+        """Stop the pools once the queued calls are done"""
+
+        with self._lock:
+            executors = list(self._executors.values())
+            self._executors = {}
+
+        for executor in executors:
+            executor.shutdown(wait=wait)
+
+
+class Scheduler(object):
+    """
+    Run calls after a delay on a single background thread, e.g. to retry a
+    request later without keeping a sleeping thread per request.  The calls
+    should be quick, slow work is handed to a Dispatcher.
+
+    Parameters
+    ----------
+
+    log_level: int
+       The logging level
+
+    timer: callable
+       The clock used to schedule the calls
+
+    """
+
+    def __init__(self, log_level=logging.DEBUG, timer=time.monotonic):
+
+        self.timer = timer
+
+        self.logger = logging.getLogger('lugito.scheduler')
+
+        # Add log level, the handler once per logger
+        if not self.logger.handlers:
+            ch = logging.StreamHandler()
+
+            formatter = logging.Formatter(
+                '%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+            ch.setFormatter(formatter)
+
+            self.logger.addHandler(ch)
+
+        self.logger.setLevel(log_level)
+
+        self._calls = []
+        self._sequence = itertools.count()
+        self._condition = threading.Condition()
+        self._thread = None
+        self._running = False
+
+
+    def __len__(self):
+
+        with self._condition:
+            return len([call for call in self._calls if not call[-1]])
+
+
+    def call_later(self, delay, func, *args, **kwargs):
+        """
+        Schedule a call
+
+        Parameters
+        ----------
+
+        delay: float
+           Seconds before the call
+
+        func: callable
+           The function to call
+
+        Returns
+        -------
+
+        call: list
+           The scheduled call, to pass to cancel
+
+        """
+
+        call = [self.timer() + delay, next(self._sequence), func, args,
+            kwargs, False]
+
+        with self._condition:
+            heapq.heappush(self._calls, call)
+
+            if self._thread is None:
+                self._running = True
+                self._thread = threading.Thread(target=self._run,
+                    name='lugito-scheduler')
+                self._thread.daemon = True
+                self._thread.start()
+
+            self._condition.notify()
+
+        return call
+
+
+    def cancel(self, call):
+        """Cancel a scheduled call if it has not run yet"""
+
+        with self._condition:
+            call[-1] = True
+
+
+    def shutdown(self):
+        """Stop the scheduler, dropping the pending calls"""
+
+        with self._condition:
+            self._running = False
+            self._calls = []
+            self._condition.notify()
+            thread = self._thread
+            self._thread = None
+
+        if thread is not None:
+            thread.join()
+
+
+    def _run(self):
+
+        while True:
+            with self._condition:
+                while self._running:
+                    if self._calls and self._calls[0][-1]:
+                        heapq.heappop(self._calls)
+                        continue
+
+                    if self._calls and (self._calls[0][0] <= self.timer()):
+                        break
+
+                    timeout = None
+                    if self._calls:
+                        timeout = self._calls[0][0] - self.timer()
+
+                    self._condition.wait(timeout)
+
+                if not self._running:
+                    return
+
+                when, sequence, func, args, kwargs, cancelled =\
+                    heapq.heappop(self._calls)
+
+            try:
+                func(*args, **kwargs)
+            except Exception:
+                self.logger.exception('scheduled call failed')
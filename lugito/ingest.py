@@ -0,0 +1,334 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+# S.D.G
+
+"""
+:mod:`lugito.ingest`
+======================================
+
+Durable queue of received webhook payloads, drained by a pool of workers
+
+.. currentmodule:: lugito.ingest
+"""
+
+# Imports
+import time
+import logging
+import sqlite3
+import threading
+
+DEFAULT_WORKERS = 4
+
+# A payload failing this many times is moved to the failed table
+MAX_ATTEMPTS = 5
+
+# Seconds before the first retry of a failed payload, doubled each attempt
+RETRY_DELAY = 30
+
+
+class IngestQueue(object):
+    """
+    Webhook payloads stored in a SQLite database until they are processed.
+    Payloads claimed by a worker but not acknowledged, e.g. because the
+    process stopped, are handed out again when the queue is reopened.
+    Payloads whose processing failed are retried after a delay doubling with
+    each attempt, then moved to the failed table.
+
+    Parameters
+    ----------
+
+    path: str
+       The path of the SQLite database, ':memory:' for a non durable queue
+
+    log_level: int
+       The logging level
+
+    max_attempts: int
+       The number of times a payload is processed before it is given up
+
+    retry_delay: float
+       The seconds before the first retry of a failed payload
+
+    """
+
+    def __init__(self, path, log_level=logging.DEBUG,
+            max_attempts=MAX_ATTEMPTS, retry_delay=RETRY_DELAY):
+
+        self.path = path
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+
+        self.logger = logging.getLogger('lugito.ingest')
+
+        # Add log level, the handler once per logger
+        if not self.logger.handlers:
+            ch = logging.StreamHandler()
+
+            formatter = logging.Formatter(
+                '%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+            ch.setFormatter(formatter)
+
+            self.logger.addHandler(ch)
+
+        self.logger.setLevel(log_level)
+
+        self._lock = threading.Lock()
+        self._available = threading.Condition(self._lock)
+        self._workers = []
+        self._running = False
+
+        self._db = sqlite3.connect(path, check_same_thread=False)
+
+        with self._lock, self._db:
+            self._db.execute(
+                'CREATE TABLE IF NOT EXISTS events ('
+                'id INTEGER PRIMARY KEY AUTOINCREMENT, '
+                'route TEXT NOT NULL, '
+                'data BLOB NOT NULL, '
+                'received REAL NOT NULL, '
+                'claimed INTEGER NOT NULL DEFAULT 0, '
+                'attempts INTEGER NOT NULL DEFAULT 0, '
+                'retry_at REAL NOT NULL DEFAULT 0)')
+
+            self._db.execute(
+                'CREATE TABLE IF NOT EXISTS failed ('
+                'id INTEGER PRIMARY KEY, '
+                'route TEXT NOT NULL, '
+                'data BLOB NOT NULL, '
+                'received REAL NOT NULL, '
+                'attempts INTEGER NOT NULL, '
+                'failed REAL NOT NULL)')
+
+            # Queues created before the retries
+            columns = [row[1] for row in
+                self._db.execute('PRAGMA table_info(events)')]
+
+            if 'attempts' not in columns:
+                self._db.execute('ALTER TABLE events ADD COLUMN '
+                    'attempts INTEGER NOT NULL DEFAULT 0')
+                self._db.execute('ALTER TABLE events ADD COLUMN '
+                    'retry_at REAL NOT NULL DEFAULT 0')
+
+            # Recover the events of a previous run
+            self._db.execute('UPDATE events SET claimed = 0')
+
+
+    def __len__(self):
+
+        with self._lock:
+            return self._db.execute(
+                'SELECT COUNT(*) FROM events').fetchone()[0]
+
+
+    def failed_count(self):
+        """Get the number of payloads given up"""
+
+        with self._lock:
+            return self._db.execute(
+                'SELECT COUNT(*) FROM failed').fetchone()[0]
+
+
+    def put(self, route, data):
+        """
+        Store a payload
+
+        Parameters
+        ----------
+
+        route: str
+           The name of the webhook that received the payload
+
+        data: bytes
+           The raw request body
+
+        Returns
+        -------
+
+        event_id: int
+           The id of the stored payload
+
+        """
+
+        with self._available:
+            with self._db:
+                cursor = self._db.execute(
+                    'INSERT INTO events (route, data, received) '
+                    'VALUES (?, ?, ?)', (route, bytes(data), time.time()))
+
+            self._available.notify()
+
+        self.logger.debug('queued %s event %d' % (route, cursor.lastrowid))
+        return cursor.lastrowid
+
+
+    def claim(self, timeout=None):
+        """
+        Claim the oldest unclaimed payload that isn't waiting for a retry
+
+        Parameters
+        ----------
+
+        timeout: float or None
+           Seconds to wait for a payload, None to wait until one is available
+
+        Returns
+        -------
+
+        event: tuple or None
+           The (event_id, route, data) of the payload or None if the timeout
+           expired
+
+        """
+
+        deadline = None if timeout is None else time.monotonic() + timeout
+
+        with self._available:
+            while True:
+                now = time.time()
+                row = self._db.execute(
+                    'SELECT id, route, data FROM events WHERE claimed = 0 '
+                    'AND retry_at <= ? ORDER BY id LIMIT 1',
+                    (now,)).fetchone()
+
+                if row is not None:
+                    with self._db:
+                        self._db.execute(
+                            'UPDATE events SET claimed = 1 WHERE id = ?',
+                            (row[0],))
+                    return row[0], row[1], bytes(row[2])
+
+                # Wake up for the next retry
+                retry_at = self._db.execute(
+                    'SELECT MIN(retry_at) FROM events WHERE claimed = 0'
+                    ).fetchone()[0]
+                wait = None if retry_at is None else max(retry_at - now, 0)
+
+                if deadline is not None:
+                    remaining = deadline - time.monotonic()
+
+                    if remaining <= 0:
+                        return None
+
+                    wait = remaining if wait is None else min(wait,
+                        remaining)
+
+                self._available.wait(wait)
+
+
+    def ack(self, event_id):
+        """Remove a processed payload"""
+
+        with self._lock, self._db:
+            self._db.execute('DELETE FROM events WHERE id = ?', (event_id,))
+
+
+    def fail(self, event_id):
+        """
+        Release a payload whose processing failed, it is retried after a
+        delay or moved to the failed table after max_attempts attempts
+
+        Parameters
+        ----------
+
+        event_id: int
+           The id of the payload
+
+        Returns
+        -------
+
+        retry_at: float or None
+           The time of the retry, None if the payload was given up
+
+        """
+
+        with self._available:
+            attempts = self._db.execute(
+                'SELECT attempts FROM events WHERE id = ?',
+                (event_id,)).fetchone()[0] + 1
+
+            with self._db:
+                if attempts >= self.max_attempts:
+                    self._db.execute(
+                        'INSERT OR REPLACE INTO failed (id, route, data, '
+                        'received, attempts, failed) SELECT id, route, data, '
+                        'received, ?, ? FROM events WHERE id = ?',
+                        (attempts, time.time(), event_id))
+                    self._db.execute('DELETE FROM events WHERE id = ?',
+                        (event_id,))
+                    retry_at = None
+
+                else:
+                    retry_at = time.time() + self.retry_delay * 2 ** (
+                        attempts - 1)
+                    self._db.execute(
+                        'UPDATE events SET claimed = 0, attempts = ?, '
+                        'retry_at = ? WHERE id = ?',
+                        (attempts, retry_at, event_id))
+
+            self._available.notify()
+
+        return retry_at
+
+
+    def start(self, handler, workers=DEFAULT_WORKERS):
+        """
+        Start the workers draining the queue
+
+        Parameters
+        ----------
+
+        handler: callable
+           Called with the route and the raw request body of each payload
+
+        workers: int
+           The number of worker threads
+
+        """
+
+        self._running = True
+
+        for _ in range(workers):
+            worker = threading.Thread(target=self._work, args=[handler])
+            worker.daemon = True
+            worker.start()
+            self._workers.append(worker)
+
+
+    def stop(self):
+        """Stop the workers once their current payload is processed"""
+
+        self._running = False
+
+        with self._available:
+            self._available.notify_all()
+
+        for worker in self._workers:
+            worker.join()
+
+        self._workers = []
+
+
+    def _work(self, handler):
+        """Process payloads until stopped"""
+
+        while self._running:
+            claimed = self.claim(timeout=1)
+
+            if claimed is None:
+                continue
+
+            event_id, route, data = claimed
+
+            try:
+                handler(route, data)
+            except Exception:
+                self.logger.exception('failed to process %s event %d' % (
+                    route, event_id))
+
+                # Acknowledged requests are not delivered again, retry
+                if self.fail(event_id) is None:
+                    self.logger.error('gave up %s event %d' % (route,
+                        event_id))
+                continue
+
+            self.ack(event_id)
@@ -14,9 +14,10 @@ import json
 import hmac
 import http
 import logging
-import phabricator
 import lugito
+from collections import namedtuple
 from hashlib import sha256
+from lugito.cache import HandleCache, SeenSet
 
 PHAB_WEBHOOK_SIG = "X-Phabricator-Webhook-Signature"
 
@@ -24,31 +25,119 @@ COMMIT = "CMIT"
 DIFF_REV = "DREV"
 TASK = "TASK"
 
+# Handle cache defaults, tasks and diffs are invalidated whenever they are
+# renamed so only handles that are never renamed are kept for longer
+HANDLE_CACHE_SIZE = 1024
+HANDLE_TTL = 300
+HANDLE_TTLS = {
+    "USER": 86400,
+    "REPO": 86400,
+    COMMIT: 86400,
+}
+
+# Transactions changing the handle of an object
+RENAME_TYPES = ("title", "name")
+
+# Repeated deliveries are dropped if received within DEDUPE_WINDOW seconds
+DEDUPE_SIZE = 4096
+DEDUPE_WINDOW = 3600
+
+
+class LugitoEvent(namedtuple('LugitoEvent',
+        ['request_data', 'transaction', 'partial', 'lookups'])):
+    """
+    A validated webhook request.  Each request gets its own event so that
+    concurrent requests never share state on the Lugito instance.
+
+    Parameters
+    ----------
+
+    request_data: dictionary
+       The decoded webhook payload
+
+    transaction: list
+       The transaction data returned by Conduit
+
+    partial: boolean
+       True if transaction only holds the transactions listed in the payload,
+       False if it holds the full history of the object
+
+    lookups: dictionary
+       Cache of Conduit lookups made while processing the event
+
+    """
+
+    __slots__ = ()
+
+    def __new__(cls, request_data, transaction, partial=False, lookups=None):
+        if lookups is None:
+            lookups = {}
+
+        return super(LugitoEvent, cls).__new__(
+            cls, request_data, transaction, partial, lookups)
+
+    @property
+    def object_phid(self):
+        return self.request_data["object"]["phid"]
+
+    @property
+    def object_type(self):
+        return self.request_data["object"]["type"]
+
 
 class Lugito(object):
 
-    def __init__(self, log_level=logging.DEBUG):
+    def __init__(self, log_level=logging.DEBUG, targeted_fetch=True):
         """
         Initialise
+
+        Parameters
+        ----------
+
+        log_level: int
+           The logging level
+
+        targeted_fetch: boolean
+           If True only the transactions listed in the webhook payload are
+           requested from Conduit, otherwise the full transaction history of
+           the object is retrieved
+
         """
 
-        self.phab = phabricator.Phabricator(
-            host=lugito.config.CONFIG['phabricator']['host'],
-            token=lugito.config.CONFIG['phabricator']['token'],
-        )
+        self.phab = lugito.conduit.get_client()
         self.HMAC = lugito.config.CONFIG['phabricator']['hooks']
         self.host = lugito.config.CONFIG['phabricator']['host']
+        self.targeted_fetch = targeted_fetch
+
+        handle_ttls = dict(HANDLE_TTLS)
+        handle_ttls.update(
+            lugito.config.CONFIG['phabricator'].get('handle_ttl', {}))
+        self.handle_cache = HandleCache(
+            maxsize=lugito.config.CONFIG['phabricator'].get(
+                'handle_cache_size', HANDLE_CACHE_SIZE),
+            ttl=HANDLE_TTL,
+            ttls=handle_ttls,
+        )
+
+        settings = lugito.config.CONFIG.get('lugito', {})
+        self.seen = SeenSet(
+            maxsize=int(settings.get('dedupe_size', DEDUPE_SIZE)),
+            window=float(settings.get('dedupe_window', DEDUPE_WINDOW)),
+            path=settings.get('dedupe_path'),
+        )
 
         self.logger = logging.getLogger('lugito.lugito')
 
-        # Add log level
-        ch = logging.StreamHandler()
+        # Add log level, the handler once per logger
+        if not self.logger.handlers:
+            ch = logging.StreamHandler()
 
-        formatter = logging.Formatter(
-            '%(asctime)s - %(name)s - %(levelname)s - %(message)s')
-        ch.setFormatter(formatter)
+            formatter = logging.Formatter(
+                '%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+            ch.setFormatter(formatter)
+
+            self.logger.addHandler(ch)
 
-        self.logger.addHandler(ch)
         self.logger.setLevel(log_level)
 
         for key, val in self.HMAC.items():
@@ -58,8 +147,8 @@ class Lugito(object):
     def validate_request(self, hmac_key, request):
         """
         Check a request originated from Phabricator.  This method must be called
-        first to validate a request is from Phabricator before any other method
-        can be called
+        first to validate a request is from Phabricator, the returned event is
+        then passed to the other methods
 
         Parameters
         ----------
@@ -73,37 +162,237 @@ class Lugito(object):
         Returns
         -------
 
+        event: LugitoEvent or None
+           The event of the request if it matches the specified HMAC key and
+           is not a repeated delivery, None if not
+
+        """
+
+        # check if from phabricator
+        if self.verify_request(hmac_key, request.data,
+                request.headers[PHAB_WEBHOOK_SIG]):
+            return self.load_event(request.data, hmac_key)
+        return None
+
+
+    def verify_request(self, hmac_key, data, signature):
+        """
+        Check the signature of a request body
+
+        Parameters
+        ----------
+
+        hmac_key: str
+           The dictionary key corresponding to the HMAC token for the specifid webhook
+
+        data: bytes
+           The raw request body
+
+        signature: str
+           The value of the X-Phabricator-Webhook-Signature header
+
+        Returns
+        -------
+
         result: boolean
-           True if the request matches the specified HMAC key, False if not
+           True if the signature matches the specified HMAC key, False if not
 
         """
 
-        hash_ = hmac.new(self.HMAC[hmac_key], request.data, sha256)
+        if signature is None:
+            return False
 
-        # check if from phabricator
-        if hash_.hexdigest() == request.headers[PHAB_WEBHOOK_SIG]:
+        hash_ = hmac.new(self.HMAC[hmac_key], data, sha256)
+        return hmac.compare_digest(hash_.hexdigest(), signature)
+
+
+    def is_duplicate(self, hmac_key, request_data):
+        """
+        Check whether a request repeats a delivery already received by the
+        same webhook, e.g. a retry after a timeout.  Deliveries are told apart
+        by their transaction PHIDs and action epoch, so that the edit of a
+        comment isn't mistaken for the delivery of the comment.
 
-            # Store the request and transaction
-            self.request_data = json.loads(request.data)
-            self.transaction = self.phab.transaction.search(objectIdentifier=
-                self.request_data["object"]["phid"])["data"]
+        Parameters
+        ----------
 
+        hmac_key: str
+           The dictionary key corresponding to the HMAC token for the specifid webhook
 
-            self.logger.info('received phid: %s' %\
-                self.request_data["object"]["phid"])
+        request_data: dictionary
+           The decoded webhook payload
+
+        Returns
+        -------
+
+        result: boolean
+           True if every transaction of the request was already delivered
+
+        """
+
+        keys = self.get_delivery_keys(hmac_key, request_data)
+
+        if self.seen.check_and_add(keys):
+            self.logger.info('dropped repeated delivery of phid: %s' %\
+                request_data["object"]["phid"])
             return True
         return False
 
 
-    def get_object_type(self):
+    def forget_delivery(self, hmac_key, request_data):
+        """
+        Forget a delivery that failed to be processed, so that its retry by
+        Phabricator isn't dropped as a repeated delivery
+
+        Parameters
+        ----------
+
+        hmac_key: str
+           The dictionary key corresponding to the HMAC token for the specifid webhook
+
+        request_data: dictionary
+           The decoded webhook payload
+
+        """
+
+        self.seen.discard(self.get_delivery_keys(hmac_key, request_data))
+
+
+    def get_delivery_keys(self, hmac_key, request_data):
+        """Get the keys telling a delivery apart, see is_duplicate"""
+
+        epoch = request_data.get("action", {}).get("epoch")
+        return ['%s:%s:%s' % (hmac_key, xact["phid"], epoch) for xact in
+            request_data.get("transactions", []) if "phid" in xact]
+
+
+    def load_event(self, data, hmac_key=None):
+        """
+        Build the event of a verified request body
+
+        Parameters
+        ----------
+
+        data: bytes
+           The raw request body
+
+        hmac_key: str or None
+           The dictionary key of the webhook, if given repeated deliveries to
+           the webhook are dropped.  The delivery is forgotten if the event
+           can't be built, the caller forgets it if processing fails.
+
+        Returns
+        -------
+
+        event: LugitoEvent or None
+           The event of the request, None if it is a repeated delivery
+
+        """
+
+        request_data = json.loads(data)
+
+        # Drop repeated deliveries before any Conduit call
+        if (hmac_key is not None) and self.is_duplicate(hmac_key,
+                request_data):
+            return None
+
+        try:
+            transaction, partial = self.get_transactions(request_data)
+        except Exception:
+            if hmac_key is not None:
+                self.forget_delivery(hmac_key, request_data)
+            raise
+
+        event = LugitoEvent(request_data, transaction, partial)
+
+        # The cached handle holds the old name of a renamed object
+        if self.is_rename(event):
+            self.handle_cache.invalidate(event.object_phid)
+
+        self.logger.info('received phid: %s' % event.object_phid)
+        return event
+
+
+    def is_rename(self, event):
+        """
+        Check whether the delivered transactions rename the object
+
+        Parameters
+        ----------
+
+        event: LugitoEvent
+           The event returned by validate_request
+
+        Returns
+        -------
+
+        result: boolean
+           True if a title or name transaction was delivered
+
+        """
+
+        if event.object_type == COMMIT:
+            return False
+
+        phids = set(xact["phid"] for xact in
+            event.request_data.get("transactions", []) if "phid" in xact)
+
+        # The full history also holds the transactions of earlier hooks
+        for xact in event.transaction:
+            if (xact.get("type") in RENAME_TYPES) and (event.partial or
+                    (not phids) or (xact.get("phid") in phids)):
+                return True
+
+        return False
+
+
+    def get_transactions(self, request_data):
+        """
+        Get the transactions of a request.  If targeted fetching is enabled and
+        the payload lists its transactions only those are requested, otherwise
+        the complete transaction history of the object is searched.
+
+        Parameters
+        ----------
+
+        request_data: dictionary
+           The decoded webhook payload
+
+        Returns
+        -------
+
+        transactions: list
+           The transaction data returned by Conduit
+
+        partial: boolean
+           True if only the transactions listed in the payload were fetched
+
+        """
+
+        object_phid = request_data["object"]["phid"]
+        xact_phids = [xact["phid"] for xact in
+            request_data.get("transactions", []) if "phid" in xact]
+
+        if self.targeted_fetch and xact_phids:
+            self.logger.debug('get_transactions: fetching %d transactions' %\
+                len(xact_phids))
+            return self.phab.transaction.search(objectIdentifier=object_phid,
+                constraints={"phids": xact_phids})["data"], True
+
+        self.logger.debug('get_transactions: fetching full history')
+        return self.phab.transaction.search(
+            objectIdentifier=object_phid)["data"], False
+
+
+    def get_object_type(self, event):
         """
         Get object type from a request
 
         Parameters
         ----------
 
-        request: flask request object
-           The request object provided by the flask route decorator
+        event: LugitoEvent
+           The event returned by validate_request
 
         Returns
         -------
@@ -112,20 +401,20 @@ class Lugito(object):
             The object type from a request
 
         """
-        object_type = self.request_data["object"]["type"]
+        object_type = event.object_type
         self.logger.debug('get_object_type: %s' % object_type)
         return object_type
 
 
-    def get_author_fullname(self):
+    def get_author_fullname(self, event):
         """
         Get author fullname from a request
 
         Parameters
         ----------
 
-        request: flask request object
-           The request object provided by the flask route decorator
+        event: LugitoEvent
+           The event returned by validate_request
 
         Returns
         -------
@@ -138,9 +427,9 @@ class Lugito(object):
 
         try:
             # Find the author too.
-            userlookup = self.transaction[0]["authorPHID"]
-            who = dict(self.phab.phid.query(
-                phids=[userlookup]))[userlookup]["fullName"]
+            userlookup = event.transaction[0]["authorPHID"]
+            who = self.get_handles(event,
+                self.get_event_phids(event))[userlookup]["fullName"]
 
             self.logger.debug('get_author_fullname: %s' % who)
             return who
@@ -151,30 +440,197 @@ class Lugito(object):
             return None
 
 
-    def get_object_string(self, key): #pragma: no cover
+    def get_event_phids(self, event, repository=False):
+        """
+        Get the PHIDs needed to process an event
+
+        Parameters
+        ----------
+
+        event: LugitoEvent
+           The event returned by validate_request
+
+        repository: boolean
+           Include the repository of a commit event
+
+        Returns
+        -------
+
+        phids: list
+           The object PHID, the author PHID and, if requested, the repository
+           PHID of the event
+
+        """
+
+        phids = [event.object_phid]
+
+        if event.transaction:
+            phids.append(event.transaction[0]["authorPHID"])
+
+        if repository:
+            phids.append(self.get_repository_phid(event))
+
+        return phids
+
+
+    def get_handles(self, event, phids):
+        """
+        Get the handles of a list of PHIDs.  The PHIDs not yet looked up for
+        the event nor in the handle cache are resolved with a single
+        phid.query and kept on the event
+
+        Parameters
+        ----------
+
+        event: LugitoEvent
+           The event returned by validate_request
+
+        phids: list
+           The PHIDs to resolve
+
+        Returns
+        -------
+
+        handles: dictionary
+           The handle of each PHID known to Phabricator
+
+        """
+
+        missing = []
+        for phid in phids:
+            if phid in event.lookups:
+                continue
+
+            handle = self.handle_cache.get(phid)
+            if handle is None:
+                missing.append(phid)
+            else:
+                event.lookups[phid] = handle
+
+        if missing:
+            self.logger.debug('get_handles: %s' % ', '.join(missing))
+            handles = self.phab.phid.query(phids=missing)
+
+            for phid, handle in handles.items():
+                self.handle_cache.set(phid, handle)
+                event.lookups[phid] = handle
+
+        return {phid: event.lookups[phid] for phid in phids
+            if phid in event.lookups}
+
+
+    def prefetch_handles(self, event, repository=False):
+        """
+        Resolve every handle needed to process an event in one phid.query.
+        Failed lookups are left to the individual get methods.
+
+        Parameters
+        ----------
+
+        event: LugitoEvent
+           The event returned by validate_request
+
+        repository: boolean
+           Include the repository of a commit event
+
+        """
+
+        try:
+            self.get_handles(event, self.get_event_phids(event, repository))
+        except http.client.HTTPException:
+            self.logger.info('prefetch_handles failed')
+
+
+    def get_object_string(self, event, key):
+        """
+        Get a field of the object handle
+
+        Parameters
+        ----------
+
+        event: LugitoEvent
+           The event returned by validate_request
+
+        key: str
+           The handle field e.g. fullName, name or uri
+
+        Returns
+        -------
+
+        value: str
+           The value of the field
+
+        """
+
+        phid = event.object_phid
+        return self.get_handles(event, self.get_event_phids(event))[phid][key]
+
+
+    def get_repository_phid(self, event):
+        """
+        Get the repository PHID of a commit event
+
+        Parameters
+        ----------
+
+        event: LugitoEvent
+           The event returned by validate_request
+
+        Returns
+        -------
+
+        repo_phid: str
+           The PHID of the repository the commit belongs to
+
+        """
+
+        if 'repositoryPHID' not in event.lookups:
+            # Get the commit PHID and search it
+            commit = self.phab.diffusion.commit.search(
+                constraints={"phids": [event.object_phid]})
+
+            # Grab the repository PHID from the query results
+            event.lookups['repositoryPHID'] =\
+                commit["data"][0]["fields"]["repositoryPHID"]
+
+        return event.lookups['repositoryPHID']
+
+
+    def get_repository_name(self, event):
+        """
+        Get the repository name of a commit event
+
+        Parameters
+        ----------
+
+        event: LugitoEvent
+           The event returned by validate_request
 
-        phid = self.request_data["object"]["phid"]
-        return self.phab.phid.query(phids=[phid])[phid][key]
+        Returns
+        -------
 
+        repo_name: str
+           The name of the repository the commit belongs to
 
-    def get_repository_name(self): #pragma: no cover
-        # Get the commit PHID and search it
-        commit_phid = self.request_data["object"]["phid"]
-        commit = self.phab.diffusion.commit.search(
-            constraints={"phids": [commit_phid]})
+        """
 
-        # Grab the repository PHID from the query results
-        repo_phid = commit["data"][0]["fields"]["repositoryPHID"]
+        repo_phid = self.get_repository_phid(event)
 
         # Using the repo PHID we just grabbed, get the name of it
-        repo_name = self.phab.phid.query(phids=[repo_phid])[repo_phid]["name"]
-        return repo_name
+        handles = self.get_handles(event,
+            self.get_event_phids(event, repository=True))
+        return handles[repo_phid]["name"]
 
 
-    def get_commit_message(self):
+    def get_commit_message(self, event):
         """
         Get the commit message
 
+        Parameters
+        ----------
+
+        event: LugitoEvent
+           The event returned by validate_request
 
         Returns
         -------
@@ -184,8 +640,8 @@ class Lugito(object):
            If the object doesn't exist a blank string is returned.
 
         """
-        fullName = self.get_object_string(self.request_data, "fullName")
-        name = self.get_object_string(self.request_data, "name")
+        fullName = self.get_object_string(event, "fullName")
+        name = self.get_object_string(event, "name")
 
         commitmessage = fullName.replace(name + ": ", "")
 
@@ -193,10 +649,15 @@ class Lugito(object):
         return commitmessage
 
 
-    def is_new_object(self):
+    def is_new_object(self, event):
         """
         Is the request from a newly created object
 
+        Parameters
+        ----------
+
+        event: LugitoEvent
+           The event returned by validate_request
 
         Returns
         -------
@@ -206,9 +667,14 @@ class Lugito(object):
 
         """
 
+        # Only the webhook's own transactions are known, a new object always
+        # carries its create transaction
+        if event.partial:
+            return any(data["type"] == "create" for data in event.transaction)
+
         newtask = None
         modified = None
-        for data in self.transaction:
+        for data in event.transaction:
             if modified:
                 if (data["dateCreated"] == data["dateModified"])\
                     and (data["dateCreated"] == modified):
@@ -223,15 +689,18 @@ class Lugito(object):
         return newtask
 
 
-    def is_comment(self, period=10):
+    def is_comment(self, event, period=10):
         """
         Is the request from a new or edited comment object
 
         Parameters
         ----------
 
-        request: flask request object
-           The request object provided by the flask route decorator
+        event: LugitoEvent
+           The event returned by validate_request
+
+        period: int
+           Window in seconds around the request epoch to search for comments
 
         Returns
         -------
@@ -251,8 +720,8 @@ class Lugito(object):
         is_new_comment = False
         is_edited_comment = False
         comment_id = None
-        for task in self.transaction:
-            dataepoch = self.request_data["action"]["epoch"]
+        for task in event.transaction:
+            dataepoch = event.request_data["action"]["epoch"]
             datemodified = task["dateModified"]
 
             # All comments within period seconds of the request are fair game.
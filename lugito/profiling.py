@@ -0,0 +1,246 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+# S.D.G
+
+"""
+:mod:`lugito.profiling`
+======================================
+
+Startup profiling.  The startup is run in a child interpreter started with
+``-X importtime`` so that every import is timed, including the import of
+lugito itself, while the initialisation phases are timed with
+:func:`phase`.
+
+.. currentmodule:: lugito.profiling
+"""
+
+# Imports
+import sys
+import json
+import time
+import subprocess
+from collections import namedtuple
+from contextlib import contextmanager
+
+# Prefix of the line holding the phase times in the child output
+PHASES_MARKER = 'lugito-phases: '
+
+# Number of imports reported
+TOP_IMPORTS = 15
+
+ImportTime = namedtuple('ImportTime', ['module', 'self', 'cumulative',
+    'depth'])
+
+# The [name, seconds] of the timed phases, None when not profiling
+PHASES = None
+
+
+@contextmanager
+def phase(name):
+    """
+    Time an initialisation phase when profiling the startup
+
+    Parameters
+    ----------
+
+    name: str
+       The name of the phase
+
+    """
+
+    if PHASES is None:
+        yield
+        return
+
+    # Phases are listed in the order they start
+    timed = [name, None]
+    PHASES.append(timed)
+    started = time.perf_counter()
+
+    try:
+        yield
+    finally:
+        timed[1] = time.perf_counter() - started
+
+
+def parse_importtime(lines):
+    """
+    Parse the output of python -X importtime
+
+    >>> parse_importtime([
+    ...     'import time: self [us] | cumulative | imported package',
+    ...     'import time:       259 |        259 |   _json',
+    ...     'import time:       450 |        709 | json',
+    ...     'something else'])
+    [ImportTime(module='_json', self=259, cumulative=259, depth=1), \
+ImportTime(module='json', self=450, cumulative=709, depth=0)]
+
+    Parameters
+    ----------
+
+    lines: list
+       The lines written to stderr
+
+    Returns
+    -------
+
+    imports: list
+       The ImportTime of each module, times in microseconds
+
+    """
+
+    imports = []
+
+    for line in lines:
+        if not line.startswith('import time:'):
+            continue
+
+        fields = line[len('import time:'):].split('|')
+
+        try:
+            self_time, cumulative = int(fields[0]), int(fields[1])
+        except (ValueError, IndexError):
+            # The header
+            continue
+
+        module = fields[2].rstrip()
+        depth = (len(module) - len(module.lstrip()) - 1) // 2
+
+        imports.append(ImportTime(module.strip(), self_time, cumulative,
+            depth))
+
+    return imports
+
+
+def get_lugito_imports(imports):
+    """
+    Get the top level imports and the imports made by the lugito modules
+
+    >>> get_lugito_imports([
+    ...     ImportTime('idna', 10, 10, 2),
+    ...     ImportTime('requests', 20, 30, 1),
+    ...     ImportTime('lugito.conduit', 5, 35, 0),
+    ...     ImportTime('site', 5, 5, 0),
+    ... ])
+    [ImportTime(module='requests', self=20, cumulative=30, depth=1), \
+ImportTime(module='lugito.conduit', self=5, cumulative=35, depth=0), \
+ImportTime(module='site', self=5, cumulative=5, depth=0)]
+
+    Parameters
+    ----------
+
+    imports: list
+       The ImportTime of each module in the order of parse_importtime
+
+    Returns
+    -------
+
+    imports: list
+       The ImportTime of the selected modules
+
+    """
+
+    selected = []
+
+    # A module is listed before the modules importing it, the parent of
+    # a module is the first module after it one level up
+    for index, item in enumerate(imports):
+        if item.depth == 0:
+            selected.append(item)
+            continue
+
+        for parent in imports[index + 1:]:
+            if parent.depth == item.depth - 1:
+                if parent.module.split('.')[0] == 'lugito':
+                    selected.append(item)
+                break
+
+    return selected
+
+
+def run_startup():
+    """Run the startup phases and write their times, in the child"""
+
+    global PHASES
+    PHASES = []
+
+    with phase('import lugito.webhooks'):
+        from lugito import webhooks
+
+    # Without side effects: no IRC login, no queued event processed
+    with phase('start services'):
+        webhooks.start_services(dry_run=True)
+
+    print(PHASES_MARKER + json.dumps(PHASES))
+    sys.stdout.flush()
+
+
+def profile_startup(stream=None, budget=None, top=TOP_IMPORTS):
+    """
+    Profile the startup and write a report
+
+    Parameters
+    ----------
+
+    stream: file or None
+       Where the report is written, stdout if None
+
+    budget: float or None
+       The maximum startup time in seconds
+
+    top: int
+       The number of imports reported
+
+    Returns
+    -------
+
+    status: int
+       1 if the startup failed or took longer than the budget, 0 otherwise
+
+    """
+
+    if stream is None:
+        stream = sys.stdout
+
+    started = time.perf_counter()
+    child = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-m', 'lugito.profiling'],
+        stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+        universal_newlines=True)
+    total = time.perf_counter() - started
+
+    phases = None
+    for line in child.stdout.splitlines():
+        if line.startswith(PHASES_MARKER):
+            phases = json.loads(line[len(PHASES_MARKER):])
+
+    if (child.returncode != 0) or (phases is None):
+        stream.write('Startup failed:\n' + child.stderr)
+        return 1
+
+    imports = get_lugito_imports(parse_importtime(child.stderr.splitlines()))
+    imports.sort(key=lambda item: item.cumulative, reverse=True)
+
+    stream.write('Startup: %.1f ms\n\n' % (total * 1e3))
+
+    stream.write('Phases\n')
+    for name, seconds in phases:
+        stream.write('%10.1f ms  %s\n' % (seconds * 1e3, name))
+
+    stream.write('\nImports (cumulative)\n')
+    for item in imports[:top]:
+        stream.write('%10.1f ms  %s\n' % (item.cumulative / 1e3,
+            item.module))
+
+    if (budget is not None) and (total > budget):
+        stream.write('\nStartup took longer than the %.1f s budget\n' %
+            budget)
+        return 1
+
+    return 0
+
+
+if __name__ == '__main__':
+    # The phases are recorded by the lugito.profiling module, not __main__
+    from lugito.profiling import run_startup
+    run_startup()
@@ -0,0 +1,139 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+# S.D.G
+
+"""
+:mod:`lugito.references`
+======================================
+
+Extract the task and diff references of chat messages
+
+.. currentmodule:: lugito.references
+"""
+
+# Imports
+import re
+from collections import namedtuple
+
+# A bare mention e.g. T123, D45#678 or a link e.g. https://phab.lubuntu.me/T123
+# The lookahead quickly skips the positions that can't start a reference
+REFERENCE_RE = re.compile(
+    r'(?=[hTD])(?:(?P<url>https?://\S*?/)|(?<![\w/#]))'
+    r'(?P<kind>[TD])(?P<id>\d+)(?:#(?P<anchor>\d+))?(?!\w)')
+
+
+class Reference(namedtuple('Reference', ['kind', 'id', 'anchor'])):
+    """
+    A reference to a task or diff
+
+    >>> Reference('T', 88, 3230)
+    Reference(kind='T', id=88, anchor=3230)
+    >>> str(Reference('T', 88, 3230))
+    'T88#3230'
+
+    """
+
+    __slots__ = ()
+
+    @property
+    def name(self):
+        """The object name e.g. T88"""
+
+        return '{}{}'.format(self.kind, self.id)
+
+    def __str__(self):
+
+        if self.anchor is None:
+            return self.name
+
+        return '{}#{}'.format(self.name, self.anchor)
+
+
+def _get_urls(host):
+    """Get the links prefixes of a host with and without TLS"""
+
+    host = host.split('://', 1)[-1]
+    return ('http://' + host, 'https://' + host)
+
+
+def extract_references(text, host=None, bare=True):
+    """
+    Extract the references of a message in order
+
+    >>> extract_references('see T1, D2#5 and https://phab.lubuntu.me/T3#4')
+    [Reference(kind='T', id=1, anchor=None), \
+Reference(kind='D', id=2, anchor=5), Reference(kind='T', id=3, anchor=4)]
+    >>> extract_references('http://other/T1 https://phab.lubuntu.me/D2',
+    ...     host='https://phab.lubuntu.me/', bare=False)
+    [Reference(kind='D', id=2, anchor=None)]
+
+    Parameters
+    ----------
+
+    text: str
+       The message
+
+    host: str or None
+       Only keep the links to this host, None to keep all links
+
+    bare: boolean
+       Keep the mentions that are not links
+
+    Returns
+    -------
+
+    references: list
+       The Reference of each mention
+
+    """
+
+    urls = None if host is None else _get_urls(host)
+    references = []
+
+    for url, kind, number, anchor in REFERENCE_RE.findall(text):
+
+        if not url:
+            if not bare:
+                continue
+
+        elif (urls is not None) and (url not in urls):
+            continue
+
+        references.append(Reference(kind, int(number),
+            int(anchor) if anchor else None))
+
+    return references
+
+
+def parse_reference(text):
+    """
+    Parse a single reference or link
+
+    >>> parse_reference('https://phab.lubuntu.me/T088')
+    Reference(kind='T', id=88, anchor=None)
+    >>> parse_reference('Tblah') is None
+    True
+
+    Parameters
+    ----------
+
+    text: str
+       The reference e.g. T123#456 or https://phab.lubuntu.me/D45
+
+    Returns
+    -------
+
+    reference: Reference or None
+       The reference or None if the text is not a reference
+
+    """
+
+    match = REFERENCE_RE.fullmatch(text.strip())
+
+    if match is None:
+        return None
+
+    anchor = match.group('anchor')
+
+    return Reference(match.group('kind'), int(match.group('id')),
+        None if anchor is None else int(anchor))
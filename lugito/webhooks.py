@@ -13,24 +13,41 @@ Lugito webhooks
 """
 
 # Imports
+import json
 import logging
-import threading
+import argparse
 from flask import Flask, request
-from time import sleep
-from lugito import Lugito
-from lugito.connectors import irc, launchpad, jenkins
+from lugito import Lugito, config
+from lugito.lugito import PHAB_WEBHOOK_SIG
+from lugito.ingest import IngestQueue, DEFAULT_WORKERS, MAX_ATTEMPTS,\
+    RETRY_DELAY
+from lugito.dispatcher import Dispatcher, Scheduler, BuildPending
+from lugito.profiling import phase
+from lugito.connectors import ConnectorRegistry
 
 # Constants
 GLOBAL_LOG_LEVEL = logging.DEBUG
 
+# Retries of the lookup of a running build, after 2, 4, 8... seconds
+JENKINS_BACKOFF = 2
+JENKINS_RETRIES = 5
+
 # Instantiate Lugito and connectors
-lugito = Lugito(GLOBAL_LOG_LEVEL)
+with phase('Lugito'):
+    lugito = Lugito(GLOBAL_LOG_LEVEL)
 WEBSITE = lugito.host.replace('/api/', '')
 
-# Connectors
-irc_con = irc()
-launchpad_con = launchpad()
-jenkins_con = jenkins()
+# Connector calls run on per-connector pools
+dispatcher = Dispatcher(GLOBAL_LOG_LEVEL)
+
+# Delayed calls e.g. retries
+scheduler = Scheduler(GLOBAL_LOG_LEVEL)
+
+# Connectors, built on first use.  The jenkins connector debounces its
+# builds with the shared scheduler and dispatcher.
+registry = ConnectorRegistry(GLOBAL_LOG_LEVEL, {
+    'jenkins': {'scheduler': scheduler, 'dispatcher': dispatcher},
+})
 
 # Logging
 logger = logging.getLogger('lugito.webhooks')
@@ -45,180 +62,363 @@ ch.setFormatter(formatter)
 logger.addHandler(ch)
 logger.setLevel(GLOBAL_LOG_LEVEL)
 
+# Durable queue of verified requests, enabled by the lugito queue setting
+ingest_queue = None
+
 # Flask
-app = Flask('lugito')
+with phase('Flask'):
+    app = Flask('lugito')
+
+
+def submit(connector, method, *args, **kwargs):
+    """
+    Queue a call to a connector method if the connector is configured.  The
+    connector is built by the call if it is not yet.
+    """
+
+    if connector not in registry:
+        logger.debug('%s connector not configured' % connector)
+        return None
+
+    def call():
+        return getattr(registry.get(connector), method)(*args, **kwargs)
+
+    return dispatcher.submit(connector, call)
+
+
+def receive(hmac_key, process):
+    """
+    Validate a request and process its event.  If the ingestion queue is
+    enabled the verified request body is queued for the workers instead.
+    """
+
+    if ingest_queue is not None:
+        if lugito.verify_request(hmac_key, request.data,
+                request.headers.get(PHAB_WEBHOOK_SIG)):
+            queue_delivery(hmac_key, request.data)
+        return 'Ok'
+
+    event = lugito.validate_request(hmac_key, request)
+
+    if event:
+        process_delivery(hmac_key, process, event)
+
+    return 'Ok'
+
+
+def queue_delivery(hmac_key, data):
+    """Queue a verified request body unless it is a repeated delivery"""
+
+    request_data = json.loads(data)
+
+    if lugito.is_duplicate(hmac_key, request_data):
+        return
+
+    try:
+        ingest_queue.put(hmac_key, data)
+    except Exception:
+        lugito.forget_delivery(hmac_key, request_data)
+        raise
+
+
+def process_delivery(hmac_key, process, event):
+    """
+    Process the event of a request, forgetting the delivery if it fails so
+    that its retry is processed
+    """
+
+    try:
+        process(event)
+    except Exception:
+        lugito.forget_delivery(hmac_key, event.request_data)
+        raise
+
+
+def process_commithook(event):
+    """Process a commit hook event"""
+
+    author = lugito.get_author_fullname(event)
+
+    # Without the author we can't continue
+    if author is None:
+        return
+
+    object_type = lugito.get_object_type(event)
+
+    if object_type == "CMIT":
+        logger.debug("Object is a commit.")
+
+        commit_msg = lugito.get_commit_message(event)
+        pkg_name = lugito.get_object_string(event, "name")
+
+
+        submit('launchpad', 'send', pkg_name, commit_msg,
+            commit_phid=event.object_phid)
 
 
 @app.route("/commithook", methods=["POST"])
 def commithook():
     """Commit hook"""
 
-    if lugito.validate_request('commithook', request):
+    return receive('commithook', process_commithook)
 
-        author = lugito.get_author_fullname()
 
-        # Without the author we can't continue
-        if author is None:
-            return 'Ok'
+def process_irc(event):
+    """Process an irc event"""
 
-        object_type = lugito.request_data["object"]["type"]
+    author = lugito.get_author_fullname(event)
 
-        if object_type == "CMIT":
-            logger.debug("Object is a commit.")
+    # Without the author we can't continue
+    if author is None:
+        return
 
-            commit_msg = lugito.get_object_string("fullName").replace(
-                lugito.get_object_string("name") + ": ", "")
-            pkg_name = lugito.get_object_string("name")
+    logger.debug("Object exists, checking to see if it's a task, diff "\
+        "or a commit.")
 
+    newtask = lugito.is_new_object(event)
+    is_new_comment, is_edited, comment_id = lugito.is_comment(event)
+    object_type = lugito.get_object_type(event)
 
-            launchpad_con.send(pkg_name, commit_msg)
+    body = ""
+    link = ""
+    objectstr = lugito.get_object_string(event, "fullName")
 
+    # The object changed, its summary must be looked up again
+    irc_con = registry.loaded('irc')
+    if irc_con is not None:
+        irc_con.invalidate_info(lugito.get_object_string(event, "name"))
 
-    return 'Ok'
+    send_msg = True
+    # Determine what event produced the webhook call
+    if (object_type == "TASK") and newtask:
+        logger.debug("Object is a new task.")
+        body = "just created this task"
+        link = lugito.get_object_string(event, "uri")
 
+    elif (object_type == "TASK") and (not newtask):
+        logger.debug("Object is NOT a new task.")
 
-@app.route("/irc", methods=["POST"])
-def _main():
-    """Main route"""
+        # Is it a new or edited comment
+        if is_new_comment and (not is_edited):
+            logger.debug("Object is a new comment.")
+            body = "commented on the task"
 
-    if lugito.validate_request('irc', request):
+        elif (not is_new_comment) and is_edited:
+            logger.debug("Object is an edited comment.")
+            body = "edited a message on the task"
 
-        author = lugito.get_author_fullname()
+        if is_new_comment or is_edited:
+            link = lugito.get_object_string(event, "uri")
+            link += "#" + str(comment_id)
+            logger.info(link)
 
-        # Without the author we can't continue
-        if author is None:
-            return 'Ok'
+        else:
+            logger.debug("The object has already been processed")
+            send_msg = False
 
-        logger.debug("Object exists, checking to see if it's a task, diff "\
-            "or a commit.")
+    elif (object_type == "DREV") and newtask:
+        logger.debug("Object is a new diff.")
+        body = "just created this diff"
+        link = lugito.get_object_string(event, "uri")
 
-        newtask = lugito.is_new_object()
-        is_new_comment, is_edited, comment_id = lugito.is_comment()
-        object_type = lugito.request_data["object"]["type"]
+    elif (object_type == "DREV") and (not newtask):
+        logger.debug("Object is NOT a new diff.")
 
-        body = ""
-        link = ""
-        objectstr = lugito.get_object_string("fullName")
+        # Is it a new or edited comment
+        if is_new_comment and (not is_edited):
+            logger.debug("Object is a new comment.")
+            body = "commented on the diff"
 
-        send_msg = True
-        # Determine what event produced the webhook call
-        if (object_type == "TASK") and newtask:
-            logger.debug("Object is a new task.")
-            body = "just created this task"
-            link = lugito.get_object_string("uri")
+        elif (not is_new_comment) and is_edited:
+            logger.debug("Object is an edited comment.")
+            body = "edited a message on the diff"
 
-        elif (object_type == "TASK") and (not newtask):
-            logger.debug("Object is NOT a new task.")
+        if is_new_comment or is_edited:
+            link = lugito.get_object_string(event, "uri")
+            link += "#" + str(comment_id)
+            logger.info(link)
 
-            # Is it a new or edited comment
-            if is_new_comment and (not is_edited):
-                logger.debug("Object is a new comment.")
-                body = "commented on the task"
+        else:
+            logger.debug("The object has already been processed")
+            send_msg = False
 
-            elif (not is_new_comment) and is_edited:
-                logger.debug("Object is an edited comment.")
-                body = "edited a message on the task"
+    elif object_type == "CMIT":
+        logger.debug("Object is a commit.")
+        body = "committed"
+        link = WEBSITE + "/" + lugito.get_object_string(event, "name")
+        logger.info(link)
 
-            if is_new_comment or is_edited:
-                link = lugito.get_object_string("uri")
-                link += "#" + str(comment_id)
-                logger.info(link)
+    if send_msg:
+        submit('irc', 'send', objectstr, author, body, link)
 
-            else:
-                logger.debug("The object has already been processed")
-                send_msg = False
 
-        elif (object_type == "DREV") and newtask:
-            logger.debug("Object is a new diff.")
-            body = "just created this diff"
-            link = lugito.get_object_string("uri")
+@app.route("/irc", methods=["POST"])
+def _main():
+    """Main route"""
 
-        elif (object_type == "DREV") and (not newtask):
-            logger.debug("Object is NOT a new diff.")
+    return receive('irc', process_irc)
 
-            # Is it a new or edited comment
-            if is_new_comment and (not is_edited):
-                logger.debug("Object is a new comment.")
-                body = "commented on the diff"
 
-            elif (not is_new_comment) and is_edited:
-                logger.debug("Object is an edited comment.")
-                body = "edited a message on the diff"
+def process_jenkins(event):
+    """Process a jenkins event"""
 
-            if is_new_comment or is_edited:
-                link = lugito.get_object_string("uri")
-                link += "#" + str(comment_id)
-                logger.info(link)
+    object_type = lugito.get_object_type(event)
 
-            else:
-                logger.debug("The object has already been processed")
-                send_msg = False
+    # Resolve the author, commit and repository together
+    lugito.prefetch_handles(event, repository=(object_type == "CMIT"))
 
-        elif object_type == "CMIT":
-            logger.debug("Object is a commit.")
-            body = "committed"
-            link = WEBSITE + "/" + lugito.get_object_string("name")
-            logger.info(link)
+    author = lugito.get_author_fullname(event)
 
-        if send_msg:
-            irc_con.send(objectstr, author, body, link)
+    # Without the author we can't continue
+    if author is None:
+        return
 
-    return 'Ok'
+    if object_type == "CMIT":
+        logger.debug("Object is a commit.")
+
+        pkg_name = lugito.get_repository_name(event)
+        submit('jenkins', 'send', package_name=pkg_name)
 
 
 @app.route("/jenkins", methods=["POST"])
 def jenkinstrigger():
     """Jenkins trigger"""
 
-    if lugito.validate_request('jenkins', request):
+    return receive('jenkins', process_jenkins)
 
-        author = lugito.get_author_fullname()
 
-        # Without the author we can't continue
-        if author is None:
-            return 'Ok'
+def send_jenkins_status(request, attempt=0):
+    """
+    Send the status of a build of a project to irc.  If the build is not
+    finished the lookup is retried later with exponential backoff.
+    """
 
-        object_type = lugito.request_data["object"]["type"]
-        pkg_name = lugito.get_repository_name()
+    if 'jenkins' not in registry:
+        logger.debug('jenkins connector not configured')
+        return
 
-        if object_type == "CMIT":
-            logger.debug("Object is a commit.")
+    try:
+        build = registry.get('jenkins').receive(request)
 
-            jenkins_con.send(package_name=pkg_name)
+    except BuildPending as err:
+        if attempt >= JENKINS_RETRIES:
+            logger.warning('Build of %s still running, giving up' % err)
+            return
 
+        scheduler.call_later(JENKINS_BACKOFF * (2 ** attempt),
+            notify_jenkins_status, request, attempt + 1)
+        return
 
-    return 'Ok'
+    if build is None:
+        return
 
+    proj, status, link = build
 
-def processjenkinsircnotify(request):
-    """Process the request given so it can be daemonized"""
+    if status:
+        submit('irc', 'send', "Lubuntu CI", proj, status, link)
 
-    sleep(10)
 
-    # Get the status of the most recent build to the given project
-    proj, status, link = jenkins_con.receive(request)
+def notify_jenkins_status(request, attempt=0):
+    """Queue the lookup of the status of a build"""
 
-    if status:
-        irc_con.send("Lubuntu CI", proj, status, link)
+    dispatcher.submit('jenkins', send_jenkins_status, request, attempt)
 
 
 @app.route("/jenkinsnag", methods=["POST"])
 def jenkinsircnotify():
     """Jenkins IRC notifications"""
 
-    print("Processing request")
-    send_notification = threading.Thread(
-            target=processjenkinsircnotify, args=[request.data])
-    send_notification.setDaemon(True)
-    send_notification.start()
+    if ingest_queue is not None:
+        ingest_queue.put('jenkinsnag', request.data)
+        return 'Ok'
+
+    notify_jenkins_status(request.data)
 
     return 'Ok'
 
 
-def run():
-    irc_con.connect()
-    launchpad_con.connect()
-    t = threading.Thread(target=irc_con.listen)
-    t.daemon = True
-    t.start()
-    app.run(host="0.0.0.0", port=5000)
+# Event processors by webhook
+PROCESSORS = {
+    'commithook': process_commithook,
+    'irc': process_irc,
+    'jenkins': process_jenkins,
+}
+
+
+def process_queued(route, data):
+    """Process a request body taken from the ingestion queue"""
+
+    if route == 'jenkinsnag':
+        notify_jenkins_status(data)
+        return
+
+    PROCESSORS[route](lugito.load_event(data))
+
+
+def start_ingest_queue():
+    """Open the ingestion queue and start its workers if it is configured"""
+
+    global ingest_queue
+
+    settings = config.CONFIG.get('lugito', {})
+
+    if 'queue' not in settings:
+        return None
+
+    ingest_queue = IngestQueue(settings['queue'], GLOBAL_LOG_LEVEL,
+        max_attempts=int(settings.get('queue_attempts', MAX_ATTEMPTS)),
+        retry_delay=float(settings.get('queue_retry_delay', RETRY_DELAY)))
+    ingest_queue.start(process_queued,
+        int(settings.get('workers', DEFAULT_WORKERS)))
+
+    logger.info('Queueing requests in %s' % settings['queue'])
+    return ingest_queue
+
+
+def start_services(dry_run=False):
+    """
+    Connect to the connector services and start the background workers
+
+    Parameters
+    ----------
+
+    dry_run: bool
+       Only build the configured connectors, without connecting or starting
+       the workers, e.g. to time the startup
+
+    """
+
+    if dry_run:
+        for name in registry.configured():
+            with phase('build %s' % name):
+                registry.get(name)
+
+        return
+
+    # Only the configured connectors are built, launchpad logs in when
+    # the first bug is processed
+    if 'irc' in registry:
+        with phase('connect irc'):
+            registry.get('irc').connect()
+
+    with phase('ingest queue'):
+        start_ingest_queue()
+
+
+def run(args=None, parents=()):
+    parser = argparse.ArgumentParser(prog='lugito', parents=list(parents))
+    parser.add_argument('--server', choices=['flask', 'asgi'],
+        default='flask', help='serve the webhooks with the Flask server or'
+        ' with an ASGI server')
+    parser.add_argument('--host', default='0.0.0.0')
+    parser.add_argument('--port', type=int, default=5000)
+    args = parser.parse_args(args)
+
+    if args.server == 'asgi':
+        from lugito.asgi import run_asgi
+        run_asgi(host=args.host, port=args.port)
+        return
+
+    start_services()
+    # Requests share no state on the Lugito instance, serve them concurrently
+    app.run(host=args.host, port=args.port, threaded=True)
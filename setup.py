@@ -45,10 +45,13 @@ setup(
         " to Phabricator and provide updates",
     entry_points={
         'console_scripts': [
-            'lugito=lugito.webhooks:run',
+            'lugito=lugito.cli:main',
         ],
     },
     install_requires=requirements,
+    extras_require={
+        'asgi': ['uvicorn'],
+    },
     license="BSD license",
     long_description=readme + '\n\n' + history,
     include_package_data=True,
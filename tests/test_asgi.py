@@ -0,0 +1,256 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+# S.D.G
+
+"""
+Test the ASGI application
+"""
+
+# Imports
+import os
+import hmac
+import json
+import asyncio
+import pytest
+import lugito
+from hashlib import sha256
+from unittest.mock import MagicMock
+
+# Setup ###############################################################
+
+TEST_DIR = os.path.dirname(__file__)
+
+# Applied before the webhooks build their Lugito instance
+lugito.config.CONFIG = {
+    'phabricator': {
+        'host': 'http://127.0.0.1:9091/api/',
+        'token': 'api-nojs2ip33hmp4zn6u6cf72w7d6yh',
+        'hooks': {
+            'commithook': 'znkyfflbcia5gviqx5ybad7s6uyfywxi',
+            'irc': 'vglzi6t4gsumnilv27r27no7rs3vgs75',
+            'jenkins': 'c3b4gsumnilv27r27no7rs3vgs75vglz',
+            },
+        },
+    'connectors': {},
+}
+
+from lugito import asgi, webhooks
+from lugito.lugito import LugitoEvent
+
+FAKE_REQ_DATA = os.path.join(TEST_DIR, 'fake_req_data.json')
+
+
+def get_body(xact_phid):
+    """Get a request body with its own transaction"""
+
+    with open(FAKE_REQ_DATA, 'r') as f:
+        request_data = json.load(f)
+
+    request_data['transactions'] = [{'phid': xact_phid}]
+    return json.dumps(request_data).encode()
+
+
+def sign(hmac_key, body):
+    """Get the signature header of a request body"""
+
+    signature = hmac.new(webhooks.lugito.HMAC[hmac_key], body,
+        sha256).hexdigest()
+
+    return [(b'x-phabricator-webhook-signature', signature.encode())]
+
+
+def call(path, body=b'', method='POST', headers=()):
+    """Run a request through the application and get the sent messages"""
+
+    scope = {'type': 'http', 'path': path, 'method': method,
+        'headers': list(headers)}
+
+    # The body is split in two messages
+    messages = [
+        {'type': 'http.request', 'body': body[:10], 'more_body': True},
+        {'type': 'http.request', 'body': body[10:], 'more_body': False},
+    ]
+    sent = []
+
+    async def receive():
+        return messages.pop(0)
+
+    async def send(message):
+        sent.append(message)
+
+    asyncio.run(asgi.app(scope, receive, send))
+    return sent
+
+
+@pytest.fixture
+def load_event(monkeypatch):
+    """Replace the Conduit lookups of the events"""
+
+    event = LugitoEvent({'transactions': []}, [])
+    load_event = MagicMock(return_value=event)
+    monkeypatch.setattr(webhooks.lugito, 'load_event', load_event)
+    monkeypatch.setattr(webhooks, 'ingest_queue', None)
+
+    return load_event
+
+
+# Tests ###############################################################
+
+@pytest.mark.parametrize('path,hmac_key,process', [
+    ('/commithook', 'commithook', 'process_commithook'),
+    ('/irc', 'irc', 'process_irc'),
+    ('/jenkins', 'jenkins', 'process_jenkins'),
+])
+def test_hook(monkeypatch, load_event, path, hmac_key, process):
+    """Test each hook processes the event of a signed request"""
+
+    processed = MagicMock()
+    monkeypatch.setattr(webhooks, process, processed)
+
+    body = get_body('PHID-XACT-DREV-' + hmac_key)
+    sent = call(path, body, headers=sign(hmac_key, body))
+
+    assert(sent[0]['status'] == 200)
+    assert(sent[1]['body'] == b'Ok')
+    load_event.assert_called_once_with(body, hmac_key)
+    processed.assert_called_once_with(load_event.return_value)
+
+
+def test_jenkinsnag(monkeypatch, load_event):
+    """Test the Jenkins notifications are passed on"""
+
+    notify = MagicMock()
+    monkeypatch.setattr(webhooks, 'notify_jenkins_status', notify)
+
+    sent = call('/jenkinsnag', b'{"RESULT": "SUCCESS"}')
+
+    assert(sent[0]['status'] == 200)
+    notify.assert_called_once_with(b'{"RESULT": "SUCCESS"}')
+
+
+def test_not_found(load_event):
+    """Test an unknown path"""
+
+    sent = call('/unknown')
+
+    assert(sent[0]['status'] == 404)
+    assert(not load_event.called)
+
+
+def test_method_not_allowed(load_event):
+    """Test a hook only accepts POST"""
+
+    sent = call('/commithook', method='GET')
+
+    assert(sent[0]['status'] == 405)
+    assert(not load_event.called)
+
+
+def test_invalid_HMAC(load_event):
+    """Test a request with a wrong signature is ignored"""
+
+    body = get_body('PHID-XACT-DREV-invalid')
+    sent = call('/commithook', body, headers=sign('irc', body))
+
+    assert(sent[0]['status'] == 200)
+    assert(not load_event.called)
+
+
+def test_hook_failure(monkeypatch, load_event):
+    """Test a failing event gets an error status"""
+
+    monkeypatch.setattr(webhooks, 'process_commithook',
+        MagicMock(side_effect=ValueError('Conduit is down')))
+
+    body = get_body('PHID-XACT-DREV-failure')
+    sent = call('/commithook', body, headers=sign('commithook', body))
+
+    assert(sent[0]['status'] == 500)
+
+
+def test_hook_retry(monkeypatch):
+    """Test the retry of a delivery that failed is processed"""
+
+    monkeypatch.setattr(webhooks, 'ingest_queue', None)
+    monkeypatch.setattr(webhooks.lugito, 'get_transactions',
+        MagicMock(return_value=([], True)))
+
+    processed = MagicMock(side_effect=[ValueError('Conduit is down'), None])
+    monkeypatch.setattr(webhooks, 'process_commithook', processed)
+
+    body = get_body('PHID-XACT-DREV-retry')
+    headers = sign('commithook', body)
+
+    assert(call('/commithook', body, headers=headers)[0]['status'] == 500)
+    assert(call('/commithook', body, headers=headers)[0]['status'] == 200)
+    assert(call('/commithook', body, headers=headers)[0]['status'] == 200)
+    assert(processed.call_count == 2)
+
+
+def test_ingest_queue(monkeypatch, load_event):
+    """Test verified requests are queued once when the queue is enabled"""
+
+    queue = MagicMock()
+    monkeypatch.setattr(webhooks, 'ingest_queue', queue)
+
+    body = get_body('PHID-XACT-DREV-queued')
+    headers = sign('commithook', body)
+
+    assert(call('/commithook', body, headers=headers)[0]['status'] == 200)
+    assert(call('/commithook', body, headers=headers)[0]['status'] == 200)
+    call('/commithook', body, headers=sign('irc', body))
+    call('/jenkinsnag', b'{"RESULT": "SUCCESS"}')
+
+    assert(queue.put.call_args_list == [
+        (('commithook', body),),
+        (('jenkinsnag', b'{"RESULT": "SUCCESS"}'),),
+    ])
+    assert(not load_event.called)
+
+
+def test_lifespan(monkeypatch):
+    """Test the handler pool is started and shut down with the server"""
+
+    monkeypatch.setattr(asgi, 'executor', None)
+
+    messages = [
+        {'type': 'lifespan.startup'},
+        {'type': 'lifespan.shutdown'},
+    ]
+    sent = []
+    executors = []
+
+    async def receive():
+        executors.append(asgi.executor)
+        return messages.pop(0)
+
+    async def send(message):
+        sent.append(message)
+
+    asyncio.run(asgi.app({'type': 'lifespan'}, receive, send))
+
+    assert(sent == [
+        {'type': 'lifespan.startup.complete'},
+        {'type': 'lifespan.shutdown.complete'},
+    ])
+
+    # The pool exists once the startup completed, then is shut down
+    assert(executors[0] is None)
+    assert(executors[1] is not None)
+    assert(asgi.executor._shutdown)
+
+
+def test_start_services_dry_run(monkeypatch):
+    """Test a dry run only builds the configured connectors"""
+
+    registry = MagicMock()
+    registry.configured.return_value = ['irc', 'jenkins']
+    start_ingest_queue = MagicMock()
+    monkeypatch.setattr(webhooks, 'registry', registry)
+    monkeypatch.setattr(webhooks, 'start_ingest_queue', start_ingest_queue)
+
+    webhooks.start_services(dry_run=True)
+
+    assert(registry.get.call_args_list == [(('irc',),), (('jenkins',),)])
+    assert(not registry.get.return_value.connect.called)
+    assert(not start_ingest_queue.called)
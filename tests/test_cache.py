@@ -0,0 +1,211 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+# S.D.G
+
+"""
+Test the lookup caches
+"""
+
+# Imports
+import os
+from lugito.cache import TTLCache, HandleCache, SeenSet, get_phid_type
+
+
+class FakeTimer(object):
+    """Clock advanced by hand"""
+
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+# Tests ###############################################################
+
+def test_ttl_expiry():
+    """Test entries expire after their time to live"""
+
+    timer = FakeTimer()
+    cache = TTLCache(maxsize=10, ttl=5, timer=timer)
+
+    cache.set('key', 'value')
+    assert(cache.get('key') == 'value')
+
+    timer.now = 5
+    assert(cache.get('key') is None)
+    assert(cache.stats()['hits'] == 1)
+    assert(cache.stats()['misses'] == 1)
+    assert(cache.stats()['hit_rate'] == 0.5)
+
+
+def test_lru_eviction():
+    """Test the least recently used entry is evicted"""
+
+    cache = TTLCache(maxsize=2, ttl=60)
+
+    cache.set('a', 1)
+    cache.set('b', 2)
+
+    # Use a so that b is the least recently used
+    cache.get('a')
+    cache.set('c', 3)
+
+    assert('a' in cache)
+    assert('b' not in cache)
+    assert('c' in cache)
+    assert(len(cache) == 2)
+
+
+def test_invalidate():
+    """Test invalidating an entry"""
+
+    cache = TTLCache()
+
+    cache.set('key', 'value')
+    cache.invalidate('key')
+    cache.invalidate('missing')
+
+    assert('key' not in cache)
+
+
+def test_handle_cache_ttls():
+    """Test handles expire depending on their PHID type"""
+
+    timer = FakeTimer()
+    cache = HandleCache(ttl=10, ttls={'USER': 100}, timer=timer)
+
+    cache.set('PHID-USER-5cmhaqtkggymhvbyqdcv', {'fullName': 'AuthorName'})
+    cache.set('PHID-TASK-cn5bo6syeq6ogdrsxbbe', {'fullName': 'T1: Task'})
+
+    timer.now = 50
+    assert('PHID-USER-5cmhaqtkggymhvbyqdcv' in cache)
+    assert('PHID-TASK-cn5bo6syeq6ogdrsxbbe' not in cache)
+
+
+def test_get_phid_type():
+    """Test getting the PHID type"""
+
+    assert(get_phid_type('PHID-DREV-qxuxc6eankxb7rw7iusf') == 'DREV')
+    assert(get_phid_type('nophid') is None)
+
+
+def test_seen_set_window():
+    """Test keys are remembered within the window"""
+
+    timer = FakeTimer()
+    seen = SeenSet(window=10, timer=timer)
+
+    assert(not seen.check_and_add(['a', 'b']))
+    assert(seen.check_and_add(['a', 'b']))
+
+    # A new key in the same delivery is not a duplicate
+    assert(not seen.check_and_add(['a', 'c']))
+    assert(not seen.check_and_add([]))
+
+    timer.now = 10
+    assert(not seen.check_and_add(['a']))
+
+
+def test_seen_set_bounded():
+    """Test the oldest keys are forgotten"""
+
+    seen = SeenSet(maxsize=2)
+
+    seen.check_and_add(['a'])
+    seen.check_and_add(['b'])
+    seen.check_and_add(['c'])
+
+    assert(len(seen) == 2)
+    assert(not seen.check_and_add(['a']))
+
+
+def test_seen_set_persisted(tmpdir):
+    """Test keys survive a restart"""
+
+    path = os.path.join(str(tmpdir), 'seen.sqlite')
+
+    seen = SeenSet(path=path)
+    seen.check_and_add(['a'])
+
+    seen = SeenSet(path=path)
+    assert(seen.check_and_add(['a']))
+
+
+def test_seen_set_add():
+    """Test remembering keys without checking them"""
+
+    timer = FakeTimer()
+    seen = SeenSet(window=10, timer=timer)
+
+    assert('a' not in seen)
+
+    seen.add(['a'])
+    assert('a' in seen)
+    assert(seen.check_and_add(['a']))
+
+    timer.now = 10
+    assert('a' not in seen)
+
+
+def test_seen_set_discard(tmpdir):
+    """Test forgetting keys"""
+
+    path = os.path.join(str(tmpdir), 'seen.sqlite')
+
+    seen = SeenSet(path=path)
+    seen.add(['a', 'b'])
+    seen.discard(['a', 'c'])
+
+    assert('a' not in seen)
+
+    seen = SeenSet(path=path)
+    assert('a' not in seen)
+    assert('b' in seen)
+
+
+def test_seen_set_claim():
+    """Test a key is claimed by a single caller"""
+
+    seen = SeenSet()
+
+    assert(seen.claim('a'))
+    assert(not seen.claim('a'))
+    assert('a' not in seen)
+
+    # A released key can be claimed again
+    seen.release('a')
+    assert(seen.claim('a'))
+
+    seen.add(['a'])
+    assert(not seen.claim('a'))
+    assert(not seen.claim('a'))
+
+
+def test_seen_set_table_bounded(tmpdir):
+    """Test the table is only written when keys are added or expire"""
+
+    path = os.path.join(str(tmpdir), 'seen.sqlite')
+    timer = FakeTimer()
+
+    seen = SeenSet(maxsize=2, window=10, path=path, timer=timer)
+    seen.add(['a'])
+    changes = seen._db.total_changes
+
+    assert(seen.check_and_add(['a']))
+    assert('a' in seen)
+    assert(not seen.claim('a'))
+    assert(seen._db.total_changes == changes)
+
+    seen.add(['b'])
+    seen.add(['c'])
+
+    count = seen._db.execute('SELECT COUNT(*) FROM seen').fetchone()[0]
+    assert(count == 2)
+
+    timer.now = 10
+    assert('b' not in seen)
+
+    count = seen._db.execute('SELECT COUNT(*) FROM seen').fetchone()[0]
+    assert(count == 0)
+
@@ -0,0 +1,104 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+# S.D.G
+
+"""
+Test the shared Conduit client
+"""
+
+# Imports
+import json
+import http
+import pytest
+import lugito
+from lugito.conduit import ConduitClient, get_client
+from unittest.mock import MagicMock
+
+# Setup ###############################################################
+
+lugito.config.CONFIG = {
+    'phabricator': {
+        'host': 'http://127.0.0.1:9091/api/',
+        'token': 'api-nojs2ip33hmp4zn6u6cf72w7d6yh',
+        'hooks': {},
+        'package_names': {},
+        },
+    'connectors': {},
+}
+
+
+# Tests ###############################################################
+
+def test_get_client_shared():
+    """Test the client is created once"""
+
+    client = get_client()
+
+    assert(isinstance(client, ConduitClient))
+    assert(client is get_client())
+    assert(client.host == 'http://127.0.0.1:9091/api/')
+    assert(client.token == 'api-nojs2ip33hmp4zn6u6cf72w7d6yh')
+
+
+def test_request_uses_session():
+    """Test Conduit calls are sent through the pooled session"""
+
+    client = ConduitClient('http://127.0.0.1:9091/api/', 'sometoken')
+    client.session = MagicMock()
+    client.session.post.return_value.status_code = 200
+    client.session.post.return_value.text = json.dumps({
+        'result': {'PHID-USER-1': {'fullName': 'AuthorName'}},
+        'error_code': None,
+        'error_info': None,
+    })
+
+    result = client.phid.query(phids=['PHID-USER-1'])
+
+    assert(result['PHID-USER-1']['fullName'] == 'AuthorName')
+
+    path = client.session.post.call_args[0][0]
+    params = json.loads(client.session.post.call_args[1]['data']['params'])
+    assert(path == 'http://127.0.0.1:9091/api/phid.query')
+    assert(params['phids'] == ['PHID-USER-1'])
+    assert(params['__conduit__'] == {'token': 'sometoken'})
+
+    # Nested methods resolve to the full method name
+    client.transaction.search(objectIdentifier='PHID-DREV-1')
+    path = client.session.post.call_args[0][0]
+    assert(path == 'http://127.0.0.1:9091/api/transaction.search')
+
+
+def test_request_bad_status():
+    """Test a bad response status raises an HTTPException"""
+
+    client = ConduitClient('http://127.0.0.1:9091/api/', 'sometoken')
+    client.session = MagicMock()
+    client.session.post.return_value.status_code = 500
+
+    with pytest.raises(http.client.HTTPException):
+        client.phid.query(phids=['PHID-USER-1'])
+
+
+def test_request_validates_arguments():
+    """Test the arguments are checked before the request"""
+
+    client = ConduitClient('http://127.0.0.1:9091/api/', 'sometoken')
+    client.session = MagicMock()
+
+    with pytest.raises(ValueError):
+        client.phid.query()
+
+    with pytest.raises(ValueError):
+        client.phid.query(phids='PHID-USER-1')
+
+    assert(not client.session.post.called)
+
+
+def test_session_retries():
+    """Test failed connections are retried"""
+
+    client = ConduitClient('http://127.0.0.1:9091/api/', 'sometoken')
+    adapter = client.session.get_adapter('http://127.0.0.1:9091/api/')
+
+    assert(adapter.max_retries.total == 3)
+    assert('POST' in adapter.max_retries.allowed_methods)
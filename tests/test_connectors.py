@@ -0,0 +1,118 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+# S.D.G
+
+"""
+Test connector registry
+"""
+
+# Imports
+import sys
+import lugito
+import pytest
+from lugito.connectors import ConnectorRegistry, CONNECTORS, register,\
+    get_connector_class
+
+
+class FakeConnector(object):
+
+    instances = 0
+
+    def __init__(self, log_level, **kwargs):
+        FakeConnector.instances += 1
+        self.log_level = log_level
+        self.kwargs = kwargs
+
+
+# Tests ###############################################################
+
+def test_configured(monkeypatch):
+    """Test only the configured connectors are available"""
+
+    monkeypatch.setattr(lugito.config, 'CONFIG', {'connectors': {
+        'irc': {},
+        'unknown': {},
+        'custom': {'class': 'test_connectors:FakeConnector'},
+    }})
+
+    registry = ConnectorRegistry()
+
+    assert(sorted(registry.configured()) == ['custom', 'irc'])
+    assert('irc' in registry)
+    assert('jenkins' not in registry)
+
+    with pytest.raises(KeyError):
+        registry.get('jenkins')
+
+
+def test_get_lazy(monkeypatch):
+    """Test connectors are built once on first use"""
+
+    monkeypatch.setattr(lugito.config, 'CONFIG', {'connectors': {
+        'fake': {},
+    }})
+    monkeypatch.setitem(CONNECTORS, 'fake', 'test_connectors:FakeConnector')
+    FakeConnector.instances = 0
+
+    registry = ConnectorRegistry(log_level=10)
+
+    assert(registry.loaded('fake') is None)
+    assert(FakeConnector.instances == 0)
+
+    connector = registry.get('fake')
+
+    assert(isinstance(connector, FakeConnector))
+    assert(connector.log_level == 10)
+    assert(registry.get('fake') is connector)
+    assert(registry.loaded('fake') is connector)
+    assert(FakeConnector.instances == 1)
+
+
+def test_get_kwargs(monkeypatch):
+    """Test connectors are built with their extra keyword arguments"""
+
+    monkeypatch.setattr(lugito.config, 'CONFIG', {'connectors': {
+        'fake': {},
+    }})
+    monkeypatch.setitem(CONNECTORS, 'fake', 'test_connectors:FakeConnector')
+
+    scheduler = object()
+    registry = ConnectorRegistry(kwargs={'fake': {'scheduler': scheduler}})
+
+    assert(registry.get('fake').kwargs == {'scheduler': scheduler})
+
+
+def test_register(monkeypatch):
+    """Test registering a connector class"""
+
+    monkeypatch.setattr(lugito.config, 'CONFIG', {})
+    monkeypatch.setattr(sys.modules['lugito.connectors'], 'CONNECTORS',
+        dict(CONNECTORS))
+
+    register('fake', 'test_connectors:FakeConnector')
+
+    assert(get_connector_class('fake') is FakeConnector)
+
+
+def test_reexports(monkeypatch):
+    """Test the connector classes are available from the package"""
+
+    monkeypatch.setattr(lugito.config, 'CONFIG', {})
+
+    # As if the module wasn't imported yet
+    package = sys.modules['lugito.connectors']
+    monkeypatch.delitem(sys.modules, 'lugito.connectors.jenkins')
+    monkeypatch.delattr(package, 'jenkins', raising=False)
+
+    from lugito.connectors import jenkins
+
+    assert(isinstance(jenkins, type))
+    assert(jenkins is sys.modules['lugito.connectors.jenkins'].jenkins)
+    assert(package.jenkins is jenkins)
+
+    # Building the connector keeps the class
+    monkeypatch.delattr(package, 'jenkins')
+    assert(get_connector_class('jenkins') is package.jenkins)
+
+    with pytest.raises(ImportError):
+        from lugito.connectors import missing
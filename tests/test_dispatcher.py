@@ -0,0 +1,126 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+# S.D.G
+
+"""
+Test the connector dispatcher
+"""
+
+# Imports
+import time
+import threading
+import lugito
+from lugito.dispatcher import Dispatcher, Scheduler
+
+# Tests ###############################################################
+
+def test_concurrency(monkeypatch):
+    """Test reading the concurrency of each connector"""
+
+    monkeypatch.setitem(lugito.config.CONFIG['connectors'], 'launchpad',
+        {'concurrency': '3'})
+
+    obj = Dispatcher()
+
+    assert(obj.get_concurrency('launchpad') == 3)
+    assert(obj.get_concurrency('irc') == 1)
+    assert(obj.get_concurrency('unknown') == 2)
+
+
+def test_slow_connector_isolated():
+    """Test a blocked connector doesn't hold up the others"""
+
+    obj = Dispatcher()
+    release = threading.Event()
+
+    blocked = obj.submit('launchpad', release.wait, 5)
+    result = obj.submit('irc', lambda x: x * 2, 21)
+
+    assert(result.result(timeout=5) == 42)
+    assert(not blocked.done())
+    assert(obj.pending('launchpad') == 1)
+
+    release.set()
+    obj.shutdown()
+
+    assert(obj.pending() == {'launchpad': 0, 'irc': 0})
+
+
+def test_failure_logged():
+    """Test a failing call doesn't stop the connector pool"""
+
+    obj = Dispatcher()
+
+    def fail():
+        raise ValueError('failed')
+
+    failed = obj.submit('jenkins', fail)
+    result = obj.submit('jenkins', lambda: 'ok')
+
+    assert(isinstance(failed.exception(timeout=5), ValueError))
+    assert(result.result(timeout=5) == 'ok')
+    obj.shutdown()
+
+
+def test_scheduler_order():
+    """Test scheduled calls run in the order of their delay"""
+
+    obj = Scheduler()
+    done = threading.Event()
+    calls = []
+
+    obj.call_later(0.1, calls.append, 'third')
+    obj.call_later(0, calls.append, 'first')
+    obj.call_later(0.05, calls.append, 'second')
+    cancelled = obj.call_later(0.02, calls.append, 'cancelled')
+    obj.call_later(0.15, done.set)
+
+    obj.cancel(cancelled)
+
+    assert(done.wait(5))
+    assert(calls == ['first', 'second', 'third'])
+    assert(len(obj) == 0)
+
+    obj.shutdown()
+
+
+def test_scheduler_failure():
+    """Test a failing call doesn't stop the scheduler"""
+
+    obj = Scheduler()
+    done = threading.Event()
+
+    obj.call_later(0, lambda: 1 / 0)
+    obj.call_later(0.01, done.set)
+
+    assert(done.wait(5))
+
+    obj.shutdown()
+
+
+def test_scheduler_shutdown():
+    """Test pending calls are dropped on shutdown"""
+
+    obj = Scheduler()
+    calls = []
+
+    obj.call_later(60, calls.append, 'late')
+    assert(len(obj) == 1)
+
+    started = time.monotonic()
+    obj.shutdown()
+
+    assert(time.monotonic() - started < 5)
+    assert(calls == [])
+
+
+def test_logger_handlers():
+    """Test the handler of the logger is only added once"""
+
+    Dispatcher()
+    Scheduler()
+    dispatcher = Dispatcher()
+    scheduler = Scheduler()
+
+    assert(len(dispatcher.logger.handlers) == 1)
+    assert(len(scheduler.logger.handlers) == 1)
@@ -0,0 +1,141 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+# S.D.G
+
+"""
+Test the webhook ingestion queue
+"""
+
+# Imports
+import os
+import time
+import sqlite3
+import threading
+from lugito.ingest import IngestQueue
+
+
+# Tests ###############################################################
+
+def test_put_claim_ack():
+    """Test payloads are handed out in order"""
+
+    queue = IngestQueue(':memory:')
+
+    first = queue.put('irc', b'{"first": 1}')
+    second = queue.put('commithook', b'{"second": 2}')
+
+    assert(len(queue) == 2)
+    assert(queue.claim(timeout=0) == (first, 'irc', b'{"first": 1}'))
+    assert(queue.claim(timeout=0) == (second, 'commithook', b'{"second": 2}'))
+    assert(queue.claim(timeout=0) is None)
+
+    queue.ack(first)
+    queue.ack(second)
+    assert(len(queue) == 0)
+
+
+def test_recover_after_restart(tmpdir):
+    """Test unacknowledged payloads survive a restart"""
+
+    path = os.path.join(str(tmpdir), 'queue.sqlite')
+
+    queue = IngestQueue(path)
+    event_id = queue.put('irc', b'{}')
+    queue.put('jenkins', b'{}')
+    queue.claim(timeout=0)
+
+    queue = IngestQueue(path)
+
+    assert(len(queue) == 2)
+    assert(queue.claim(timeout=0) == (event_id, 'irc', b'{}'))
+
+
+def test_workers():
+    """Test the workers drain the queue"""
+
+    queue = IngestQueue(':memory:', max_attempts=2, retry_delay=0.1)
+    done = threading.Event()
+    received = []
+
+    def handler(route, data):
+        received.append((route, data))
+
+        if route == 'fail':
+            if received.count(('fail', b'{}')) == 2:
+                done.set()
+            raise ValueError('bad payload')
+
+    queue.start(handler, workers=2)
+    queue.put('fail', b'{}')
+    queue.put('irc', b'{}')
+
+    assert(done.wait(5))
+    queue.stop()
+
+    # The failing payload is retried then given up
+    assert(('irc', b'{}') in received)
+    assert(received.count(('fail', b'{}')) == 2)
+    assert(len(queue) == 0)
+    assert(queue.failed_count() == 1)
+
+
+def test_retry():
+    """Test a failed payload is retried after a growing delay"""
+
+    queue = IngestQueue(':memory:', max_attempts=3, retry_delay=10)
+
+    event_id = queue.put('irc', b'{}')
+    assert(queue.claim(timeout=0) == (event_id, 'irc', b'{}'))
+
+    retry_at = queue.fail(event_id)
+    assert(9 < retry_at - time.time() <= 10)
+
+    # Not handed out before the retry
+    assert(queue.claim(timeout=0.05) is None)
+    assert(len(queue) == 1)
+
+    queue._db.execute('UPDATE events SET retry_at = 0')
+    assert(queue.claim(timeout=0) == (event_id, 'irc', b'{}'))
+
+    retry_at = queue.fail(event_id)
+    assert(19 < retry_at - time.time() <= 20)
+
+    queue._db.execute('UPDATE events SET retry_at = 0')
+    queue.claim(timeout=0)
+
+    assert(queue.fail(event_id) is None)
+    assert(len(queue) == 0)
+    assert(queue.failed_count() == 1)
+
+
+def test_retry_wakes_up():
+    """Test a waiting claim gets the payload once its delay is over"""
+
+    queue = IngestQueue(':memory:', retry_delay=0.1)
+
+    event_id = queue.put('irc', b'{}')
+    queue.claim(timeout=0)
+    queue.fail(event_id)
+
+    assert(queue.claim(timeout=5) == (event_id, 'irc', b'{}'))
+
+
+def test_upgrade(tmpdir):
+    """Test opening a queue created before the retries"""
+
+    path = os.path.join(str(tmpdir), 'queue.sqlite')
+
+    db = sqlite3.connect(path)
+    db.execute('CREATE TABLE events (id INTEGER PRIMARY KEY AUTOINCREMENT, '
+        'route TEXT NOT NULL, data BLOB NOT NULL, received REAL NOT NULL, '
+        'claimed INTEGER NOT NULL DEFAULT 0)')
+    db.execute("INSERT INTO events (route, data, received) "
+        "VALUES ('irc', x'7b7d', 0)")
+    db.commit()
+    db.close()
+
+    queue = IngestQueue(path)
+    event_id, route, data = queue.claim(timeout=0)
+
+    assert(queue.fail(event_id) is not None)
+    assert(len(queue) == 1)
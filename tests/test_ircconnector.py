@@ -12,7 +12,13 @@ import json
 import phabricator
 import lugito
 import pytest
+import sys
+import time
+import asyncio
+import threading
 from lugito.connectors import irc
+from lugito.connectors.irc import TokenBucket, LineBuffer, parse_message,\
+    get_backoff, BACKOFF_BASE, BACKOFF_MAX
 # docEbrown - 20181120
 # There is a bug in inspect.unwrap preventing the import of call directly
 import unittest.mock
@@ -46,6 +52,30 @@ lugito.config.CONFIG = {
     },
 }
 
+TASK_SEARCH = {
+    'data': [{
+        'id': 154,
+        'phid': 'PHID-TASK-ciqyu6qo3ev6hjnbc5ph',
+        'fields': {
+            'name': 'Fix shortcuts related to Super key',
+            'status': {'value': 'open', 'name': 'Open'},
+            'priority': {'value': 100, 'name': 'Unbreak Now!',
+                'color': 'pink'},
+        },
+    }],
+}
+
+DIFF_SEARCH = {
+    'data': [{
+        'id': 24,
+        'phid': 'PHID-DREV-gtrvxhnlhh4ne6p5nbj5',
+        'fields': {
+            'title': 'Some diff title',
+            'status': {'value': 'published', 'name': 'Closed'},
+        },
+    }],
+}
+
 
 # Tests ###############################################################
 
@@ -107,25 +137,60 @@ def test_send_kwargs(phab_mock):
         '\x033[\x03\x0313objectstr\x03\x033]\x03 \x0315who\x03 body: \x032link\x03')
 
 
+def run_session(obj, chunks, until):
+    """Run an IRC session fed with chunks until a condition holds"""
+
+    async def session():
+        reader = asyncio.StreamReader()
+        writer = MagicMock()
+
+        async def drain():
+            pass
+
+        writer.drain = drain
+        obj._outbound_ready = asyncio.Event()
+        obj._outbound_ready.set()
+
+        for chunk in chunks:
+            reader.feed_data(chunk)
+
+        task = asyncio.ensure_future(obj._session(reader, writer))
+
+        for _ in range(100):
+            if until():
+                break
+            await asyncio.sleep(0.01)
+
+        reader.feed_eof()
+        await task
+
+    loop = asyncio.new_event_loop()
+    try:
+        loop.run_until_complete(session())
+    finally:
+        loop.close()
+
+
 def test_connect():
     """Test connect"""
 
     obj = irc(sleep_delay=0)
-
     obj._send_raw = MagicMock()
-    obj._setup_connection = MagicMock()
-    obj.conn = MagicMock()
 
-    obj.conn.recv.side_effect = [
-        b'No Ident response',
-        b'You are now identified',
-        b'477',
-        b'433',
-        b'PING: something',
-        b'366',
-    ]
-
-    obj.connect()
+    joined = []
+    obj._joined.set = lambda: joined.append(True)
+
+    # Lines may be split across chunks
+    run_session(obj, [
+        b':irc.server NOTICE * :*** No Ident response\r\n:NickS',
+        b'erv!NickServ@services. NOTICE someusername :You are now identified'
+        b' for someusername.\r\n',
+        b':irc.server 477 someusername #somechannel :Cannot join channel\r\n'
+        b':irc.server 433 * someusername :Nickname is already in use\r\n',
+        b'PING :something\r\n',
+        b':irc.server 366 someusername1 #somechannel :End of /NAMES list.\r\n',
+    ], until=lambda: obj._send_raw.call_args_list.count(
+        unittest.mock.call('JOIN #somechannel\r\n')) == 2)
 
     # No Ident response results
     assert(unittest.mock.call('NICK someusername1\r\n') in\
@@ -146,9 +211,24 @@ def test_connect():
         obj._send_raw.call_args_list)
 
     # Ping
-    assert(unittest.mock.call('PONG : something\r\n') in\
+    assert(unittest.mock.call('PONG :something\r\n') in\
         obj._send_raw.call_args_list)
 
+    assert(joined)
+
+    # The session ended with the connection
+    assert(not obj.connected)
+
+
+def test_backoff():
+    """Test the reconnection delay grows up to the maximum"""
+
+    for attempt in range(12):
+        delay = get_backoff(attempt)
+        limit = min(BACKOFF_MAX, BACKOFF_BASE * (2 ** attempt))
+
+        assert(limit / 2 <= delay <= limit)
+
 
 # docEbrown - 20181120
 # Address including anchors in reference
@@ -160,24 +240,17 @@ def test_get_task_info_with_anchor():
 
     obj.send_notice = MagicMock()
     obj.phab = MagicMock()
-    obj.phab.maniphest.info = MagicMock(
-        return_value={
-            'priorityColor': 'pink',
-            'statusName': 'Open',
-            'title': 'Fix shortcuts related to Super key',
-            'uri': 'https://phab.lubuntu.me/T154'
-        }
-    )
+    obj.phab.maniphest.search = MagicMock(return_value=TASK_SEARCH)
 
     link_with_anchor = 'https://phab.lubuntu.me/T154#3228'
     obj.get_task_info(link_with_anchor)
 
-    assert(unittest.mock.call(task_id=154) in\
-        obj.phab.maniphest.info.call_args_list)
+    assert(unittest.mock.call(constraints={'ids': [154]}) in\
+        obj.phab.maniphest.search.call_args_list)
     assert(obj.send_notice.call_args == \
         unittest.mock.call('\x033[\x03\x035Unbreak Now!, Open\x03\x033]\x03 '
             'Fix shortcuts related to Super key: '\
-            '\x032https://phab.lubuntu.me/T154#3228\x03'))
+            '\x032http://127.0.0.1:9091/T154#3228\x03'))
 
 
 def test_get_diff_info_with_anchor():
@@ -187,23 +260,90 @@ def test_get_diff_info_with_anchor():
 
     obj.send_notice = MagicMock()
     obj.phab = MagicMock()
-    obj.phab.differential.query = MagicMock(
-        return_value=[{
-            'statusName': 'Closed',
-            'title': 'Some diff title',
-            'uri': 'https://phab.lubuntu.me/D24'
-        },]
-    )
+    obj.phab.differential.revision.search = MagicMock(
+        return_value=DIFF_SEARCH)
 
     link_with_anchor = 'https://phab.lubuntu.me/D24#123'
     obj.get_task_info(link_with_anchor)
 
-    assert(unittest.mock.call(ids=[24]) in\
-        obj.phab.differential.query.call_args_list)
+    assert(unittest.mock.call(constraints={'ids': [24]}) in\
+        obj.phab.differential.revision.search.call_args_list)
     assert(obj.send_notice.call_args == \
         unittest.mock.call('\x033[\x03Closed\x03\x033]\x03 '
             'Some diff title: '\
-            '\x032https://phab.lubuntu.me/D24#123\x03'))
+            '\x032http://127.0.0.1:9091/D24#123\x03'))
+
+
+def test_get_task_info_cached():
+    """Test summaries are cached until invalidated"""
+
+    obj = irc()
+
+    obj.send_notice = MagicMock()
+    obj.phab = MagicMock()
+    obj.phab.maniphest.search = MagicMock(return_value=TASK_SEARCH)
+
+    obj.get_task_info('T154')
+    obj.get_task_info('https://phab.lubuntu.me/T154#3228')
+
+    assert(obj.phab.maniphest.search.call_count == 1)
+    assert(obj.send_notice.call_args_list == [
+        unittest.mock.call('\x033[\x03\x035Unbreak Now!, Open\x03\x033]\x03 '
+            'Fix shortcuts related to Super key: '\
+            '\x032http://127.0.0.1:9091/T154\x03'),
+        unittest.mock.call('\x033[\x03\x035Unbreak Now!, Open\x03\x033]\x03 '
+            'Fix shortcuts related to Super key: '\
+            '\x032http://127.0.0.1:9091/T154#3228\x03'),
+    ])
+
+    stats = obj.info_stats()
+    assert(stats['hits'] == 1)
+    assert(stats['misses'] == 1)
+    assert(stats['hit_rate'] == 0.5)
+
+    # The task changed
+    obj.invalidate_info('T154')
+    obj.get_task_info('T154')
+
+    assert(obj.phab.maniphest.search.call_count == 2)
+
+
+def test_get_tasks_info_batched():
+    """Test references are looked up with one search per type in order"""
+
+    obj = irc()
+
+    obj.send_notice = MagicMock()
+    obj.phab = MagicMock()
+    obj.phab.maniphest.search = MagicMock(return_value={'data': [
+        {'id': 1, 'fields': {'name': 'One', 'status': {'name': 'Open'},
+            'priority': {'color': 'red'}}},
+        {'id': 2, 'fields': {'name': 'Two', 'status': {'name': 'Open'},
+            'priority': {'color': 'yellow'}}},
+    ]})
+    obj.phab.differential.revision.search = MagicMock(
+        return_value=DIFF_SEARCH)
+
+    obj.bot('someusername: info T2 D24, T1 T2 Tblah T3', 'info')
+
+    obj.phab.maniphest.search.assert_called_once_with(
+        constraints={'ids': [1, 2, 3]})
+    obj.phab.differential.revision.search.assert_called_once_with(
+        constraints={'ids': [24]})
+
+    assert(obj.send_notice.call_args_list == [
+        unittest.mock.call('\x033[\x03\x038Low, Open\x03\x033]\x03 Two: '
+            '\x032http://127.0.0.1:9091/T2\x03'),
+        unittest.mock.call('\x033[\x03Closed\x03\x033]\x03 '
+            'Some diff title: \x032http://127.0.0.1:9091/D24\x03'),
+        unittest.mock.call('\x033[\x03\x034High, Open\x03\x033]\x03 One: '
+            '\x032http://127.0.0.1:9091/T1\x03'),
+        unittest.mock.call('\x033[\x03\x038Low, Open\x03\x033]\x03 Two: '
+            '\x032http://127.0.0.1:9091/T2\x03'),
+        unittest.mock.call('\x034Error: T3 is an invalid task '
+            'reference.\x03'),
+    ])
+
 
 def test_get_task_info_with_error_anchor():
     """Test getting task info with anchor"""
@@ -212,7 +352,7 @@ def test_get_task_info_with_error_anchor():
 
     obj.send_notice = MagicMock()
     obj.phab = MagicMock()
-    obj.phab.maniphest.info = MagicMock(side_effect=ValueError(''))
+    obj.phab.maniphest.search = MagicMock(return_value={'data': []})
 
     link_with_anchor = 'https://phab.lubuntu.me/T154#3228'
 
@@ -229,12 +369,227 @@ def test_get_task_info_with_error_no_anchor():
 
     obj.send_notice = MagicMock()
     obj.phab = MagicMock()
-    obj.phab.maniphest.info = MagicMock(side_effect=ValueError(''))
 
-    link_with_anchor = 'https://phab.lubuntu.me/T154'
+    link_with_anchor = 'https://phab.lubuntu.me/Tblah'
 
     obj.get_task_info(link_with_anchor)
 
+    assert(not obj.phab.maniphest.search.called)
     assert(obj.send_notice.call_args ==
-        unittest.mock.call('\x034Error: https://phab.lubuntu.me/T154'\
+        unittest.mock.call('\x034Error: https://phab.lubuntu.me/Tblah'\
             ' is an invalid task reference.\x03'))
+
+
+def test_token_bucket():
+    """Test the token bucket allows a burst then the sustained rate"""
+
+    now = [0.0]
+    bucket = TokenBucket(rate=2.0, burst=2, timer=lambda: now[0])
+
+    assert(bucket.consume() == 0)
+    assert(bucket.consume() == 0)
+    assert(bucket.consume() == 0.5)
+
+    # The reserved token becomes available after half a second
+    now[0] = 0.5
+    assert(bucket.consume() == 0.5)
+
+    now[0] = 10
+    assert(bucket.consume() == 0)
+
+
+def test_send_notice_queued():
+    """Test notices are queued until the channel is joined"""
+
+    obj = irc()
+    obj._send_raw = MagicMock()
+
+    obj.send_notice('message')
+    assert(obj.queue_depth() == 1)
+    assert(not obj._send_raw.called)
+
+    # The connection is lost before joining, the notice is kept
+    run_session(obj, [b'NOTICE * :*** Looking up your hostname\r\n'],
+        until=lambda: False)
+
+    assert(obj.queue_depth() == 1)
+    assert(obj.sent == 0)
+
+    # And sent once joined after reconnecting
+    run_session(obj, [
+        b':irc.server 366 someusername #somechannel :End of /NAMES list.\r\n',
+    ], until=lambda: obj.queue_depth() == 0)
+
+    obj._send_raw.assert_called_with('NOTICE #somechannel :message\r\n')
+    assert(obj.queue_depth() == 0)
+    assert(obj.sent == 1)
+
+
+def test_line_buffer():
+    """Test partial lines are kept until completed"""
+
+    lines = LineBuffer()
+
+    assert(lines.feed(b'PING :one\r\nPRIVMSG #chan :par') == ['PING :one'])
+    assert(lines.feed(b'tial\r') == [])
+    assert(lines.feed(b'\n') == ['PRIVMSG #chan :partial'])
+
+
+def test_parse_message():
+    """Test parsing IRC lines"""
+
+    message = parse_message(':irc.server 366 nick #chan :End of /NAMES list.')
+    assert(message.prefix == 'irc.server')
+    assert(message.command == '366')
+    assert(message.params == ['nick', '#chan', 'End of /NAMES list.'])
+
+    message = parse_message('PING :something')
+    assert(message.prefix is None)
+    assert(message.command == 'PING')
+    assert(message.params == ['something'])
+
+
+def test_session_dispatch():
+    """Test messages are dispatched by command once joined"""
+
+    obj = irc()
+    obj._send_raw = MagicMock()
+    obj.bot = MagicMock()
+
+    run_session(obj, [
+        b':irc.server 366 someusername #somechannel :End of /NAMES list.\r\n'
+        b'PING :token\r\n:nick!u@h PRIVMSG #somechannel :someusername: in',
+        b'fo T1\r\n:nick!u@h PRIVMSG #somechannel :see '
+        b'http://127.0.0.1:9091/T2\r\n:nick!u@h PRIVMSG #somechannel :PING\r\n',
+    ], until=lambda: obj.bot.call_count == 2)
+
+    obj._send_raw.assert_called_once_with('PONG :token\r\n')
+    assert(sorted(obj.bot.call_args_list) == [
+        unittest.mock.call('see http://127.0.0.1:9091/T2', 'link'),
+        unittest.mock.call('someusername: info T1', 'info'),
+    ])
+
+
+def test_session_bot_error():
+    """Test the errors of the answers are logged"""
+
+    obj = irc()
+    obj._send_raw = MagicMock()
+    obj.bot = MagicMock(side_effect=ValueError('Conduit is down'))
+    obj.logger = MagicMock()
+
+    run_session(obj, [
+        b':irc.server 366 someusername #somechannel :End of /NAMES list.\r\n'
+        b':nick!u@h PRIVMSG #somechannel :someusername: info T1\r\n',
+    ], until=lambda: obj.logger.error.called)
+
+    assert(isinstance(obj.logger.error.call_args[1]['exc_info'],
+        ValueError))
+
+
+def test_run_handler_error(monkeypatch):
+    """Test the client reconnects after an unexpected error"""
+
+    obj = irc()
+    monkeypatch.setattr(sys.modules['lugito.connectors.irc'], 'get_backoff',
+        lambda attempt: 0)
+
+    sessions = []
+
+    async def open_connection():
+        return MagicMock(), MagicMock()
+
+    async def session(reader, writer):
+        sessions.append(reader)
+
+        if len(sessions) == 1:
+            raise ValueError('bad handler')
+
+        # Stop the client
+        raise asyncio.CancelledError()
+
+    obj._open_connection = open_connection
+    obj._session = session
+
+    loop = asyncio.new_event_loop()
+    try:
+        with pytest.raises(asyncio.CancelledError):
+            loop.run_until_complete(obj._run())
+    finally:
+        loop.close()
+
+    assert(len(sessions) == 2)
+
+
+def start_loop(obj):
+    """Run the event loop of a client in a thread"""
+
+    obj.loop = asyncio.new_event_loop()
+    thread = threading.Thread(target=obj.loop.run_forever)
+    thread.daemon = True
+    thread.start()
+
+    return thread
+
+
+def stop_loop(obj, thread):
+
+    obj.loop.call_soon_threadsafe(obj.loop.stop)
+    thread.join()
+    obj.loop.close()
+
+
+def test_coalesce():
+    """Test events of an author are merged into a digest"""
+
+    obj = irc()
+    obj.send_notice = MagicMock()
+    obj.coalesce_window = 0.1
+    thread = start_loop(obj)
+
+    for number in range(12):
+        obj.send('T{}: Task {}'.format(number, number), 'who',
+            'edited the task', 'link')
+    obj.send('T1: Task 1', 'who', 'commented on the task', 'link1')
+    obj.send('T1: Task 1', 'other', 'edited the task', 'link2')
+
+    time.sleep(0.3)
+    stop_loop(obj, thread)
+
+    assert(sorted(obj.send_notice.call_args_list) == sorted([
+        unittest.mock.call('\x033[\x03\x031312 updates\x03\x033]\x03 '
+            '\x0315who\x03 edited the task: T0, T1, T2, T3, T4, T5, T6, T7, '
+            'T8, T9 and 2 more'),
+        unittest.mock.call('\x033[\x03\x0313T1: Task 1\x03\x033]\x03 '
+            '\x0315who\x03 commented on the task: \x032link1\x03'),
+        unittest.mock.call('\x033[\x03\x0313T1: Task 1\x03\x033]\x03 '
+            '\x0315other\x03 edited the task: \x032link2\x03'),
+    ]))
+
+
+def test_coalesce_max_delay():
+    """Test a steady stream of events is sent within the maximum delay"""
+
+    obj = irc()
+    obj.send_notice = MagicMock()
+    obj.coalesce_window = 0.1
+    obj.coalesce_max_delay = 0.2
+    thread = start_loop(obj)
+
+    # Each event arrives before the window of the previous one closes
+    for number in range(10):
+        obj.send('T{}: Task'.format(number), 'who', 'edited the task', 'l')
+        time.sleep(0.05)
+
+    time.sleep(0.3)
+    stop_loop(obj, thread)
+
+    # Every event is sent, in more than one message
+    sent = 0
+    for call in obj.send_notice.call_args_list:
+        head = call[0][0].split('\x0313')[1].split()
+
+        sent += int(head[0]) if head[1] == 'updates\x03\x033]\x03' else 1
+
+    assert(obj.send_notice.call_count > 1)
+    assert(sent == 10)
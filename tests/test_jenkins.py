@@ -0,0 +1,276 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+# S.D.G
+
+"""
+Test jenkins connector
+"""
+
+# Imports
+import json
+import time
+import threading
+import lugito
+import pytest
+from lugito.connectors.jenkins import jenkins, BuildPending
+from unittest.mock import MagicMock
+
+# Setup ###############################################################
+
+CONFIG = {
+    'phabricator': {
+        'host': 'http://127.0.0.1:9091/api/',
+        'token': 'api-nojs2ip33hmp4zn6u6cf72w7d6yh',
+        'hooks': {},
+        'package_names': {
+            'rlugito': 'lugito',
+            },
+        },
+    'connectors': {
+        'jenkins': {
+            'site': 'https://ci.lubuntu.me',
+            'template_url': 'https://phab.lubuntu.me/source/PACKAGE.git',
+            'user': 'someuser',
+            'api_key': 'somekey',
+        },
+    },
+}
+
+
+@pytest.fixture
+def obj(monkeypatch):
+    """A jenkins connector with a mocked API session"""
+
+    monkeypatch.setattr(lugito.config, 'CONFIG', CONFIG)
+
+    obj = jenkins()
+    obj._session = MagicMock()
+    obj._session.get.return_value.status_code = 200
+
+    return obj
+
+
+def api_builds(obj, *builds):
+    """Make the API return builds of (number, result, building)"""
+
+    obj._session.get.return_value.json.return_value = {'builds': [
+        {'number': number, 'result': result, 'building': building,
+            'url': 'https://ci.lubuntu.me/job/lugito/%d/' % number}
+        for number, result, building in builds]}
+
+
+# Tests ###############################################################
+
+def test_lazy_auth(monkeypatch):
+    """Test creating the session on first use"""
+
+    monkeypatch.setattr(lugito.config, 'CONFIG', CONFIG)
+
+    obj = jenkins()
+
+    assert(obj._session is None)
+    assert(obj.session.auth == ('someuser', 'somekey'))
+    assert(obj.session is obj.session)
+
+
+def test_get_builds(obj):
+    """Test the builds are fetched with one filtered request"""
+
+    api_builds(obj, (3, None, True), (2, 'SUCCESS', False))
+
+    builds = obj.get_builds('lugito')
+
+    obj._session.get.assert_called_once_with(
+        'https://ci.lubuntu.me/job/lugito/api/json',
+        params={'tree': 'builds[number,result,url,building]{0,3}'},
+        timeout=30)
+    assert(builds[3].building)
+    assert(builds[2].result == 'SUCCESS')
+
+    # Only the completed build is cached
+    assert(obj.get_cached_build('lugito', 3) is None)
+    assert(obj.get_cached_build('lugito', 2) == builds[2])
+
+
+def test_get_builds_quoted(obj, monkeypatch):
+    """Test the job name is quoted and the timeout configurable"""
+
+    monkeypatch.setitem(CONFIG['connectors']['jenkins'], 'timeout', '5')
+    obj = jenkins()
+    obj._session = MagicMock()
+    obj._session.get.return_value.status_code = 404
+
+    assert(obj.get_builds('lugito tests/ä') is None)
+
+    obj._session.get.assert_called_once_with(
+        'https://ci.lubuntu.me/job/lugito%20tests%2F%C3%A4/api/json',
+        params={'tree': 'builds[number,result,url,building]{0,3}'},
+        timeout=5.0)
+
+
+def test_receive_payload(obj):
+    """Test using the build details of the request"""
+
+    status = obj.receive(json.dumps({
+        'PROJECT': 'lugito',
+        'BUILD_NUMBER': '2',
+        'RESULT': 'FAILURE',
+        'PREVIOUS_RESULT': 'SUCCESS',
+        'BUILD_URL': 'https://ci.lubuntu.me/job/lugito/2/',
+    }))
+
+    assert(status == ('lugito', '\x034just failed after succeeding\x03',
+        'https://ci.lubuntu.me/job/lugito/2/'))
+    assert(not obj._session.get.called)
+
+
+def test_receive_cached(obj):
+    """Test the previous build is fetched once then cached"""
+
+    api_builds(obj, (3, 'SUCCESS', False), (2, 'SUCCESS', False))
+
+    status = obj.receive(json.dumps({
+        'PROJECT': 'lugito',
+        'BUILD_NUMBER': 3,
+        'RESULT': 'SUCCESS',
+        'BUILD_URL': 'https://ci.lubuntu.me/job/lugito/3/',
+    }))
+
+    assert(status == ('lugito', None, 'https://ci.lubuntu.me/job/lugito/3/'))
+    assert(obj._session.get.call_count == 1)
+
+    # The next build uses the cached result of build 3
+    status = obj.receive(json.dumps({
+        'PROJECT': 'lugito',
+        'BUILD_NUMBER': 4,
+        'RESULT': 'UNSTABLE',
+        'BUILD_URL': 'https://ci.lubuntu.me/job/lugito/4/',
+    }))
+
+    assert(status == ('lugito', '\x038just became unstable\x03',
+        'https://ci.lubuntu.me/job/lugito/4/'))
+    assert(obj._session.get.call_count == 1)
+
+
+def test_receive_running(obj):
+    """Test a running build is reported as pending"""
+
+    api_builds(obj, (2, None, True), (1, 'SUCCESS', False))
+
+    with pytest.raises(BuildPending):
+        obj.receive(json.dumps({'PROJECT': 'lugito', 'BUILD_NUMBER': 2}))
+
+    with pytest.raises(BuildPending):
+        obj.receive(json.dumps({'PROJECT': 'lugito'}))
+
+
+def test_receive_last_build(obj):
+    """Test falling back to the most recent build"""
+
+    api_builds(obj, (2, 'SUCCESS', False), (1, 'FAILURE', False))
+
+    status = obj.receive(json.dumps({'PROJECT': 'lugito'}))
+
+    assert(status == ('lugito', '\x033just succeeded after failing\x03',
+        'https://ci.lubuntu.me/job/lugito/2/'))
+    assert(obj._session.get.call_count == 1)
+
+
+def test_receive_unknown_job(obj):
+    """Test unknown jobs are ignored"""
+
+    obj._session.get.return_value.status_code = 404
+
+    assert(obj.receive(json.dumps({'PROJECT': 'unknown'})) is None)
+
+
+def test_receive_no_build(obj):
+    """Test jobs without builds are ignored"""
+
+    api_builds(obj)
+
+    assert(obj.receive(json.dumps({'PROJECT': 'lugito'})) is None)
+
+
+def test_session_pool(monkeypatch):
+    """Test the session keeps a pool of connections to the server"""
+
+    monkeypatch.setattr(lugito.config, 'CONFIG', CONFIG)
+
+    obj = jenkins()
+    adapter = obj.session.get_adapter('https://ci.lubuntu.me/job/lugito')
+
+    assert(adapter._pool_maxsize == 4)
+
+
+def test_send_debounced(obj):
+    """Test a burst of commits triggers a single build"""
+
+    obj.debounce = 0.1
+    triggered = threading.Event()
+    threads = []
+
+    def post(*args, **kwargs):
+        threads.append(threading.current_thread().name)
+        triggered.set()
+        return MagicMock()
+
+    obj._session.post.side_effect = post
+
+    for _ in range(5):
+        obj.send(package_name='rLUGITO')
+
+    assert(obj.trigger_stats() == {'triggered': 0, 'collapsed': 4,
+        'pending': 1})
+
+    assert(triggered.wait(5))
+    time.sleep(0.05)
+
+    obj._session.post.assert_called_once_with(
+        'https://ci.lubuntu.me/git/notifyCommit',
+        params={'url': 'https://phab.lubuntu.me/source/lugito.git'}, data='',
+        timeout=30)
+    assert(obj.trigger_stats() == {'triggered': 1, 'collapsed': 4,
+        'pending': 0})
+
+    # The scheduler thread only queues the request
+    assert(threads[0].startswith('lugito-jenkins'))
+
+    obj.scheduler.shutdown()
+
+
+def test_shared_scheduler(monkeypatch):
+    """Test the connector uses the scheduler and dispatcher it is given"""
+
+    monkeypatch.setattr(lugito.config, 'CONFIG', CONFIG)
+
+    scheduler = MagicMock()
+    dispatcher = MagicMock()
+
+    obj = jenkins(scheduler=scheduler, dispatcher=dispatcher)
+    obj.send(package_name='rLUGITO')
+
+    scheduler.call_later.assert_called_once_with(5.0, obj._trigger, 'lugito')
+
+    obj._trigger('lugito')
+    dispatcher.submit.assert_called_once_with('jenkins', obj.notify_commit,
+        'lugito')
+
+
+def test_send_unknown_package(obj):
+    """Test commits to unknown repositories are ignored"""
+
+    obj.send('runknown')
+
+    assert(not obj._session.post.called)
+    assert(obj.trigger_stats()['pending'] == 0)
+
+
+def test_send_no_debounce(obj):
+    """Test triggering immediately without a debounce window"""
+
+    obj.debounce = 0
+
+    obj.send('rLUGITO')
+
+    assert(obj._session.post.call_count == 1)
@@ -9,12 +9,20 @@ Test launchpad connector
 # Imports
 import json
 import phabricator
+import time
+import threading
 import lugito
+import pytest
+import os
 from lugito.connectors import launchpad
+from lugito.connectors.launchpad import UPDATED, ALREADY_FIXED, SKIPPED,\
+    NO_TASK, FAILED
+from lazr.restfulclient.errors import Unauthorized
+from unittest.mock import MagicMock, patch
 
 # Setup ###############################################################
 
-lugito.config.CONFIG = {
+CONFIG = {
     'phabricator': {
         'host': 'http://127.0.0.1:9091/api/',
         'token': 'api-nojs2ip33hmp4zn6u6cf72w7d6yh',
@@ -48,6 +56,50 @@ lugito.config.CONFIG = {
     },
 }
 
+lugito.config.CONFIG = CONFIG
+
+
+def fake_bug(*targets):
+    """A bug with a task for each target"""
+
+    bug = MagicMock()
+    bug.bug_tasks = []
+
+    for target in targets:
+        task = MagicMock()
+        task.bug_target_display_name = target
+        task.status = 'New'
+        bug.bug_tasks.append(task)
+
+    return bug
+
+
+@pytest.fixture
+def obj(monkeypatch):
+    """A launchpad connector with a fake Launchpad"""
+
+    monkeypatch.setattr(lugito.config, 'CONFIG', CONFIG)
+
+    obj = launchpad()
+    obj.bugs = {
+        '1': fake_bug('nm-tray (Ubuntu)', 'nm-tray (Ubuntu Bionic)'),
+        '2': fake_bug('lxqt-config (Ubuntu)'),
+        '3': fake_bug('nm-tray (Ubuntu)'),
+    }
+
+    def load(path):
+        bug = path.split('/')[-1]
+
+        if bug == '4':
+            raise ValueError('Launchpad is down')
+
+        return obj.bugs[bug]
+
+    obj.login = MagicMock()
+    obj.login.return_value.load.side_effect = load
+
+    return obj
+
 
 # Tests ###############################################################
 
@@ -103,3 +155,269 @@ def test_get_bugs_list():
 
     assert(obj.get_bugs_list("lp: #1234") == ['1234'])
     assert(obj.get_bugs_list("#1234") == [])
+
+
+def test_send(obj):
+    """Test updating the bugs of a commit"""
+
+    result = obj.send('rnmtraypackaging', 'Fix the tray icon lp: #1, #2, #3')
+
+    assert([(outcome.bug, outcome.outcome) for outcome in result] == [
+        ('1', UPDATED), ('2', NO_TASK), ('3', UPDATED)])
+    assert(result.ok)
+
+    # The release task is preferred
+    task = obj.bugs['1'].bug_tasks[1]
+    assert(task.status == 'Fix Committed')
+    assert(task.lp_save.called)
+    assert(not obj.bugs['1'].bug_tasks[0].lp_save.called)
+    assert(obj.bugs['1'].newMessage.called)
+
+    assert(not obj.bugs['2'].newMessage.called)
+
+
+def test_send_failure_isolated(obj):
+    """Test a failing bug doesn't affect the others"""
+
+    result = obj.send('rnmtraypackaging', 'lp: #4, #3')
+
+    assert([(outcome.bug, outcome.outcome) for outcome in result] == [
+        ('4', FAILED), ('3', UPDATED)])
+    assert(not result.ok)
+    assert(isinstance(result.failed[0].error, ValueError))
+    assert(obj.bugs['3'].bug_tasks[0].lp_save.called)
+
+
+def test_send_concurrent(obj):
+    """Test bugs are processed concurrently"""
+
+    obj.bugs = {str(bug): fake_bug('nm-tray (Ubuntu)') for bug in range(4)}
+    load = obj.login.return_value.load.side_effect
+
+    def slow_load(path):
+        time.sleep(0.2)
+        return load(path)
+
+    obj.login.return_value.load.side_effect = slow_load
+
+    started = time.monotonic()
+    result = obj.send('rnmtraypackaging', 'lp: #0, #1, #2, #3')
+
+    assert(time.monotonic() - started < 0.6)
+    assert(all(outcome.latency >= 0.2 for outcome in result))
+    assert(len(result) == 4)
+
+
+def test_send_no_bugs(obj):
+    """Test commits without bug references"""
+
+    result = obj.send('rnmtraypackaging', 'Fix the tray icon')
+
+    assert(len(result) == 0)
+    assert(not obj.login.called)
+
+
+def test_get_task(obj):
+    """Test choosing the task with the best ranked target"""
+
+    bug = fake_bug('nm-tray (Ubuntu)', 'nm-tray (Ubuntu Trusty)',
+        'lxqt-config (Ubuntu Cosmic)', 'nm-tray (Ubuntu Bionic)',
+        'nm-tray (Debian)', 'qps (Ubuntu)')
+
+    assert(obj.get_task('nm-tray', bug.bug_tasks) is bug.bug_tasks[3])
+    assert(obj.get_task('nm-tray', bug.bug_tasks[:1]) is bug.bug_tasks[0])
+    assert(obj.get_task('nm-tray', bug.bug_tasks[4:]) is None)
+    assert(obj.get_task('lxqt-config', bug.bug_tasks) is bug.bug_tasks[2])
+
+    # Packages missing from the config are ranked on the fly
+    assert(obj.get_task('qps', bug.bug_tasks) is bug.bug_tasks[5])
+
+
+def test_login(monkeypatch):
+    """Test logging in with the cache directory and credentials file"""
+
+    monkeypatch.setitem(CONFIG['connectors']['launchpad'], 'cache_dir',
+        '/tmp/launchpadlib')
+    monkeypatch.setattr(lugito.config, 'CONFIG', CONFIG)
+
+    obj = launchpad()
+
+    with patch('lugito.connectors.launchpad.lp.login_with') as login_with:
+        assert(obj.get_lp() is login_with.return_value)
+
+        # The session is reused
+        assert(obj.get_lp() is login_with.return_value)
+
+    login_with.assert_called_once_with('lugito', 'production',
+        launchpadlib_dir='/tmp/launchpadlib', credentials_file=None,
+        version='devel')
+
+
+def test_send_lazy_login(obj):
+    """Test logging in when the first bug is processed"""
+
+    assert(not obj.login.called)
+
+    obj.send('rnmtraypackaging', 'lp: #1')
+    obj.send('rnmtraypackaging', 'lp: #3')
+
+    # The worker thread keeps its session
+    assert(obj.login.call_count == 1)
+
+
+def test_connect(obj):
+    """Test connecting logs in on a worker of the bug pool"""
+
+    obj.connect()
+
+    assert(obj.login.call_count == 1)
+    assert(not hasattr(obj, 'lp'))
+
+    # The worker keeps its session
+    obj.send('rnmtraypackaging', 'lp: #1')
+    assert(obj.login.call_count == 1)
+
+
+def test_send_session_expired(obj, tmp_path):
+    """Test authorizing again when the credentials are rejected"""
+
+    obj.credentials_file = str(tmp_path / 'launchpad.credentials')
+    with open(obj.credentials_file, 'w') as f:
+        f.write('expired')
+
+    expired = MagicMock()
+    expired.load.side_effect = Unauthorized(MagicMock(status=401), '')
+    session = obj.login.return_value
+    obj.login.side_effect = [expired, session]
+
+    result = obj.send('rnmtraypackaging', 'lp: #1')
+
+    assert([(outcome.bug, outcome.outcome) for outcome in result] == [
+        ('1', UPDATED)])
+    assert(obj.login.call_count == 2)
+
+    # The rejected credentials are not loaded again
+    assert(not os.path.exists(obj.credentials_file))
+
+
+def test_drop_credentials_once(obj, tmp_path):
+    """Test the credentials of a new login are not dropped by a worker
+    that logged in with the previous ones"""
+
+    obj.credentials_file = str(tmp_path / 'launchpad.credentials')
+    obj.get_lp()
+
+    # Another worker authorized again
+    obj._credentials += 1
+    with open(obj.credentials_file, 'w') as f:
+        f.write('fresh')
+
+    obj.drop_credentials()
+
+    assert(os.path.exists(obj.credentials_file))
+    assert(obj._local.lp is None)
+
+
+def test_send_session_expired_save(obj):
+    """Test the comment isn't posted again when the save is retried"""
+
+    expired = MagicMock()
+    expired.load.return_value = fake_bug('nm-tray (Ubuntu)')
+    task = expired.load.return_value.bug_tasks[0]
+    task.lp_save.side_effect = Unauthorized(MagicMock(status=401), '')
+
+    # The bug loaded again by the new session
+    fresh = MagicMock()
+    fresh.load.return_value = fake_bug('nm-tray (Ubuntu)')
+    obj.login.side_effect = [expired, fresh]
+
+    result = obj.send('rnmtraypackaging', 'lp: #1')
+
+    assert(result.outcomes[0].outcome == UPDATED)
+    assert(expired.load.return_value.newMessage.call_count == 1)
+    assert(not fresh.load.return_value.newMessage.called)
+    assert(fresh.load.return_value.bug_tasks[0].lp_save.called)
+
+
+def test_send_ledger(obj):
+    """Test a commit delivered again doesn't update its bugs twice"""
+
+    phid = 'PHID-CMIT-w6ndx6d5lyq3lhkbuefv'
+    obj.send('rnmtraypackaging', 'lp: #1, #4', commit_phid=phid)
+
+    obj.bugs['1'].newMessage.reset_mock()
+    obj.login.return_value.load.reset_mock()
+
+    result = obj.send('rnmtraypackaging', 'lp: #1, #4', commit_phid=phid)
+
+    # The failed bug is retried
+    assert([(outcome.bug, outcome.outcome) for outcome in result] == [
+        ('1', SKIPPED), ('4', FAILED)])
+    assert(not obj.bugs['1'].newMessage.called)
+    obj.login.return_value.load.assert_called_once_with('/bugs/4')
+
+    # Another commit updates the bug
+    result = obj.send('rnmtraypackaging', 'lp: #1',
+        commit_phid='PHID-CMIT-ehxkdp3hnlnbvz3xhbzo')
+
+    assert(result.outcomes[0].outcome == ALREADY_FIXED)
+
+
+def test_send_ledger_concurrent(obj):
+    """Test a delivery running at the same time doesn't comment twice"""
+
+    load = obj.login.return_value.load.side_effect
+
+    def slow_load(path):
+        time.sleep(0.2)
+        return load(path)
+
+    obj.login.return_value.load.side_effect = slow_load
+
+    results = []
+    thread = threading.Thread(target=lambda: results.append(obj.send(
+        'rnmtraypackaging', 'lp: #1', commit_phid='PHID-CMIT-x')))
+    thread.start()
+    time.sleep(0.05)
+
+    results.append(obj.send('rnmtraypackaging', 'lp: #1',
+        commit_phid='PHID-CMIT-x'))
+    thread.join()
+
+    assert(sorted(result.outcomes[0].outcome for result in results) == [
+        SKIPPED, UPDATED])
+    assert(obj.bugs['1'].newMessage.call_count == 1)
+
+
+def test_send_ledger_persisted(monkeypatch, tmpdir):
+    """Test the ledger survives a restart"""
+
+    monkeypatch.setitem(CONFIG['connectors']['launchpad'], 'ledger_path',
+        os.path.join(str(tmpdir), 'ledger.sqlite'))
+    monkeypatch.setattr(lugito.config, 'CONFIG', CONFIG)
+
+    obj = launchpad()
+    obj.ledger.add(['PHID-CMIT-w6ndx6d5lyq3lhkbuefv:1'])
+
+    obj = launchpad()
+    obj.login = MagicMock()
+
+    result = obj.send('rnmtraypackaging', 'lp: #1',
+        commit_phid='PHID-CMIT-w6ndx6d5lyq3lhkbuefv')
+
+    assert(result.outcomes[0].outcome == SKIPPED)
+    assert(not obj.login.called)
+
+
+def test_send_already_fixed(obj):
+    """Test tasks already Fix Committed are not saved"""
+
+    task = obj.bugs['3'].bug_tasks[0]
+    task.status = 'Fix Committed'
+
+    result = obj.send('rnmtraypackaging', 'lp: #3')
+
+    assert(result.outcomes[0].outcome == ALREADY_FIXED)
+    assert(result.ok)
+    assert(obj.bugs['3'].newMessage.called)
+    assert(not task.lp_save.called)
@@ -11,9 +11,11 @@ import os
 import pytest
 import phabricator
 import json
+import hmac
 import http
 import lugito
-from lugito import Lugito
+from lugito import Lugito, LugitoEvent
+from hashlib import sha256
 from unittest.mock import MagicMock
 
 # Setup ###############################################################
@@ -64,6 +66,20 @@ FAKE_REQ_EDITED_COMMENT = os.path.join(TEST_DIR,
 FAKE_EDITED_COMMENT = os.path.join(TEST_DIR,
     'fake_transaction_edit_comment.json')
 
+
+def load_event(req_data, transaction=None, partial=False):
+    """Build an event from the pre-prepared request and transaction files"""
+
+    with open(req_data, 'r') as f:
+        request_data = json.load(f)
+
+    transactions = []
+    if transaction is not None:
+        with open(transaction, 'r') as f:
+            transactions = json.load(f)
+
+    return LugitoEvent(request_data, transactions, partial)
+
 # Tests ###############################################################
 
 def test_init():
@@ -96,7 +112,10 @@ def test_validate_request():
         "a8f636f03ed4464ddb398ea873ffab409d941f87396f28fa9d22bb58cfbedc9f"
     }
 
-    assert(obj.validate_request('diffhook', request_mock))
+    event = obj.validate_request('diffhook', request_mock)
+
+    assert(isinstance(event, LugitoEvent))
+    assert(event.object_phid == 'PHID-DREV-qxuxc6eankxb7rw7iusf')
     assert(obj.phab.transaction.search.is_called())
 
 
@@ -115,7 +134,7 @@ def test_invalid_HMAC():
         "a8f6364464ddb398ea873ffab409d941f87396f28fa9d22bb58cfbedc9f"
     }
 
-    assert(not obj.validate_request('diffhook', request_mock))
+    assert(obj.validate_request('diffhook', request_mock) is None)
 
 
 def test_author_fullname():
@@ -123,11 +142,7 @@ def test_author_fullname():
 
     obj = Lugito()
 
-    with open(FAKE_REQ_DATA, 'r') as f:
-        obj.request_data = json.load(f)
-
-    with open(FAKE_TRANSACTION, 'r') as f:
-        obj.transaction = json.load(f)
+    event = load_event(FAKE_REQ_DATA, FAKE_TRANSACTION)
 
     obj.phab = MagicMock()
     obj.phab.phid.query = MagicMock(return_value={
@@ -137,7 +152,7 @@ def test_author_fullname():
         }
     )
 
-    author_name = obj.get_author_fullname()
+    author_name = obj.get_author_fullname(event)
     assert(author_name == 'AuthorName')
 
 
@@ -146,16 +161,12 @@ def test_author_fullname_error():
 
     obj = Lugito()
 
-    with open(FAKE_REQ_DATA, 'r') as f:
-        obj.request_data = json.load(f)
-
-    with open(FAKE_TRANSACTION, 'r') as f:
-        obj.transaction = json.load(f)
+    event = load_event(FAKE_REQ_DATA, FAKE_TRANSACTION)
 
     obj.phab = MagicMock()
     obj.phab.phid.query = MagicMock(side_effect=http.client.HTTPException)
 
-    author_name = obj.get_author_fullname()
+    author_name = obj.get_author_fullname(event)
     assert(author_name is None)
 
 
@@ -164,36 +175,27 @@ def test_get_object_type():
 
     obj = Lugito()
 
-    with open(FAKE_REQ_DATA, 'r') as f:
-        obj.request_data = json.load(f)
+    event = load_event(FAKE_REQ_DATA)
 
-    assert(obj.get_object_type() == 'DREV')
+    assert(obj.get_object_type(event) == 'DREV')
 
 def test_is_new_object_false():
     """Test is new task - false"""
 
     obj = Lugito()
 
-    with open(FAKE_REQ_DATA, 'r') as f:
-        obj.request_data = json.load(f)
-
-    with open(FAKE_TRANSACTION, 'r') as f:
-        obj.transaction = json.load(f)
+    event = load_event(FAKE_REQ_DATA, FAKE_TRANSACTION)
 
-    assert (not obj.is_new_object())
+    assert (not obj.is_new_object(event))
 
 def test_is_new_object_true():
     """Test is new task - true"""
 
     obj = Lugito()
 
-    with open(FAKE_REQ_DATA, 'r') as f:
-        obj.request_data = json.load(f)
-
-    with open(FAKE_TRANSACTION_NEW_OBJECT, 'r') as f:
-        obj.transaction = json.load(f)
+    event = load_event(FAKE_REQ_DATA, FAKE_TRANSACTION_NEW_OBJECT)
 
-    assert (obj.is_new_object())
+    assert (obj.is_new_object(event))
 
 
 def test_is_new_comment():
@@ -201,13 +203,9 @@ def test_is_new_comment():
 
     obj = Lugito()
 
-    with open(FAKE_REQ_NEW_COMMENT, 'r') as f:
-        obj.request_data = json.load(f)
+    event = load_event(FAKE_REQ_NEW_COMMENT, FAKE_NEW_COMMENT)
 
-    with open(FAKE_NEW_COMMENT, 'r') as f:
-        obj.transaction = json.load(f)
-
-    new_comment, edited, _id = obj.is_comment()
+    new_comment, edited, _id = obj.is_comment(event)
 
     assert(new_comment)
     assert(not edited)
@@ -219,14 +217,225 @@ def test_is_edited_comment():
 
     obj = Lugito()
 
-    with open(FAKE_REQ_EDITED_COMMENT, 'r') as f:
-        obj.request_data = json.load(f)
-
-    with open(FAKE_EDITED_COMMENT, 'r') as f:
-        obj.transaction = json.load(f)
+    event = load_event(FAKE_REQ_EDITED_COMMENT, FAKE_EDITED_COMMENT)
 
-    new_comment, edited, _id = obj.is_comment()
+    new_comment, edited, _id = obj.is_comment(event)
 
     assert(not new_comment)
     assert(edited)
     assert(_id == 157)
+
+
+def test_get_transactions_targeted():
+    """Test only the payload transactions are requested"""
+
+    obj = Lugito()
+    obj.phab = MagicMock()
+    obj.phab.transaction.search = MagicMock(return_value={'data': []})
+
+    with open(FAKE_REQ_DATA, 'r') as f:
+        request_data = json.load(f)
+
+    _, partial = obj.get_transactions(request_data)
+
+    obj.phab.transaction.search.assert_called_with(
+        objectIdentifier='PHID-DREV-qxuxc6eankxb7rw7iusf',
+        constraints={'phids': ['PHID-XACT-DREV-34sap7mpfbsucjw']})
+    assert(partial)
+
+
+def test_get_transactions_fallback():
+    """Test the full history is searched if the payload has no transactions"""
+
+    obj = Lugito()
+    obj.phab = MagicMock()
+    obj.phab.transaction.search = MagicMock(return_value={'data': []})
+
+    with open(FAKE_REQ_DATA, 'r') as f:
+        request_data = json.load(f)
+
+    del request_data['transactions']
+    _, partial = obj.get_transactions(request_data)
+
+    obj.phab.transaction.search.assert_called_with(
+        objectIdentifier='PHID-DREV-qxuxc6eankxb7rw7iusf')
+    assert(not partial)
+
+
+def test_is_new_object_partial():
+    """Test is new task using only the webhook transactions"""
+
+    obj = Lugito()
+
+    event = load_event(FAKE_REQ_DATA, FAKE_TRANSACTION_NEW_OBJECT, True)
+    assert(obj.is_new_object(event))
+
+    # The same edit without the create transaction
+    event = LugitoEvent(event.request_data, event.transaction[:-1], True)
+    assert(not obj.is_new_object(event))
+
+
+def test_get_handles_batched():
+    """Test the author and object are resolved with one phid.query"""
+
+    obj = Lugito()
+
+    event = load_event(FAKE_REQ_DATA, FAKE_TRANSACTION)
+
+    obj.phab = MagicMock()
+    obj.phab.phid.query = MagicMock(return_value={
+        'PHID-USER-5cmhaqtkggymhvbyqdcv': {
+            'fullName': 'AuthorName',
+            },
+        'PHID-DREV-qxuxc6eankxb7rw7iusf': {
+            'fullName': 'D1: Some diff',
+            'uri': 'http://127.0.0.1:9091/D1',
+            'name': 'D1',
+            },
+        }
+    )
+
+    assert(obj.get_author_fullname(event) == 'AuthorName')
+    assert(obj.get_object_string(event, 'fullName') == 'D1: Some diff')
+    assert(obj.get_object_string(event, 'uri') == 'http://127.0.0.1:9091/D1')
+
+    obj.phab.phid.query.assert_called_once_with(phids=[
+        'PHID-DREV-qxuxc6eankxb7rw7iusf', 'PHID-USER-5cmhaqtkggymhvbyqdcv'])
+
+
+def test_get_repository_name():
+    """Test the repository is resolved together with the event handles"""
+
+    obj = Lugito()
+
+    event = load_event(FAKE_REQ_DATA, FAKE_TRANSACTION)
+
+    obj.phab = MagicMock()
+    obj.phab.diffusion.commit.search = MagicMock(return_value={
+        'data': [{'fields': {'repositoryPHID': 'PHID-REPO-1'}}],
+        }
+    )
+    obj.phab.phid.query = MagicMock(return_value={
+        'PHID-USER-5cmhaqtkggymhvbyqdcv': {'fullName': 'AuthorName'},
+        'PHID-DREV-qxuxc6eankxb7rw7iusf': {'name': 'D1'},
+        'PHID-REPO-1': {'name': 'rART'},
+        }
+    )
+
+    obj.prefetch_handles(event, repository=True)
+
+    assert(obj.get_repository_name(event) == 'rART')
+    assert(obj.get_author_fullname(event) == 'AuthorName')
+    assert(obj.phab.diffusion.commit.search.call_count == 1)
+    assert(obj.phab.phid.query.call_count == 1)
+
+
+def test_handle_cache():
+    """Test handles are reused between events"""
+
+    obj = Lugito()
+
+    obj.phab = MagicMock()
+    obj.phab.phid.query = MagicMock(return_value={
+        'PHID-USER-5cmhaqtkggymhvbyqdcv': {'fullName': 'AuthorName'},
+        'PHID-DREV-qxuxc6eankxb7rw7iusf': {'fullName': 'D1: Some diff'},
+        }
+    )
+
+    event = load_event(FAKE_REQ_DATA, FAKE_TRANSACTION)
+    assert(obj.get_author_fullname(event) == 'AuthorName')
+
+    event = load_event(FAKE_REQ_DATA, FAKE_TRANSACTION)
+    assert(obj.get_author_fullname(event) == 'AuthorName')
+    assert(obj.phab.phid.query.call_count == 1)
+
+    # A new hook on the diff only refreshes the diff
+    obj.handle_cache.invalidate('PHID-DREV-qxuxc6eankxb7rw7iusf')
+
+    event = load_event(FAKE_REQ_DATA, FAKE_TRANSACTION)
+    assert(obj.get_object_string(event, 'fullName') == 'D1: Some diff')
+    obj.phab.phid.query.assert_called_with(
+        phids=['PHID-DREV-qxuxc6eankxb7rw7iusf'])
+
+
+def test_is_rename():
+    """Test only the delivered title transactions rename the object"""
+
+    obj = Lugito()
+
+    event = load_event(FAKE_REQ_DATA, FAKE_TRANSACTION_NEW_OBJECT, True)
+    assert(obj.is_rename(event))
+
+    # The title transaction of the full history isn't delivered by the hook
+    event = load_event(FAKE_REQ_NEW_COMMENT, FAKE_NEW_COMMENT)
+    assert(not obj.is_rename(event))
+
+
+def test_load_event_rename():
+    """Test the handle cache is only invalidated by a rename"""
+
+    obj = Lugito()
+    obj.phab = MagicMock()
+    obj.handle_cache.set('PHID-DREV-qxuxc6eankxb7rw7iusf', {'name': 'D1'})
+
+    with open(FAKE_REQ_DATA, 'r') as f:
+        data = f.read().encode()
+
+    with open(FAKE_NEW_COMMENT, 'r') as f:
+        comments = json.load(f)[:1]
+
+    obj.phab.transaction.search = MagicMock(return_value={'data': comments})
+    obj.load_event(data)
+    assert('PHID-DREV-qxuxc6eankxb7rw7iusf' in obj.handle_cache)
+
+    with open(FAKE_TRANSACTION_NEW_OBJECT, 'r') as f:
+        edits = json.load(f)
+
+    obj.phab.transaction.search = MagicMock(return_value={'data': edits})
+    obj.load_event(data)
+    assert('PHID-DREV-qxuxc6eankxb7rw7iusf' not in obj.handle_cache)
+
+
+def test_validate_request_duplicate():
+    """Test a repeated delivery is dropped before any Conduit call"""
+
+    obj = Lugito()
+    obj.phab = MagicMock()
+    obj.phab.transaction.search = MagicMock(return_value={'data': []})
+
+    request_mock = MagicMock()
+
+    with open(FAKE_REQ_DATA, 'r') as f:
+        request_mock.data = f.read().encode()
+
+    request_mock.headers = {
+        "X-Phabricator-Webhook-Signature": hmac.new(obj.HMAC['diffhook'],
+            request_mock.data, sha256).hexdigest()
+    }
+
+    assert(obj.validate_request('diffhook', request_mock) is not None)
+    assert(obj.validate_request('diffhook', request_mock) is None)
+    assert(obj.phab.transaction.search.call_count == 1)
+
+    # The same transaction delivered to another webhook is processed
+    request_data = json.loads(request_mock.data)
+    assert(not obj.is_duplicate('commithook', request_data))
+
+
+def test_load_event_retry():
+    """Test the retry of a delivery that failed is processed"""
+
+    obj = Lugito()
+    obj.phab = MagicMock()
+    obj.phab.transaction.search = MagicMock(side_effect=[
+        http.client.HTTPException('Conduit is down'), {'data': []}])
+
+    with open(FAKE_REQ_DATA, 'r') as f:
+        data = f.read().encode()
+
+    with pytest.raises(http.client.HTTPException):
+        obj.load_event(data, 'diffhook')
+
+    assert(obj.load_event(data, 'diffhook') is not None)
+    assert(obj.load_event(data, 'diffhook') is None)
+
@@ -0,0 +1,100 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+# S.D.G
+
+"""
+Test startup profiling
+"""
+
+# Imports
+import io
+import os
+import lugito
+from lugito import profiling
+from lugito.cli import main
+from unittest.mock import MagicMock
+
+# Startup budget in seconds, generous as test machines vary
+BUDGET = float(os.environ.get('LUGITO_STARTUP_BUDGET', 10))
+
+MINIMAL_CONFIG = """
+[phabricator]
+host = http://127.0.0.1:9091/api/
+token = api-nojs2ip33hmp4zn6u6cf72w7d6yh
+"""
+
+
+def setup_startup(monkeypatch, tmpdir):
+    """Start lugito with a minimal config in a temporary directory"""
+
+    tmpdir.join('.lugitorc').write(MINIMAL_CONFIG)
+    monkeypatch.chdir(tmpdir)
+
+    root = os.path.dirname(os.path.dirname(lugito.__file__))
+    monkeypatch.setenv('PYTHONPATH', root)
+
+
+# Tests ###############################################################
+
+def test_phase(monkeypatch):
+    """Test phases are only timed when profiling"""
+
+    with profiling.phase('ignored'):
+        pass
+
+    monkeypatch.setattr(profiling, 'PHASES', [])
+
+    with profiling.phase('outer'):
+        with profiling.phase('inner'):
+            pass
+
+    assert([name for name, seconds in profiling.PHASES] == ['outer',
+        'inner'])
+    assert(profiling.PHASES[0][1] >= profiling.PHASES[1][1])
+
+
+def test_startup_budget(monkeypatch, tmpdir, capsys):
+    """Test the startup is within the budget"""
+
+    setup_startup(monkeypatch, tmpdir)
+
+    status = main(['--profile-startup', '--startup-budget', str(BUDGET)])
+    report = capsys.readouterr().out
+
+    assert(status == 0), report
+    assert('import lugito.webhooks' in report)
+    assert('Lugito' in report)
+    assert('flask' in report)
+
+
+def test_startup_over_budget(monkeypatch, tmpdir):
+    """Test exceeding the budget fails"""
+
+    setup_startup(monkeypatch, tmpdir)
+    report = io.StringIO()
+
+    assert(profiling.profile_startup(stream=report, budget=0) == 1)
+    assert('budget' in report.getvalue())
+
+
+def test_startup_budget_implies_profiling(monkeypatch):
+    """Test a budget alone profiles the startup"""
+
+    profile_startup = MagicMock(return_value=0)
+    monkeypatch.setattr(profiling, 'profile_startup', profile_startup)
+
+    assert(main(['--startup-budget', '2.5']) == 0)
+    profile_startup.assert_called_once_with(budget=2.5)
+
+
+
+def test_startup_dry_run(monkeypatch, capsys):
+    """Test the profiled startup doesn't connect or start the workers"""
+
+    webhooks = MagicMock()
+    monkeypatch.setattr(lugito, 'webhooks', webhooks, raising=False)
+
+    profiling.run_startup()
+
+    webhooks.start_services.assert_called_once_with(dry_run=True)
+    assert(profiling.PHASES_MARKER in capsys.readouterr().out)
@@ -0,0 +1,66 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+# S.D.G
+
+"""
+Test reference extraction
+"""
+
+# Imports
+from lugito.references import Reference, extract_references,\
+    parse_reference
+
+
+# Tests ###############################################################
+
+def test_extract_bare():
+    """Test extracting bare mentions"""
+
+    assert(extract_references('info T1 D22#333, (T4) T5.') == [
+        Reference('T', 1, None),
+        Reference('D', 22, 333),
+        Reference('T', 4, None),
+        Reference('T', 5, None),
+    ])
+
+
+def test_extract_ignores_words():
+    """Test words starting with T or D are not references"""
+
+    assert(extract_references('Today D2D T1a xT1 a/T1 #T1 T') == [])
+
+
+def test_extract_links():
+    """Test extracting links to a host"""
+
+    text = 'see https://phab.lubuntu.me/T154#3228 and '\
+        'http://phab.lubuntu.me/D24, not https://bugs.example.org/T1 or T2'
+
+    assert(extract_references(text, 'https://phab.lubuntu.me/',
+        bare=False) == [
+        Reference('T', 154, 3228),
+        Reference('D', 24, None),
+    ])
+
+    assert(extract_references(text) == [
+        Reference('T', 154, 3228),
+        Reference('D', 24, None),
+        Reference('T', 1, None),
+        Reference('T', 2, None),
+    ])
+
+
+def test_extract_links_with_path():
+    """Test the host may have a path"""
+
+    assert(extract_references('http://example.org/phab/T7',
+        'http://example.org/phab/', bare=False) == [Reference('T', 7, None)])
+
+
+def test_parse_reference():
+    """Test parsing a single reference"""
+
+    assert(parse_reference(' T154#3228 ') == Reference('T', 154, 3228))
+    assert(parse_reference('https://phab.lubuntu.me/D24').name == 'D24')
+    assert(parse_reference('T154 T155') is None)
+    assert(parse_reference('https://phab.lubuntu.me/Tblah') is None)